@@ -1,64 +1,305 @@
-import json, os, sys, time
+from startup_clock import STARTED as _started  # первым: отсчёт до остальных импортов
+
+# isort: split
+import json, os, signal, sys, time
+import asyncio
 import threading
+from collections import Counter
+from contextlib import asynccontextmanager, nullcontext
 from datetime import date
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, 
     CallbackQueryHandler, ConversationHandler, filters, ContextTypes
 )
-from fpdf import FPDF
 from telegram import InputFile
+from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 import logging
 
+import config
 from config import TOKEN, ADMIN_CHAT_ID
+from course import Course, CourseError, compile_course, load_snapshot, save_snapshot
+from menus import KeyboardCache, PageCache
+from metrics import SIZE_BUCKETS, InstrumentedRequest, Registry, summary_lines, timed
+from outbox import AdminOutbox
+from profiling import Profiler, parse_args as parse_profile_args
+from outbound import ADMIN, INTERACTIVE, REPLY_MODES as REPLY_MODE_NAMES, ReplyBatch, SendScheduler, current_batch, reply_metrics
+from routing import CallbackRouter, pack, step_action
+from shards import SHARD_PORT, SHARDS, STATS_PATH, peak_rss_mb, shard_path, stored_count, watch_parent
+from storage import LRUCache, ProgressStore, ProgressWriter, UserRecord, open_store
+from updates import PerUserUpdateProcessor
+from webhook import HttpServer, Response, WebhookIngest
+from certificate import CERT_TEXT, CertificateArchive, CertificateCache, CertificateRenderer
+
+# Время этапов старта, сек.; итог пишется в лог перед началом polling
+startup_times = {'import': time.perf_counter() - _started}
+
+# Кому доступны /reload, /stats и /profile
+ADMINS = getattr(config, 'ADMINS', [ADMIN_CHAT_ID])
+
+# Воркер шардированного запуска (python shards.py): номер шарда задаёт фронт
+SHARD = int(os.environ['BOT_SHARD']) if 'BOT_SHARD' in os.environ else None
+
+def data_path(name: str) -> str:
+    """Файл данных пользователей; у воркера — в папке его шарда."""
+    return name if SHARD is None else shard_path(SHARD, name)
 
 # --- Files and persistent storage ---
 COURSE_FILE = 'full_course_data.json'
-PROGRESS_FILE = 'progress.json'
-SAVE_INTERVAL = 60  # секунд между автосохранениями
+# Запасные языки для неполных переводов, например {'uk': ['ru', 'en']}
+LANG_FALLBACKS = getattr(config, 'LANG_FALLBACKS', {})
+COURSE_WATCH_INTERVAL = getattr(config, 'COURSE_WATCH_INTERVAL', 5)  # сек.; 0 — не следить за файлом
+COURSE_SNAPSHOT = getattr(config, 'COURSE_SNAPSHOT', None)  # бинарный снимок скомпилированного курса
+PROGRESS_FILE = data_path('progress.json')
+PROGRESS_JOURNAL = data_path('progress.journal')
+PROGRESS_BACKEND = getattr(config, 'PROGRESS_BACKEND', 'json')  # 'json' или 'sqlite'
+PROGRESS_DB = data_path(getattr(config, 'PROGRESS_DB', 'progress.db'))
+SAVE_INTERVAL = 60  # секунд между сворачиваниями журнала в снимок
+PROGRESS_FLUSH_LATENCY = getattr(config, 'PROGRESS_FLUSH_LATENCY', 1.0)  # сек. до записи изменений
+PROGRESS_FLUSH_BATCH = getattr(config, 'PROGRESS_FLUSH_BATCH', 500)      # пользователей в пачке
+
+# --- Рендеринг сертификатов ---
+CERT_POOL = getattr(config, 'CERT_POOL', 'process')      # 'process' или 'thread'
+CERT_WORKERS = getattr(config, 'CERT_WORKERS', 2)
+CERT_QUEUE_SIZE = getattr(config, 'CERT_QUEUE_SIZE', 8)  # задач в пуле одновременно
+cert_renderer = CertificateRenderer(CERT_WORKERS, CERT_POOL, CERT_QUEUE_SIZE)
+
+# Кэш готовых сертификатов: file_id из Telegram + байты PDF
+CERT_CACHE_FILE = data_path(getattr(config, 'CERT_CACHE_FILE', 'cert_cache.json'))
+CERT_CACHE_SIZE = getattr(config, 'CERT_CACHE_SIZE', 1000)      # записей
+CERT_CACHE_MAX_MB = getattr(config, 'CERT_CACHE_MAX_MB', 16)    # байтов PDF в памяти
+cert_cache = CertificateCache(CERT_CACHE_FILE, CERT_CACHE_SIZE, CERT_CACHE_MAX_MB * 1024 * 1024)
+
+# Архив выданных сертификатов на диске (по умолчанию выключен)
+CERT_ARCHIVE_DIR = getattr(config, 'CERT_ARCHIVE_DIR', None)
+CERT_ARCHIVE_MAX_MB = getattr(config, 'CERT_ARCHIVE_MAX_MB', 200)
+CERT_ARCHIVE_MAX_DAYS = getattr(config, 'CERT_ARCHIVE_MAX_DAYS', 90)
+CERT_ARCHIVE_SWEEP_INTERVAL = 3600  # секунд между очистками архива
+cert_archive: CertificateArchive | None = None
+
+# Исходящие сообщения: лимиты Telegram на бота в целом и на чат
+OUTBOUND_RATE = getattr(config, 'OUTBOUND_RATE', 25)              # сообщений в секунду всего
+OUTBOUND_CHAT_RATE = getattr(config, 'OUTBOUND_CHAT_RATE', 1.0)   # в секунду в личный чат
+OUTBOUND_CHAT_BURST = getattr(config, 'OUTBOUND_CHAT_BURST', 3)   # подряд без ожидания
+OUTBOUND_GROUP_RATE = getattr(config, 'OUTBOUND_GROUP_RATE', 20 / 60)  # в секунду в группу
+if SHARD is not None:
+    OUTBOUND_RATE /= SHARDS  # общий лимит бота делят все воркеры
+sender = SendScheduler(OUTBOUND_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST, OUTBOUND_GROUP_RATE)
+
+# Как отвечать на кнопку (маршрут — имя или префикс callback_data):
+# 'send' — каждый ответ новым сообщением, 'merge' — склеивать подряд идущие
+# ответы, 'edit' — склеивать и менять сообщение, на котором нажата кнопка
+REPLY_MODE = getattr(config, 'REPLY_MODE', 'merge')
+REPLY_MODES = {
+    **dict.fromkeys(('menu_show_course', 'show_course', 'select_step', 'back_main', 'test_final'), 'edit'),
+    **getattr(config, 'REPLY_MODES', {}),
+}
+if not {REPLY_MODE, *REPLY_MODES.values()} <= set(REPLY_MODE_NAMES):
+    raise ValueError(f"REPLY_MODE(S) must be one of {REPLY_MODE_NAMES}")
+reply_stats = Counter()  # ответы обработчиков и реальные вызовы Bot API
+
+# Вопросы пользователей админам: журнал на диске + дайджесты
+ADMIN_OUTBOX_FILE = data_path(getattr(config, 'ADMIN_OUTBOX_FILE', 'admin_outbox.jsonl'))
+ADMIN_DIGEST_DELAY = getattr(config, 'ADMIN_DIGEST_DELAY', 30)  # сек. от первого вопроса до отправки
+ADMIN_DIGEST_SIZE = getattr(config, 'ADMIN_DIGEST_SIZE', 10)    # вопросов в одном сообщении
+admin_outbox = AdminOutbox(ADMIN_OUTBOX_FILE, ADMIN_DIGEST_DELAY, ADMIN_DIGEST_SIZE)
+
+# Приём апдейтов: 'polling' или 'webhook' (свой HTTP-сервер за балансировщиком)
+BOT_MODE = getattr(config, 'BOT_MODE', 'polling')
+WEBHOOK_URL = getattr(config, 'WEBHOOK_URL', None)        # публичный адрес; None — setWebhook делается снаружи
+WEBHOOK_SECRET = getattr(config, 'WEBHOOK_SECRET', None)  # X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_LISTEN = getattr(config, 'WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = getattr(config, 'WEBHOOK_PORT', 8080)
+WEBHOOK_PATH = getattr(config, 'WEBHOOK_PATH', '/telegram')
+WEBHOOK_MAX_CONNECTIONS = getattr(config, 'WEBHOOK_MAX_CONNECTIONS', 40)
+WEBHOOK_QUEUE_SIZE = getattr(config, 'WEBHOOK_QUEUE_SIZE', 1000)  # принятых, но не начатых апдейтов
+WEBHOOK_BATCH = getattr(config, 'WEBHOOK_BATCH', 50)              # апдейтов за один проход очереди
+if SHARD is not None:
+    # воркер получает апдейты только от фронта, по локальному HTTP
+    BOT_MODE, WEBHOOK_URL = 'webhook', None
+    WEBHOOK_LISTEN, WEBHOOK_PORT = '127.0.0.1', SHARD_PORT + SHARD
+    WEBHOOK_SECRET = os.environ['BOT_SHARD_SECRET']
+BOT_API_URL = getattr(config, 'BOT_API_URL', None)  # свой сервер Bot API вместо api.telegram.org
+if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+    sys.exit("❌ BOT_MODE = 'webhook' requires WEBHOOK_SECRET in config.py")
+webhook_ingest: WebhookIngest | None = None
+
+# Сколько апдейтов обрабатывать одновременно (апдейты одного пользователя — по очереди)
+CONCURRENT_UPDATES = getattr(config, 'CONCURRENT_UPDATES', 32)
+update_processor = PerUserUpdateProcessor(CONCURRENT_UPDATES) if CONCURRENT_UPDATES > 1 else None
+
+# Метрики: GET /metrics (формат Prometheus) на METRICS_LISTEN:METRICS_PORT и /stats для админов
+METRICS_LISTEN = getattr(config, 'METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = getattr(config, 'METRICS_PORT', None)  # None — только /stats
+METRICS_PATH = '/metrics'
+if METRICS_PORT and SHARD is not None:
+    METRICS_PORT += SHARD  # у каждого воркера свой порт
+registry = Registry()
+handler_seconds = registry.histogram('bot_handler_seconds', "Update handler latency", ('handler',))
+handler_errors = registry.counter('bot_handler_errors_total', "Exceptions in update handlers", ('handler',))
+route_seconds = registry.histogram('bot_route_seconds', "Callback button route latency", ('route',))
+route_errors = registry.counter('bot_route_errors_total', "Exceptions in callback routes", ('route',))
+api_seconds = registry.histogram('bot_api_seconds', "Bot API call latency", ('method',))
+api_errors = registry.counter('bot_api_errors_total', "Failed Bot API calls", ('method', 'status'))
+cert_seconds = registry.histogram('bot_certificate_render_seconds', "Certificate PDF render time")
+certs_sent = registry.counter('bot_certificates_total', "Certificates sent, by source", ('source',))
+flush_seconds = registry.histogram('bot_progress_flush_seconds', "Progress flush time")
+flush_records = registry.histogram('bot_progress_flush_records', "Users written per progress flush",
+                                   buckets=SIZE_BUCKETS)
+metrics_server: HttpServer | None = None
+
+# Профилирование по /profile: отчёты в PROFILE_DIR, сессия не дольше PROFILE_MAX_SECONDS
+PROFILE_DIR = data_path(getattr(config, 'PROFILE_DIR', 'profiles'))
+profiler = Profiler(max_seconds=getattr(config, 'PROFILE_MAX_SECONDS', 600))
+handler_names: set[str] = set()  # для проверки scope в /profile
 
 # Кэш в памяти
-_progress_cache: dict = {}
+_progress_cache: LRUCache = LRUCache()  # настоящий — в load_progress()
 _progress_lock = threading.Lock()
-user_final_passed = {}
-user_states = {}
-user_data = {}  # Словарь: {uid: {lang: "ru" или "en"}}
-progress: dict  # Словарь: {uid: {step: номер, финальный тест пройден или нет}}
-user_final: dict[str, dict[str,int]] = {}
+progress_store: ProgressStore  # открывается в load_progress()
+progress_writer: ProgressWriter
+# В памяти держим только недавно активных пользователей
+USER_CACHE_SIZE = getattr(config, 'USER_CACHE_SIZE', 10000)
+USER_CACHE_TTL = getattr(config, 'USER_CACHE_TTL', 6 * 3600)       # сек. простоя
+FINAL_SESSION_TTL = getattr(config, 'FINAL_SESSION_TTL', 3600)     # брошенный финальный тест
+progress: LRUCache  # {uid: UserRecord} недавно активных — прогресс, язык и состояние диалога
 
 # логирование
 logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    format="%(asctime)s - " + (f"shard {SHARD} - " if SHARD is not None else "") + "%(name)s - %(levelname)s - %(message)s",
     level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
-def load_progress() -> dict:
-    """Однократно при старте загружает прогресс из файла в кэш."""
-    global _progress_cache
-    if os.path.exists(PROGRESS_FILE):
-        with _progress_lock:
-            with open(PROGRESS_FILE, encoding='utf-8') as f:
-                _progress_cache = json.load(f)
-    else:
-        _progress_cache = {}
-    return _progress_cache
+registry.gauge('bot_users_in_memory', "Users whose state is held in memory", lambda: len(_progress_cache))
+registry.gauge('bot_progress_pending', "Users waiting to be written", lambda: progress_writer.pending)
+registry.gauge('bot_outbound_queued', "Messages waiting in the send scheduler", lambda: sender.queue_depth())
+registry.gauge('bot_updates_users_busy', "Users with an update in progress",
+               lambda: update_processor.users_busy if update_processor else 0)
+registry.gauge('bot_admin_outbox_pending', "Questions not yet delivered to admins", lambda: admin_outbox.pending)
+registry.gauge('bot_certificates_rendering', "Certificates in the render pool", lambda: cert_renderer.pending)
+
+def observe_flush(seconds: float, records: int) -> None:
+    flush_seconds.observe(seconds)
+    flush_records.observe(records)
+
+def load_progress() -> LRUCache:
+    """
+    Однократно при старте открывает хранилище и готовит кэш прогресса.
 
-def save_progress() -> None:
-    """Сохраняет текущий кэш на диск."""
+    Хранилище целиком не читается: в памяти только LRU недавно активных
+    пользователей, остальные подтягиваются в get_user().
+    """
+    global _progress_cache, progress_store, progress_writer
+    progress_store = open_store(PROGRESS_BACKEND, PROGRESS_FILE, PROGRESS_JOURNAL, PROGRESS_DB)
     with _progress_lock:
-        with open(PROGRESS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(_progress_cache, f, ensure_ascii=False, indent=2)
+        # ожидание имени/вопроса и финальный тест есть только в памяти —
+        # такие записи переполнение не вытесняет, только простой дольше ttl
+        _progress_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL, pinned=UserRecord.in_flow)
+    progress_writer = ProgressWriter(
+        progress_store,
+        max_latency=PROGRESS_FLUSH_LATENCY, max_batch=PROGRESS_FLUSH_BATCH, on_flush=observe_flush
+    )
+    return _progress_cache
 
-def auto_save_loop():
+def get_user(uid: str) -> UserRecord:
+    """
+    Запись пользователя для чтения. Незнакомому отдаётся временная запись
+    по умолчанию: /help или случайная кнопка не заводят пользователя в памяти.
+    """
+    record = _progress_cache.get(uid)
+    if record is None:
+        # вытесненный, но ещё не записанный пользователь — берём у писателя
+        record = progress_writer.get_pending(uid) or progress_store.get(uid)
+        if record is None:
+            return UserRecord()
+        _progress_cache[uid] = record
+    return record
+
+def edit_user(uid: str) -> UserRecord:
+    """Запись пользователя для изменения; новый заводится здесь (на диск — после save_progress)."""
+    record = get_user(uid)
+    if uid not in _progress_cache:
+        _progress_cache[uid] = record
+    return record
+
+def save_progress(uid: str) -> None:
+    """Помечает пользователя изменённым; запись сделает progress_writer."""
+    progress_writer.mark_dirty(uid, edit_user(uid))
+
+def has_passed_final(uid: str) -> bool:
+    return get_user(uid).final_passed
+
+def sweep_user_caches() -> int:
+    """Выбрасывает из памяти давно неактивных пользователей."""
+    return _progress_cache.sweep()
+
+def compact_progress() -> None:
+    """Обслуживание хранилища: JSON — сворачивание журнала в снимок, SQLite — checkpoint WAL."""
+    progress_store.compact()
+
+async def auto_save_loop():
     while True:
         try:
-            time.sleep(SAVE_INTERVAL)
-            save_progress()
-        except Exception as e:
+            await asyncio.sleep(SAVE_INTERVAL)
+            await asyncio.to_thread(compact_progress)
+            await asyncio.to_thread(cert_cache.save)
+            sweep_user_caches()
+            logger.info("Progress writer: %s, users in memory: %d",
+                        progress_writer.metrics(), len(_progress_cache))
+            logger.info("Callback routes: %s, unknown: %d", router.top(), router.misses)
+            if update_processor:
+                logger.info("Updates: %s", update_processor.metrics())
+            logger.info("Outbound: %s, replies: %s, admin outbox: %s",
+                        sender.metrics(), reply_metrics(reply_stats), admin_outbox.metrics())
+        except asyncio.CancelledError:
+            raise
+        except Exception:
             logger.exception("Ошибка в auto_save_loop")
             # Немного подождать, чтобы не спамить логом
-            time.sleep(5)
+            await asyncio.sleep(5)
+
+def read_course(path) -> Course:
+    """
+    Читает и компилирует курс; CourseError, OSError и ValueError (битый JSON) — наружу.
+
+    Со снимком (COURSE_SNAPSHOT) неизменившийся курс берётся готовым, без
+    разбора JSON и проверки; после компиляции снимок перезаписывается.
+    """
+    if COURSE_SNAPSHOT:
+        course = load_snapshot(COURSE_SNAPSHOT, path, LANG_FALLBACKS)
+        if course is not None:
+            logger.info(f"📦 Course taken from snapshot {COURSE_SNAPSHOT}")
+            return course
+    with open(path, 'r', encoding='utf-8') as f:
+        course = compile_course(json.load(f), LANG_FALLBACKS)
+    if COURSE_SNAPSHOT:
+        try:
+            save_snapshot(course, COURSE_SNAPSHOT, path, LANG_FALLBACKS)
+        except Exception:
+            # снимок — только ускорение, без него бот работает как обычно
+            logger.warning("Не удалось сохранить снимок курса", exc_info=True)
+    return course
+
+def course_stamp(path) -> tuple[int, int]:
+    """(mtime, размер) файла курса — по ним видно, что файл поменялся."""
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+def log_course(course: Course) -> None:
+    logger.info(f"✅ Course loaded: {len(course.steps)} steps, "
+                f"{len(course.final_questions)} final questions, languages: {', '.join(course.langs)}")
+    if course.fallbacks_used:
+        logger.warning(f"Course: {len(course.fallbacks_used)} text(s) taken from fallback languages, "
+                       f"e.g. {', '.join(course.fallbacks_used[:3])}")
+
+def log_course_error(e: Exception) -> None:
+    if isinstance(e, CourseError):
+        for problem in e.problems:
+            logger.error(f"❗ Course: {problem}")
+    else:
+        logger.error(f"❗ JSON load error: {e}")
 
 def check_course_file(path):
     if not os.path.exists(path):
@@ -67,485 +308,445 @@ def check_course_file(path):
     size_kb = os.path.getsize(path) / 1024
     logger.info(f"📦 Course file size: {size_kb:.1f} KB")
     try:
-        with open(path, 'r', encoding='utf-8') as f:
-            course = json.load(f)
+        course = read_course(path)
     except Exception as e:
-        logger.error(f"❗ JSON load error: {e}")
+        log_course_error(e)
         sys.exit(1)
-    logger.info(f"✅ Course loaded, top-level keys: {list(course.keys())}")
+    log_course(course)
     return course
 
-# Загрузка
-COURSE = check_course_file(COURSE_FILE)
+# Курс загружается в load_course(), а не при импорте: процессы пула
+# сертификатов (spawn) импортируют bot.py заново как __mp_main__
+COURSE: Course
+keyboards: KeyboardCache
+pages: PageCache
+_course_stamp: tuple[int, int] | None = None
+_reload_lock = asyncio.Lock()
+
+def load_course() -> Course:
+    """Однократно при старте: курс, клавиатуры меню и страницы шагов."""
+    global COURSE, keyboards, pages, _course_stamp
+    t0 = time.perf_counter()
+    _course_stamp = course_stamp(COURSE_FILE) if os.path.exists(COURSE_FILE) else None
+    COURSE = check_course_file(COURSE_FILE)
+    # Клавиатуры меню и страницы шагов строятся один раз на весь курс
+    keyboards = KeyboardCache(COURSE)
+    pages = PageCache(COURSE)
+    startup_times['course'] = time.perf_counter() - t0
+    return COURSE
+
+def build_course_bundle(path):
+    """Курс и всё, что из него строится; вызывается в потоке, вне event loop."""
+    stamp = course_stamp(path)
+    course = read_course(path)
+    return stamp, course, KeyboardCache(course), PageCache(course)
+
+async def reload_course() -> float:
+    """
+    Перечитывает курс и подменяет COURSE, клавиатуры и страницы разом.
+
+    Компиляция и сборка кэшей идут в потоке; подмена — одним присваиванием
+    в event loop, так что обработчики видят либо старую, либо новую версию
+    целиком. Битый файл — исключение, прежняя версия остаётся. Возвращает
+    время перезагрузки в секундах.
+    """
+    global COURSE, keyboards, pages, _course_stamp
+    async with _reload_lock:
+        started = time.perf_counter()
+        stamp, course, new_keyboards, new_pages = await asyncio.to_thread(build_course_bundle, COURSE_FILE)
+        COURSE, keyboards, pages, _course_stamp = course, new_keyboards, new_pages, stamp
+        elapsed = time.perf_counter() - started
+    log_course(course)
+    return elapsed
+
+async def course_watch_loop():
+    """Следит за файлом курса и перезагружает его при изменении."""
+    failed_stamp = None  # версия, которую уже пробовали и отвергли
+    while True:
+        await asyncio.sleep(COURSE_WATCH_INTERVAL)
+        try:
+            stamp = course_stamp(COURSE_FILE)
+        except OSError:
+            continue
+        if stamp in (_course_stamp, failed_stamp):
+            continue
+        try:
+            elapsed = await reload_course()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:  # noqa: BLE001 — любой сбой: остаётся прежний курс
+            failed_stamp = stamp
+            log_course_error(e)
+            logger.error("Course file changed but was rejected, keeping the previous version")
+        else:
+            logger.info("Course reloaded in %.0f ms", elapsed * 1000)
     
 # --- Helpers ---
 def t(key, lang):
-    return COURSE['texts'][key][lang]
-
-
-# Тексты для сертификата
-CERT_TEXT = {
-    'ru': {
-        'title': "Сертификат о прохождении курса",
-        'subtitle': "Настоящим подтверждается, что",
-        'subsubtitle': "успешно прошёл(-а) мини-курс «Подкаст за 7 шагов»",
-        'footer': "Теперь вы не просто человек, а человек-голос.\nСлушайте себя. Говорите уверенно.",
-        'date_label': "Дата прохождения:"
-    },
-    'en': {
-        'title': "Certificate of Completion",
-        'subtitle': "This is to certify that",
-        'subsubtitle': "has successfully completed the mini-course Podcast in 7 Steps",
-        'footer': "Now you are not just a person, you are a voice.\nSpeak confidently and share your story!",
-        'date_label': "Date of completion:"
-    }
+    return COURSE.catalog.get(key, lang)
+
+def tf(key, lang, **values):
+    """Текст-шаблон с подстановкой (шаблоны разобраны заранее)."""
+    return COURSE.catalog.format(key, lang, **values)
+
+async def reply(message, *args, priority=INTERACTIVE, **kwargs):
+    """message.reply_text через планировщик; в обработчике кнопки — через её пачку ответов."""
+    batch = current_batch.get()
+    if batch is not None and batch.message is message:
+        return await batch.reply(*args, **kwargs)
+    return await sender.send(message.chat_id, lambda: message.reply_text(*args, **kwargs), priority)
+
+def reply_batch(route: str, update: Update) -> ReplyBatch:
+    mode = REPLY_MODES.get(route, REPLY_MODE)
+    return ReplyBatch(update.callback_query.message, mode, sender, reply_stats)
+
+@asynccontextmanager
+async def route_scope(route: str, update: Update):
+    """Маршрут кнопки: время и ошибки — в метрики, ответы — одной пачкой."""
+    session = profiler.session
+    with route_seconds.time(route), (session.track(route, update=False) if session else nullcontext()):
+        try:
+            async with reply_batch(route, update):
+                yield
+        except Exception:
+            route_errors.inc(route)
+            raise
+
+async def reply_document(message, *args, priority=INTERACTIVE, **kwargs):
+    return await sender.send(message.chat_id, lambda: message.reply_document(*args, **kwargs), priority)
+
+async def send_message(bot, chat_id, text, priority=ADMIN, **kwargs):
+    """bot.send_message через планировщик; по умолчанию — как уведомление админам."""
+    return await sender.send(chat_id, lambda: bot.send_message(chat_id=chat_id, text=text, **kwargs), priority)
+
+# Ответ, когда все воркеры сертификатов заняты
+CERT_BUSY_TEXT = {
+    'ru': "⏳ Ваш сертификат готовится, пришлём его через минуту.",
+    'en': "⏳ Your certificate is being prepared, it will arrive in a moment."
 }
-def generate_certificate_fpdf(name: str, lang: str, date_str: str, output_path: str = 'certificate.pdf') -> str:
-    pdf = FPDF('L', 'mm', 'A4')
-    pdf.set_auto_page_break(auto=False)
-    pdf.add_page()
-
-    base      = os.path.dirname(__file__)
-    icon_path = os.path.join(base, 'assets', 'mic.png')
-    icon_w    = 30  # ширина иконки в мм
-    fonts_dir = os.path.join(base, 'fonts')
-    regular   = os.path.join(fonts_dir, 'DejaVuSans.ttf')
-    bold      = os.path.join(fonts_dir, 'DejaVuSans-Bold.ttf')
-    # шрифты для кириллицы
-    pdf.add_font('DejaVu','', regular, uni=True)
-    pdf.add_font('DejaVu','B', bold,    uni=True)
-    
-    # --- фон и рамка (оставляем как было) ---
-    pdf.set_fill_color(111, 78, 55)
-    pdf.rect(0, 0, pdf.w, pdf.h, 'F')
-    pdf.set_draw_color(245, 245, 220)
-    pdf.set_line_width(4)
-    pdf.rect(10, 10, pdf.w-20, pdf.h-20)
-
-    # --- вставляем PNG-иконку ---
-    image_y = pdf.h * 0.20
-    pdf.image(icon_path,
-              x=(pdf.w - icon_w) / 2,
-              y=image_y,
-              w=icon_w)
-
-    # вот тут — спускаем текст ниже иконки + 5 мм отступ
-    pdf.set_y(image_y + icon_w + 5)
-    
-    # заголовок
-    pdf.add_font('DejaVu','B', os.path.join(base,'fonts','DejaVuSans-Bold.ttf'), uni=True)
-    pdf.set_font('DejaVu','B',36)
-    pdf.set_text_color(245, 245, 220)
-    pdf.cell(0, 15, CERT_TEXT[lang]['title'], ln=1, align='C')
-    
-    # подзаголовок
-    pdf.set_text_color(0, 0, 0)
-    pdf.set_font('DejaVu', '', 24)
-    pdf.cell(0, 12, CERT_TEXT[lang]['subtitle'], ln=1, align='C')
-    pdf.ln(5)
-
-    # имя
-    pdf.set_text_color(245, 245, 220)
-    pdf.set_font('DejaVu', 'B', 32)
-    pdf.cell(0, 15, name, ln=1, align='C')
-    pdf.ln(8)
-
-    # подзаголовок
-    pdf.set_text_color(0, 0, 0)
-    pdf.set_font('DejaVu', '', 24)
-    pdf.cell(0, 12, CERT_TEXT[lang]['subsubtitle'], ln=1, align='C')
-    pdf.ln(8)
-
-    # дата прохождения
-    pdf.set_text_color(0, 0, 0)
-    pdf.set_font('DejaVu', '', 18)
-    pdf.cell(
-        0, 10,
-        f"{CERT_TEXT[lang]['date_label']} {date_str}",
-        ln=1, align='C'
-    )
-    pdf.ln(8)
-
-    # футер
-    pdf.set_text_color(245, 245, 220)
-    pdf.set_font('DejaVu', '', 18)
-    pdf.multi_cell(0, 10, CERT_TEXT[lang]['footer'], align='C')
-    pdf.ln(10)
-
-    pdf.output(output_path)
-    return output_path
 
 
 async def name_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Обработка имени для сертификата.
     """
-    if not context.user_data.get('awaiting_name'):
+    uid = str(update.message.from_user.id)
+    user = edit_user(uid)
+    if user.awaiting != 'name':
         return False  # <--- ВАЖНО: False, чтобы другие хендлеры могли обработать сообщение
 
-    lang = context.user_data.get('lang', 'ru')
+    lang = user.lang
     name = update.message.text.strip()
-    uid = str(update.message.from_user.id)
 
-    context.user_data['awaiting_name'] = False
+    user.awaiting = None
 
     # Берём сохранённую дату или используем текущую
-    date_str = progress.get(uid, {}).get('completion_date') \
-               or date.today().strftime('%d.%m.%Y')
+    date_str = user.completion_date or date.today().strftime('%d.%m.%Y')
+    # Шаблоны сертификата есть не для всех языков — идём по цепочке запасных
+    cert_lang = next((code for code in COURSE.chains.get(lang, ()) if code in CERT_TEXT), 'en')
 
     try:
-        output_path = generate_certificate_fpdf(
-            name, lang, date_str,
-            output_path=f"certificate_{uid}.pdf"
-        )
-        with open(output_path, 'rb') as f:
-            await update.message.reply_document(
-                document=f,
+        caption = f"🎓 {t('cert', lang)} — {name}"
+        cache_key = (name, cert_lang, date_str)
+        cached = cert_cache.get(cache_key)
+        sent = False
+
+        # Такой сертификат уже отправляли — хватит file_id
+        if cached and cached['file_id']:
+            try:
+                await reply_document(update.message, document=cached['file_id'], caption=caption)
+                sent = True
+                certs_sent.inc('file_id')
+            except BadRequest:
+                logger.warning("Устаревший file_id сертификата, загружаем заново")
+                cert_cache.forget_file_id(cache_key)
+
+        if not sent:
+            if cached and cached['data']:
+                pdf_bytes = cached['data']
+                certs_sent.inc('memory')
+            else:
+                # Пул занят — предупреждаем, что сертификат в очереди
+                if cert_renderer.is_full():
+                    await reply(update.message, CERT_BUSY_TEXT.get(lang, CERT_BUSY_TEXT['ru']))
+
+                with cert_seconds.time():
+                    pdf_bytes = await cert_renderer.render(name, cert_lang, date_str)
+                certs_sent.inc('rendered')
+                if cert_archive:
+                    try:
+                        await asyncio.to_thread(cert_archive.store, uid, pdf_bytes)
+                    except OSError:
+                        logger.exception("Не удалось сохранить сертификат в архив")
+
+            msg = await reply_document(update.message,
+                document=pdf_bytes,
                 filename=f"certificate_{name}.pdf",
-                caption=f"🎓 {t('cert', lang)} — {name}"
+                caption=caption
             )
+            cert_cache.put(cache_key, data=pdf_bytes,
+                           file_id=msg.document.file_id if msg.document else None)
         
         # --- Затем отправляем кнопку "🏠 Главное меню"
         kb = [
             [InlineKeyboardButton(t('back_main', lang), callback_data='back_main')]
         ]
-        await update.message.reply_text(
+        await reply(update.message,
             text="✅ " + t('cert_ready', lang),  # Можно красивый текст типа "Сертификат готов!"
             reply_markup=InlineKeyboardMarkup(kb)
         )
 
     except Exception:
         logger.exception("Ошибка отправки сертификата")
-        await update.message.reply_text("❗ Сертификат сгенерирован, но не удалось отправить его.")
+        await reply(update.message, "❗ Сертификат сгенерирован, но не удалось отправить его.")
 
     return True  # <--- ВАЖНО: True, чтобы остановить дальнейшую обработку
 
 
-    # -- НЕ УДАЛЯЕМ файл, он останется на диске для дальнейшего использования --
-    # try:
-    #     os.remove(cert_path)
-    # except OSError:
-    #     pass
-
-
 # --- Handlers ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Стартовое сообщение с выбором языка."""
     # Сохраняем аргумент команды (например, 'final_ru')
     if context.args:
-        context.user_data['start_param'] = context.args[0]
+        edit_user(str(update.effective_user.id)).start_param = context.args[0]
 
-    kb = [[
-        InlineKeyboardButton('🇷🇺 Русский', callback_data='lang:ru'),
-        InlineKeyboardButton('🇬🇧 English', callback_data='lang:en')
-    ]]
     prompt = "<b>Пожалуйста, выберите язык | Please choose your language:</b>"
-    await update.message.reply_text(
+    await reply(update.message,
         prompt,
-        reply_markup=InlineKeyboardMarkup(kb),
+        reply_markup=keyboards.language_menu(),
         parse_mode='HTML'
     )
 
 
 async def finaltest_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.effective_user.id)
-    lang = context.user_data.get('lang', 'ru')
-
-    # Если язык ещё не выбран, задаём по умолчанию
-    if not lang:
-        lang = 'ru'
-        context.user_data['lang'] = lang
 
     # Обнуляем финальный тест
-    user_final[uid] = {'q': 0, 'score': 0}
+    edit_user(uid).start_final()
     await send_final_question(update, context)
 
-async def lang_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def lang_chosen(update: Update, context: ContextTypes.DEFAULT_TYPE, chosen: str):
     query = update.callback_query
-    await query.answer()
     uid = str(query.from_user.id)
-    chosen = query.data.split(':', 1)[1]
-    context.user_data['lang'] = chosen
+    user = edit_user(uid)
+    user.lang = chosen
 
     # Обновим прогресс
-    progress.setdefault(uid, {'step': 1, 'final_passed': False})
-    save_progress()
+    save_progress(uid)
 
-    welcome = COURSE['texts']['welcome'][chosen]
-    overview = COURSE['texts']['overview'][chosen]
+    welcome = t('welcome', chosen)
+    overview = t('overview', chosen)
 
     # Проверим, передавался ли start_param
-    start_param = context.user_data.pop('start_param', None)
+    start_param, user.start_param = user.start_param, None
 
     # Стартовое сообщение
-    await query.message.reply_text(
+    await reply(query.message,
         f"{welcome}\n\n{overview}",
         parse_mode='HTML'
     )
 
     # И если был deep-linking
     if start_param and start_param.startswith('final'):
-        user_final[uid] = {'q': 0, 'score': 0}
+        user.start_final()
         return await send_final_question(update, context)
 
     # Иначе — главное меню
-    return await query.message.reply_text(
+    return await reply(query.message,
         t('main_menu_title', chosen),
         reply_markup=build_main_menu(uid, chosen)
     )
 
 def get_user_language(uid: str) -> str:
-    # если вы храните языки в user_data, можно сделать так:
-    return user_data.get(uid, {}).get('lang', 'ru')
+    return get_user(uid).lang
 
 def build_main_menu(uid: int, lang: str) -> InlineKeyboardMarkup:
-    st = progress.get(str(uid), {})
-    final_passed = st.get('final_passed', False)
-    kb = []
+    return keyboards.main_menu(lang, has_passed_final(str(uid)))
 
-    # 📋 Показать шаги
-    kb.append([
-        InlineKeyboardButton(
-            t('menu_show_course', lang),
-            callback_data='menu_show_course'
-        )
-    ])
+async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()  # единственный ответ на нажатие — обработчики его не повторяют
+    data = query.data
 
-    # 🌟 Финальный тест
-    kb.append([
-        InlineKeyboardButton(
-            t('menu_final', lang),
-            callback_data='menu_final'
-        )
-    ])
-    
-    # 🎓 Сертификат # 💖 Поддержка и 📚 Бонусы — только после финального теста
-    if final_passed:
-        kb.append([
-            InlineKeyboardButton(t('menu_certificate', lang), callback_data='menu_certificate')
-        ])
-        kb.append([
-            InlineKeyboardButton(t('menu_bonus', lang), callback_data='menu_bonus')
-        ])
-        
-        kb.append([
-        InlineKeyboardButton(t('menu_support', lang), callback_data='menu_support')
-        ])
+    try:
+        if not await router.dispatch(update, context, around=route_scope):
+            # во всех остальных случаях
+            await reply(query.message, t('unknown', get_user(str(query.from_user.id)).lang))
 
-    # ✉ Обратная связь
-    kb.append([
-        InlineKeyboardButton(t('menu_feedback', lang), callback_data='menu_feedback')
-    ])
+    except Exception:
+        logger.exception("Error in button_handler for data=%s", data)
+        await reply(query.message, "❗ Произошла ошибка, смотрите логи.")
 
-    # ❓ Задать вопрос
-    kb.append([
-        InlineKeyboardButton(t('menu_ask', lang), callback_data='menu_ask')
-    ])
 
-    return InlineKeyboardMarkup(kb)
+def _back_main_kb(lang: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton(t('back_main', lang), callback_data='back_main')]])
 
-async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# 5) Вход в финальный тест
+async def menu_final(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    edit_user(str(update.callback_query.from_user.id)).start_final()
+    return await send_final_question(update, context)
+
+# 7) Запрос имени для сертификата
+# --- Получить сертификат
+async def menu_certificate(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    data = query.data
-    uid  = str(query.from_user.id)
-    lang = context.user_data.get('lang', 'ru')
+    uid = str(query.from_user.id)
+    lang = get_user(uid).lang
+    if not has_passed_final(uid):
+        await reply(query.message, t('certificate_locked', lang), reply_markup=_back_main_kb(lang))
+        return
 
-    try:
-        # 0) Начать курс (новый пользователь: step == 0)
-        if data == 'menu_start_course':
-            return await show_course(update, context)
-        
-        # 1) Смена языка
-        if data.startswith('lang:'):
-            return await lang_chosen(update, context)
+    # Запросить имя для сертификата
+    text = t('certificate_message', lang)
+    kb = [
+        [InlineKeyboardButton(t('enter_name_button', lang), callback_data='enter_name')],
+        [InlineKeyboardButton(t('back_main',       lang), callback_data='back_main')]
+    ]
+    await reply(query.message, text, reply_markup=InlineKeyboardMarkup(kb), parse_mode='HTML')
 
-        # 2) 📋 Посмотреть шаги
-        if data == 'menu_show_course':
-            return await show_course(update, context)
-        
-        if data == 'show_course':  
-            return await show_course(update, context)
-        
-        # 3) Выбор шага
-        if data.startswith('select_step:'):
-            return await select_step(update, context)
+async def enter_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user = edit_user(str(query.from_user.id))
+    # Устанавливаем флаг, что теперь ждём имя
+    user.awaiting = 'name'
+    await reply(query.message, t('enter_name_prompt', user.lang))
 
-        # 4) Мини-тест внутри шага
-        if data.startswith('test_step:'):
-            return await take_test(update, context)
+# 8) Бонусы
+async def menu_bonus(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    lang = get_user(str(query.from_user.id)).lang
+    url = COURSE.bonus_links[COURSE.lid(lang)]
+    bonus_message = t('bonus_title', lang) + "\n\n" + t('bonus_text', lang)
 
-        # 5) Вход в финальный тест
-        if data == 'menu_final':
-            user_final[uid] = {'q': 0, 'score': 0}
-            return await send_final_question(update, context)
+    kb = [
+        [InlineKeyboardButton(t('btn_bonus', lang), url=url)],
+        [InlineKeyboardButton(t('back_main', lang), callback_data='back_main')]
+    ]
+    await reply(query.message,
+        bonus_message,
+        reply_markup=InlineKeyboardMarkup(kb),
+        disable_web_page_preview=False
+    )
 
-        # 6) Ответ на финальный тест
-        if data.startswith('test_final:'):
-            return await handle_final_answer(update, context)
-
-
-        # 7) Запрос имени для сертификата
-        # --- Получить сертификат
-        if data == 'menu_certificate':
-            if not user_final_passed.get(uid):
-                await query.message.reply_text(
-                    t('certificate_locked', lang),
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(t('back_main', lang), callback_data='back_main')]])
-                )
-                return
-            
-            # Запросить имя для сертификата
-            text = COURSE['texts']['certificate_message'][lang]
-            kb = [
-                [InlineKeyboardButton(t('enter_name_button', lang), callback_data='enter_name')],
-                [InlineKeyboardButton(t('back_main',       lang), callback_data='back_main')]
-            ]
-            await query.message.reply_text(text, reply_markup=InlineKeyboardMarkup(kb), parse_mode='HTML')
-            return
-
-        if data == 'enter_name':
-            # Устанавливаем флаг, что теперь ждём имя
-            context.user_data['awaiting_name'] = True
-            await query.message.reply_text(
-                t('enter_name_prompt', lang)
-            )
-            return
- 
-        # 8) Бонусы
-        if data == 'menu_bonus':
-            url = COURSE['bonus']['links'][lang]
-            bonus_message = COURSE['texts']['bonus_title'][lang] + "\n\n" + COURSE['texts']['bonus_text'][lang]
-
-            kb = [
-                [InlineKeyboardButton(COURSE['texts']['btn_bonus'][lang], url=url)],
-                [InlineKeyboardButton(t('back_main', lang), callback_data='back_main')]
-            ]
-            await query.message.reply_text(
-                bonus_message,
-                reply_markup=InlineKeyboardMarkup(kb),
-                disable_web_page_preview=False
-            )
-            return
-
-        # 9) Поддержать курс
-        if data == 'menu_support':
-            if not user_final_passed.get(uid):
-                await query.message.reply_text(
-                    t('bonus_locked', lang),
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(t('back_main', lang), callback_data='back_main')]])
-                )
-                return
-                 
-            url = COURSE['texts']['support_link']
-            support_message = COURSE['support_text'][lang]
-
-            kb = [
-                [InlineKeyboardButton(COURSE['btn_support'][lang], url=url)],
-                [InlineKeyboardButton(t('back_main', lang), callback_data='back_main')]
-            ]
+# 9) Поддержать курс
+async def menu_support(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    uid = str(query.from_user.id)
+    lang = get_user(uid).lang
+    if not has_passed_final(uid):
+        await reply(query.message, t('bonus_locked', lang), reply_markup=_back_main_kb(lang))
+        return
 
-            await query.message.reply_text(
-                support_message,
-                reply_markup=InlineKeyboardMarkup(kb),
-                disable_web_page_preview=False
-            )
-            return
-
-        # 10) Обратная связь
-        if data == 'menu_feedback':
-            url = COURSE['support_form_link'][lang]
-            feedback_message = COURSE['texts'].get('feedback_message', {}).get(lang)
-            
-            kb = [
-                [InlineKeyboardButton(COURSE['texts']['btn_feedback'][lang], url=url)],
-                [InlineKeyboardButton(t('back_main', lang), callback_data='back_main')]
-            ]
+    lid = COURSE.lid(lang)
+    url = COURSE.support_link
+    support_message = COURSE.support_text[lid]
 
-            await query.message.reply_text(
-                feedback_message,
-                reply_markup=InlineKeyboardMarkup(kb),
-                disable_web_page_preview=False
-            )
-            return
-
-
-        # 11) Задать вопрос
-        if data == 'menu_ask':
-            # переключаем бота в режим ожидания текста
-            context.user_data['awaiting_question'] = True
-            await query.message.reply_text(
-                COURSE['ask_prompt'][lang],
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton(t('cancel_question', lang), callback_data='cancel_question')]
-                ])
-            )
-            logger.info("button_handler got callback_data=%s, awaiting_question now=%s",
-                        data,
-                        context.user_data.get('awaiting_question'))
-            return
-
-        # 12) Назад в главное меню
-        if data == 'back_main':
-            return await query.message.reply_text(
-                t('main_menu_title', lang),
-                reply_markup=build_main_menu(uid, lang)
-            )
-        if data == 'cancel_final':
-            user_final.pop(uid, None)
-            return await query.message.reply_text(
-                t('cancelled', lang),
-                reply_markup=build_main_menu(uid, lang)
-            )
+    kb = [
+        [InlineKeyboardButton(COURSE.btn_support[lid], url=url)],
+        [InlineKeyboardButton(t('back_main', lang), callback_data='back_main')]
+    ]
 
-        if data == 'cancel_question':
-            context.user_data['awaiting_question'] = False
-            await query.message.reply_text(
-                t('cancelled_question', lang),
-                reply_markup=build_main_menu(uid, lang)
-            )
-            return
+    await reply(query.message,
+        support_message,
+        reply_markup=InlineKeyboardMarkup(kb),
+        disable_web_page_preview=False
+    )
 
-        # во всех остальных случаях
-        await query.message.reply_text(t('unknown', lang))
+# 10) Обратная связь
+async def menu_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    lang = get_user(str(query.from_user.id)).lang
+    url = COURSE.support_form_link[COURSE.lid(lang)]
+    feedback_message = t('feedback_message', lang)
 
-    except Exception:
-        logger.exception("Error in button_handler for data=%s", data)
-        await query.message.reply_text("❗ Произошла ошибка, смотрите логи.")
+    kb = [
+        [InlineKeyboardButton(t('btn_feedback', lang), url=url)],
+        [InlineKeyboardButton(t('back_main', lang), callback_data='back_main')]
+    ]
+
+    await reply(query.message,
+        feedback_message,
+        reply_markup=InlineKeyboardMarkup(kb),
+        disable_web_page_preview=False
+    )
+
+# 11) Задать вопрос
+async def menu_ask(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user = edit_user(str(query.from_user.id))
+    # переключаем бота в режим ожидания текста
+    user.awaiting = 'question'
+    await reply(query.message,
+        COURSE.ask_prompt[COURSE.lid(user.lang)],
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton(t('cancel_question', user.lang), callback_data='cancel_question')]
+        ])
+    )
+
+# 12) Назад в главное меню
+async def back_main(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    uid = str(query.from_user.id)
+    lang = get_user(uid).lang
+    return await reply(query.message,
+        t('main_menu_title', lang),
+        reply_markup=build_main_menu(uid, lang)
+    )
+
+async def cancel_final(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    uid = str(query.from_user.id)
+    user = edit_user(uid)
+    user.final_q = None
+    return await reply(query.message,
+        t('cancelled', user.lang),
+        reply_markup=build_main_menu(uid, user.lang)
+    )
+
+async def cancel_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    uid = str(query.from_user.id)
+    user = edit_user(uid)
+    user.awaiting = None
+    await reply(query.message,
+        t('cancelled_question', user.lang),
+        reply_markup=build_main_menu(uid, user.lang)
+    )
         
 
 # --- Обработчик текстовых сообщений ---
 async def question_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.message.from_user.id)
-    lang = context.user_data.get('lang', 'ru')
+    user = get_user(uid)
+    lang = user.lang
     
     # 1) Имя для сертификата?
-    if await name_handler(update, context):
-        # name_handler сбросил awaiting_name и выслал документ
+    if user.awaiting == 'name':
+        # name_handler сбросит awaiting и вышлет документ
+        # (его время уже входит в question_handler)
+        await name_handler(update, context)
         return
 
     # 2) Ждём вопрос?
-    if context.user_data.get('awaiting_question'):
+    if user.awaiting == 'question':
         question = update.message.text.strip()
         username = update.message.from_user.username or "без_username"
 
-        await context.bot.send_message(
-            chat_id=ADMIN_CHAT_ID,
-            text=f"❓ Новый вопрос от @{username} ({uid}):\n\n{question}"
-        )
+        # сохраняем вопрос, админам он уйдёт в ближайшем дайджесте
+        await admin_outbox.add(uid, username, question)
         # отвечаем пользователю
-        await update.message.reply_text(
+        await reply(update.message,
             t('ask_sent', lang),
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton(t('btn_back_main', lang), callback_data='back_main')]
             ])
         )
         # сбросим флаг и выйдем
-        context.user_data['awaiting_question'] = False
+        user.awaiting = None
         return
 
     # 3) Всё прочее → «неизвестная команда»
-    await update.message.reply_text(
+    await reply(update.message,
         t('unknown', lang),
         reply_markup=InlineKeyboardMarkup([
             [InlineKeyboardButton(t('btn_back_main', lang), callback_data='back_main')]
@@ -553,133 +754,74 @@ async def question_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     
 def build_course_menu(uid: str, lang: str) -> InlineKeyboardMarkup:
-    kb = []
-
-    for idx, step in enumerate(COURSE['steps'], start=1):
-        title = step['title'][lang] if isinstance(step['title'], dict) else step['title']
-        cb = f"select_step:{idx}"
-        label = f"{title}"
-        kb.append([InlineKeyboardButton(label, callback_data=cb)])
-
-    # «Назад в главное меню»
-    kb.append([InlineKeyboardButton(t('back_main', lang), callback_data='back_main')])
-    # «Задать вопрос»
-    kb.append([InlineKeyboardButton(t('menu_ask', lang), callback_data='menu_ask')])
-
-    return InlineKeyboardMarkup(kb)
+    return keyboards.course_list(lang, ask=True)
 
 
 async def show_course(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
 
-    lang    = context.user_data.get('lang', 'ru')
+    lang    = get_user(str(query.from_user.id)).lang
 
-    kb = []
-    for idx, step in enumerate(COURSE['steps'], start=1):
-        title = step['title'][lang] if isinstance(step['title'], dict) else step['title']
-        label = f"{title}"
-        cb = f"select_step:{idx}"
-        kb.append([InlineKeyboardButton(label, callback_data=cb)])
-
-    kb.append([ InlineKeyboardButton(t('back_main', lang), callback_data='back_main') ])
-
-    await query.message.reply_text(
+    await reply(query.message,
         t('course_list', lang),
-        reply_markup=InlineKeyboardMarkup(kb)
+        reply_markup=keyboards.course_list(lang)
     )
 
 
 # Select and display a step
-async def select_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def select_step(update: Update, context: ContextTypes.DEFAULT_TYPE, sid: int):
     query = update.callback_query
-    await query.answer() # всегда отвечаем на клик
-
-    lang = context.user_data.get('lang', 'ru')
-    _, sid_str = query.data.split(':')
-    sid = int(sid_str)
-
-    step = COURSE['steps'][sid-1]
-    title = step['title'][lang] if isinstance(step['title'], dict) else step['title']
-    prog  = t('progress', lang).format(step=sid, total=len(COURSE['steps']))
-    header = step.get('header', {}).get(lang, '')
-    body   = step.get('body', {}).get(lang, step.get('text', ''))
-
-    text = (
-        f"<b>{title}</b>\n"
-        f"<i>{prog}</i>\n\n"
-        f"<b>{header}</b>\n\n"
-        f"{body}"
-    )
-
-    # Если последний шаг — предлагаем финальный тест
-    kb = []
-    if sid == len(COURSE['steps']):
-        kb.append([
-            InlineKeyboardButton(t('menu_final', lang), callback_data='menu_final')
-        ])
-    else:
-        kb.append([
-            InlineKeyboardButton(t('start_test', lang), callback_data=f"test_step:{sid}:start")
-        ])
 
-    kb.append([
-        InlineKeyboardButton(t('back_steps', lang), callback_data="show_course")
-    ])
+    lang = get_user(str(query.from_user.id)).lang
+    page = pages.step(sid, lang)
 
-    await query.message.reply_text(
-        text,
-        parse_mode='HTML',
-        reply_markup=InlineKeyboardMarkup(kb)
+    await reply(query.message,
+        page.text,
+        parse_mode=page.parse_mode,
+        reply_markup=page.reply_markup
     )
 
 
 # Handle mini-test
-async def take_test(update, context):
-    query = update.callback_query; await query.answer()
-    lang = context.user_data.get('lang','ru')
-    _, sid, action = query.data.split(':')
-    sid = int(sid)
-    test = COURSE['steps'][sid-1]['test']
-    if action == 'start':
-        kb = [[InlineKeyboardButton(opt, callback_data=f'test_step:{sid}:{i}')] for i,opt in enumerate(test['options'][lang],1)]
-        return await query.message.reply_text(test['question'][lang], reply_markup=InlineKeyboardMarkup(kb))
-    choice = int(action)
-    correct = test['correct'][lang] + 1
+async def take_test(update, context, sid: int, action: int | str):
+    query = update.callback_query
     uid = str(query.from_user.id)
-    if choice == correct:
-        progress[uid]['step'] = sid+1
-        save_progress()
-        return await query.message.reply_text(t('correct', lang), reply_markup=build_main_menu(uid, lang))
-    kb = [[InlineKeyboardButton(t('retry', lang), callback_data=f'test_step:{sid}:start')]]
-    await query.message.reply_text(t('incorrect', lang), reply_markup=InlineKeyboardMarkup(kb))
+    user = edit_user(uid)
+    lang = user.lang
+    if action == 'start':
+        page = pages.test(sid, lang)
+        return await reply(query.message, page.text, reply_markup=page.reply_markup)
+    if action == pages.test_answer(sid, lang):
+        user.step = sid+1
+        save_progress(uid)
+        return await reply(query.message, t('correct', lang), reply_markup=build_main_menu(uid, lang))
+    await reply(query.message, t('incorrect', lang), reply_markup=pages.test_retry(sid, lang))
 
 # отправить вопрос финального теста
 async def send_final_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
 
-    uid = str(query.from_user.id)
-    lang = context.user_data.get('lang', 'ru')
-    state = user_final.get(uid)
+    user = get_user(str(query.from_user.id))
+    lang = user.lang
 
-    if not state:
-        return await query.message.reply_text(t('unknown', lang))
+    if not user.final_active(FINAL_SESSION_TTL):
+        return await reply(query.message, t('unknown', lang))
 
-    q_idx = state['q']
-    questions = COURSE['final_test']['questions']
+    q_idx = user.final_q
+    questions = COURSE.final_questions
     total_q = len(questions)
 
     if q_idx >= total_q:
         return await final_test_result(update, context)
 
+    lid = COURSE.lid(lang)
     question = questions[q_idx]
-    question_text = question['question'][lang]
-    opts = question['options'][lang]
+    question_text = question.question[lid]
+    opts = question.options[lid]
 
     # Кнопки ответов
     kb = [
-        [InlineKeyboardButton(opt, callback_data=f"test_final:{q_idx}:{i}")]
+        [InlineKeyboardButton(opt, callback_data=pack('test_final', q_idx, i))]
         for i, opt in enumerate(opts)
     ]
 
@@ -688,44 +830,46 @@ async def send_final_question(update: Update, context: ContextTypes.DEFAULT_TYPE
         InlineKeyboardButton(t('cancel_test', lang), callback_data='cancel_final')
     ])
 
-    await query.message.reply_text(
-        text=f"❓ {t('test_progress', lang).format(current=q_idx+1, total=total_q)}\n\n{question_text}",
+    await reply(query.message,
+        text=f"❓ {tf('test_progress', lang, current=q_idx+1, total=total_q)}\n\n{question_text}",
         reply_markup=InlineKeyboardMarkup(kb)
     )
 
 # обработать ответ на финальный тест
-async def handle_final_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def handle_final_answer(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                              q_idx: int, choice: int):
     query = update.callback_query
-    await query.answer()
 
     uid = str(query.from_user.id)
-    lang = context.user_data.get('lang', 'ru')
-    data = query.data
-
-    # Разобрать данные
-    _, q_idx_str, choice_str = data.split(':')
-    q_idx = int(q_idx_str)
-    choice = int(choice_str)
+    user = edit_user(uid)
+    lang = user.lang
 
-    questions = COURSE['final_test']['questions']
-    correct_idx = questions[q_idx]['correct'][lang]
+    questions = COURSE.final_questions
     total_q = len(questions)
 
+    # Сессия теста истекла (брошен надолго) или курс перезагружен
+    # с другими вопросами — предлагаем начать заново
+    if not user.final_active(FINAL_SESSION_TTL) or q_idx >= total_q:
+        return await reply(query.message,
+            t('unknown', lang),
+            reply_markup=build_main_menu(uid, lang)
+        )
+
         # Показываем ответ
-    if choice == correct_idx:
-        user_final[uid]['score'] += 1
-        user_final[uid]['q'] += 1  # <-- только если правильный ответ
+    if choice == questions[q_idx].correct[COURSE.lid(lang)]:
+        user.final_score += 1
+        user.final_q += 1  # <-- только если правильный ответ
         
-        await query.message.reply_text(t('final_correct', lang))
+        await reply(query.message, t('final_correct', lang))
 
-        if user_final[uid]['q'] < total_q:
+        if user.final_q < total_q:
             return await send_final_question(update, context)
         else:
             return await final_test_result(update, context)
 
     else:
         # Неправильный ответ — остаёмся на этом же вопросе
-        await query.message.reply_text(t('incorrect', lang))
+        await reply(query.message, t('incorrect', lang))
         return await send_final_question(update, context)  # повтор того же вопроса
 
 
@@ -733,28 +877,32 @@ async def handle_final_answer(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def final_test_result(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     uid = str(query.from_user.id)
-    lang = context.user_data.get('lang', 'ru')
-
-    score = user_final[uid]['score']
-    total_q = len(COURSE['final_test']['questions'])
+    user = edit_user(uid)
+    lang = user.lang
 
-    user_final.pop(uid, None)  # очищаем состояние пользователя
+    # очищаем состояние теста
+    score = user.final_score if user.final_q is not None else 0
+    user.final_q = None
+    total_q = len(COURSE.final_questions)
 
     if score == total_q:
-        # Прошёл тест успешно
-        user_final_passed[uid] = True
+        # Прошёл тест успешно — сохраняем, чтобы доступ к сертификату пережил рестарт
+        user.final_passed = True
+        if not user.completion_date:
+            user.completion_date = date.today().strftime('%d.%m.%Y')
+        save_progress(uid)
 
         # Кнопки: Бонусы + Сертификат + Поддержка
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton(t('menu_bonus', lang), callback_data="menu_bonus")],
             [InlineKeyboardButton(t('menu_certificate', lang), callback_data="menu_certificate")],
-            [InlineKeyboardButton(t('menu_support', lang), url=COURSE['texts']['support_link'])],
+            [InlineKeyboardButton(t('menu_support', lang), url=COURSE.support_link)],
             [InlineKeyboardButton(t('back_main', lang), callback_data='back_main')]
         ])
 
-        final_message = COURSE['texts']['final_message'][lang]
+        final_message = t('final_message', lang)
 
-        await query.message.reply_text(
+        await reply(query.message,
             text=final_message,
             reply_markup=kb,
             parse_mode='HTML'
@@ -771,44 +919,17 @@ async def final_test_result(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ]
         ])
 
-        await query.message.reply_text(
-            text=f"😔 {t('final_failed', lang)}\n\n{t('test_progress', lang).format(current=score, total=total_q)}",
+        await reply(query.message,
+            text=f"😔 {t('final_failed', lang)}\n\n{tf('test_progress', lang, current=score, total=total_q)}",
             reply_markup=kb
         ) 
     
-async def back_to_course(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка кнопки Назад к списку шагов."""
-    query = update.callback_query
-    await query.answer()
-
-    lang = context.user_data.get('lang', 'ru')
-    uid = str(query.from_user.id)
-    current = progress.get(uid, {}).get('step', 1)
-
-    # Сформировать список шагов заново
-    kb = []
-    for idx, step in enumerate(COURSE['steps'], 1):
-        title = step['title'][lang]
-        if idx < current:
-            label, cb = f"✓ {idx}. {title}", f'select_step:{idx}'
-        elif idx == current:
-            label, cb = f"▶ {idx}. {title}", f'select_step:{idx}'
-        else:
-            label, cb = f"🔒 {idx}. {title}", 'locked'
-        kb.append([InlineKeyboardButton(label, callback_data=cb)])
-    kb.append([InlineKeyboardButton(t('back_main', lang), callback_data='back_main')])
-
-    await query.message.reply_text(
-        text=t('course_list', lang),
-        reply_markup=InlineKeyboardMarkup(kb)
-    )
-
 async def locked_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    lang = context.user_data.get('lang', 'ru')
+    lang = get_user(str(query.from_user.id)).lang
 
     await query.answer(
-        text=COURSE['texts']['locked_step'][lang],
+        text=t('locked_step', lang),
         show_alert=True
     )
     return  # <<< ОБЯЗАТЕЛЬНО!
@@ -816,36 +937,323 @@ async def locked_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = str(update.message.from_user.id)
     lang = get_user_language(uid)
-    await update.message.reply_text(
+    await reply(update.message,
         t('help_brief', lang),
         reply_markup=build_main_menu(int(uid), lang)
     )
     
+async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/reload — перечитать курс без перезапуска (только для админов)."""
+    if update.effective_user.id not in ADMINS:
+        return
+    try:
+        elapsed = await reload_course()
+    except Exception as e:  # noqa: BLE001 — любой сбой: остаётся прежний курс
+        log_course_error(e)
+        problems = e.problems if isinstance(e, CourseError) else [str(e)]
+        text = "❗ Курс не загружен, работает прежняя версия:\n" + "\n".join(problems[:10])
+        if len(problems) > 10:
+            text += f"\n… и ещё {len(problems) - 10}"
+        await reply(update.message, text)
+        return
+    await reply(update.message,
+        f"✅ Курс перезагружен за {elapsed * 1000:.0f} мс: {len(COURSE.steps)} шагов, "
+        f"{len(COURSE.final_questions)} вопросов финального теста, языки: {', '.join(COURSE.langs)}"
+    )
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/stats — время обработчиков и вызовов Bot API, ошибки, память (только для админов)."""
+    if update.effective_user.id not in ADMINS:
+        return
+    uptime = int(time.perf_counter() - _started) // 60
+    where = f" (шард {SHARD})" if SHARD is not None else ""
+    flushes = summary_lines(flush_seconds)
+    if flushes:
+        flushes[0] += f", пользователей за раз p50 {flush_records.get().quantile(0.5):.0f}"
+    sections = [
+        (f"📈 Статистика{where} за {uptime // 60} ч {uptime % 60:02d} мин", []),
+        ("Обработчики:", summary_lines(handler_seconds, handler_errors)),
+        ("Кнопки:", summary_lines(route_seconds, route_errors)),
+        ("Bot API:", summary_lines(api_seconds, api_errors)),
+        ("Запись прогресса:", flushes),
+        ("Рендеринг сертификатов:", summary_lines(cert_seconds)),
+    ]
+    lines = []
+    for title, rows in sections:
+        if rows or not lines:
+            lines.append(title)
+            lines += [f"  {row}" for row in rows]
+    certs = ', '.join(f"{source} {n:.0f}" for (source,), n in sorted(certs_sent.values.items()))
+    if certs:
+        lines.append(f"Сертификаты: {certs}")
+    lines.append(f"Пользователей в памяти: {len(_progress_cache)}, ждут записи: {progress_writer.pending}, "
+                 f"исходящих в очереди: {sender.queue_depth()}")
+    await reply(update.message, '\n'.join(lines))
+
+PROFILE_USAGE = (
+    "/profile [cpu|sample] [30s|200] [обработчик или кнопка]\n"
+    "cpu — cProfile (точно, но медленно), sample — выборка стеков (по умолчанию); "
+    "30s — секунды, 200 — число апдейтов (по умолчанию 30s); без имени — всё подряд.\n"
+    "/profile stop — закончить досрочно"
+)
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/profile — профиль работающего бота файлом в чат (только для админов)."""
+    if update.effective_user.id not in ADMINS:
+        return
+    args = context.args or []
+    if args == ['stop']:
+        if profiler.session is None:
+            await reply(update.message, "Профилирование не запущено")
+        else:
+            profiler.session.stop()
+        return
+    try:
+        mode, seconds, updates, scope = parse_profile_args(args)
+        if scope is not None and scope not in handler_names | router.names():
+            raise ValueError(f"нет обработчика или кнопки {scope!r}")
+        session = profiler.start(mode, scope, seconds, updates)
+    except ValueError as e:
+        await reply(update.message, f"❗ {e}\n\n{PROFILE_USAGE}")
+        return
+    except RuntimeError:
+        await reply(update.message, "⏳ Профилирование уже идёт; /profile stop — закончить")
+        return
+    limit = f"{seconds:.0f} с" if seconds else f"{updates} апдейтов"
+    await reply(update.message, f"🔬 Профилирование {mode} ({scope or 'всё'}) на {limit}…")
+    task = asyncio.create_task(send_profile(context.bot, update.effective_chat.id, session))
+    _background_tasks.append(task)
+    task.add_done_callback(_background_tasks.remove)
+
+async def send_profile(bot, chat_id: int, session):
+    """Дожидается конца сессии и присылает профиль документом."""
+    await profiler.run(session)
+    prefix = 'profile' if SHARD is None else f'profile-shard{SHARD}'
+    try:
+        path, summary = await asyncio.to_thread(session.write, PROFILE_DIR, prefix)
+        with open(path, 'rb') as f:
+            data = f.read()
+        caption = (f"🔬 {session.mode}, {session.scope or 'всё'}: {session.elapsed:.0f} с, "
+                   f"апдейтов {session.calls}, профиль собирался {session.active_time:.1f} с\n{summary}")[:1024]
+        await sender.send(chat_id, lambda: bot.send_document(
+            chat_id=chat_id, document=data, filename=os.path.basename(path), caption=caption), ADMIN)
+    except Exception:
+        logger.exception("Не удалось отправить профиль")
+
 # --- Универсальный хендлер ошибок приложения ---
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
     logger.error("Unhandled exception", exc_info=context.error)
     
+# --- Маршруты callback-кнопок ---
+def course_lang(value: str) -> str:
+    if value not in keyboards.langs:
+        raise ValueError(value)
+    return value
+
+router = CallbackRouter()
+router.exact('menu_start_course', 'menu_show_course', 'show_course', handler=show_course)
+router.exact('menu_final', handler=menu_final)
+router.exact('menu_certificate', handler=menu_certificate)
+router.exact('enter_name', handler=enter_name)
+router.exact('menu_bonus', handler=menu_bonus)
+router.exact('menu_support', handler=menu_support)
+router.exact('menu_feedback', handler=menu_feedback)
+router.exact('menu_ask', handler=menu_ask)
+router.exact('back_main', handler=back_main)
+router.exact('cancel_final', handler=cancel_final)
+router.exact('cancel_question', handler=cancel_question)
+router.prefix('lang', lang_chosen, course_lang)
+router.prefix('select_step', select_step, int)
+router.prefix('test_step', take_test, int, step_action)
+router.prefix('test_final', handle_final_answer, int, int)
+
+# --- Фоновые задачи в event loop ---
+_background_tasks: list[asyncio.Task] = []
+
+def log_startup_times() -> None:
+    total = time.perf_counter() - _started
+    stages = ', '.join(f"{stage} {sec * 1000:.0f} ms" for stage, sec in startup_times.items())
+    logger.info(f"⏱ Startup: {stages}; total to polling {total * 1000:.0f} ms")
+
+async def serve_metrics(request) -> Response:
+    return Response(200, registry.render().encode(), 'text/plain; version=0.0.4; charset=utf-8')
+
+async def on_startup(app):
+    global metrics_server
+    log_startup_times()
+    progress_writer.start()
+    if METRICS_PORT:
+        metrics_server = HttpServer(METRICS_LISTEN, METRICS_PORT)
+        metrics_server.route('GET', METRICS_PATH, serve_metrics)
+        await metrics_server.start()
+    sender.start()
+    admin_outbox.start(lambda text: send_message(app.bot, ADMIN_CHAT_ID, text))
+    _background_tasks.append(asyncio.create_task(auto_save_loop()))
+    if COURSE_WATCH_INTERVAL:
+        _background_tasks.append(asyncio.create_task(course_watch_loop()))
+
+async def on_stop(app):
+    # досылаем очереди, пока клиент Bot API ещё открыт
+    await admin_outbox.stop()
+    await sender.stop()
+    logger.info("Outbound: %s, replies: %s, admin outbox: %s",
+                sender.metrics(), reply_metrics(reply_stats), admin_outbox.metrics())
+
+async def on_shutdown(app):
+    if metrics_server is not None:
+        await metrics_server.stop()
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    # всё, что ещё не записано, — в журнал
+    await progress_writer.stop()
+    logger.info("Progress writer: %s", progress_writer.metrics())
+
 # === Основной запуск ===
+def instrumented(callback):
+    """Обработчик с замером времени и ошибок в метриках и доступный для /profile."""
+    name = callback.__name__
+    handler_names.add(name)
+    return timed(handler_seconds, handler_errors, name, profiler.wrap(name, callback))
+
+def instrument_request(request) -> InstrumentedRequest:
+    """HTTP-клиент Bot API с замером каждого вызова (для своего ApplicationBuilder)."""
+    return InstrumentedRequest(request, api_seconds, api_errors)
+
+def build_application(builder: ApplicationBuilder | None = None):
+    """
+    Application со всеми обработчиками; builder — уже с токеном (по умолчанию
+    из config, с instrument_request(HTTPXRequest) для метрик Bot API).
+    """
+    if builder is None:
+        builder = ApplicationBuilder().token(TOKEN) \
+            .request(instrument_request(HTTPXRequest(connection_pool_size=256)))
+        if BOT_API_URL:
+            builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+    builder = builder \
+        .post_init(on_startup) \
+        .post_stop(on_stop) \
+        .post_shutdown(on_shutdown)
+    if update_processor:
+        builder.concurrent_updates(update_processor)
+    app = builder.build()
+    app.add_handler(CommandHandler("start", instrumented(start)))
+    app.add_handler(CommandHandler("finaltest", instrumented(finaltest_command)))
+    app.add_handler(CallbackQueryHandler(instrumented(locked_step), pattern="^locked$"))
+    app.add_handler(CallbackQueryHandler(instrumented(button_handler)), group=0)
+    app.add_handler(CommandHandler("help", instrumented(help_command)))
+    app.add_handler(CommandHandler("reload", instrumented(reload_command)))
+    app.add_handler(CommandHandler("stats", instrumented(stats_command)))
+    app.add_handler(CommandHandler("profile", instrumented(profile_command)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, instrumented(question_handler)), group=1)
+    app.add_error_handler(error_handler)
+    return app
+
+async def run_webhook(app, stop: asyncio.Event | None = None):
+    """
+    Жизненный цикл Application в режиме вебхука (аналог run_polling):
+    свой HTTP-сервер вместо Updater, остановка по SIGINT/SIGTERM или stop.
+    """
+    if stop is None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+    global webhook_ingest
+    ingest = webhook_ingest = WebhookIngest(app, WEBHOOK_SECRET, WEBHOOK_QUEUE_SIZE, WEBHOOK_BATCH)
+    server = HttpServer(WEBHOOK_LISTEN, WEBHOOK_PORT)
+    server.route('POST', WEBHOOK_PATH, ingest.handle)
+    watcher = None
+    if SHARD is not None:
+        server.route('GET', STATS_PATH, shard_stats)
+        watcher = asyncio.create_task(watch_parent(stop))
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                                  max_connections=WEBHOOK_MAX_CONNECTIONS,
+                                  allowed_updates=Update.ALL_TYPES)
+    await app.start()
+    ingest.start()
+    await server.start()
+    logger.info("Webhook mode: %s -> %s:%d%s", WEBHOOK_URL or "(set externally)",
+                WEBHOOK_LISTEN, server.port, WEBHOOK_PATH)
+    try:
+        await stop.wait()
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        await server.stop()
+        await ingest.stop()
+        logger.info("Webhook: %s", ingest.metrics())
+        await app.stop()
+        if app.post_stop:
+            await app.post_stop(app)
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+async def shard_stats(request) -> Response:
+    """Метрики воркера для /shards у фронта."""
+    stats = {
+        'shard': SHARD,
+        'pid': os.getpid(),
+        'users': len(_progress_cache),
+        'peak_rss_mb': peak_rss_mb(),
+        'ingest': webhook_ingest.metrics(),
+        'outbound_queued': sender.queue_depth(),
+    }
+    return Response(200, json.dumps(stats).encode(), 'application/json')
+
 def main():
+    if SHARD is None and (SHARDS > 1 or stored_count() is not None):
+        sys.exit("❌ Sharded setup (SHARDS > 1 or shards/map.json): start the bot with python shards.py, "
+                 "python shards.py --unshard merges the data back")
+    load_course()
     # 1) Загрузка кэша и старт фонового автосэйва
-    global progress
+    global progress, cert_archive
+    t0 = time.perf_counter()
     progress = load_progress()
-    threading.Thread(target=auto_save_loop, daemon=True).start()
+    admin_outbox.load()
+    startup_times['progress'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    cert_cache.load()
+    # Пул рендеринга сертификатов (шаблоны строятся в воркерах в фоне)
+    cert_renderer.start()
+    if CERT_ARCHIVE_DIR:
+        cert_archive = CertificateArchive(
+            CERT_ARCHIVE_DIR,
+            max_bytes=CERT_ARCHIVE_MAX_MB * 1024 * 1024,
+            max_age=CERT_ARCHIVE_MAX_DAYS * 86400
+        )
+        threading.Thread(
+            target=cert_archive.sweep_loop, args=(CERT_ARCHIVE_SWEEP_INTERVAL,), daemon=True
+        ).start()
+    startup_times['certificates'] = time.perf_counter() - t0
     
     # 2) Создаём и конфигурируем бот
-    app = ApplicationBuilder().token(TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("finaltest", finaltest_command))
-    app.add_handler(CallbackQueryHandler(locked_step, pattern="^locked$"))
-    app.add_handler(CallbackQueryHandler(button_handler), group=0)
-    app.add_handler(CommandHandler("help", help_command))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, question_handler), group=1)
-    app.add_error_handler(error_handler)
+    t0 = time.perf_counter()
+    app = build_application()
+    startup_times['app build'] = time.perf_counter() - t0
 
-
-    # 3) Запуск polling()
-    logger.info("Starting bot polling...")
-    app.run_polling()
+    # 3) Запуск: polling или вебхук
+    try:
+        if BOT_MODE == 'webhook':
+            asyncio.run(run_webhook(app))
+        else:
+            logger.info("Starting bot polling...")
+            app.run_polling()
+    finally:
+        # дожидаемся начатых сертификатов и гасим воркеры
+        cert_renderer.shutdown()
+        cert_cache.save()
+        compact_progress()
+        progress_store.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,540 @@
+import asyncio
+import base64
+import copy
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import TYPE_CHECKING
+
+# fpdf и fontTools тяжёлые (~0.3 с на импорт), а нужны только при рендеринге:
+# импортируются при первом сертификате — в воркере пула, не в боте при старте
+if TYPE_CHECKING:
+    from fpdf import FPDF
+
+# fontTools пишет по строке на каждую таблицу при сабсете шрифта
+logging.getLogger('fontTools').setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
+
+BASE_DIR  = os.path.dirname(__file__)
+ICON_PATH = os.path.join(BASE_DIR, 'assets', 'mic.png')
+FONTS_DIR = os.path.join(BASE_DIR, 'fonts')
+FONT_FILES = {'': 'DejaVuSans.ttf', 'B': 'DejaVuSans-Bold.ttf'}
+ICON_W    = 30  # ширина иконки в мм
+
+# Диапазоны Unicode, которые остаются в облегчённых шрифтах:
+# латиница, греческий, кириллица, пунктуация, валюты, буквоподобные символы
+FAST_RANGES = [
+    (0x0020, 0x024F), (0x0370, 0x03FF), (0x0400, 0x052F),
+    (0x2000, 0x206F), (0x20A0, 0x20CF), (0x2100, 0x214F),
+]
+
+# Тексты для сертификата
+CERT_TEXT = {
+    'ru': {
+        'title': "Сертификат о прохождении курса",
+        'subtitle': "Настоящим подтверждается, что",
+        'subsubtitle': "успешно прошёл(-а) мини-курс «Подкаст за 7 шагов»",
+        'footer': "Теперь вы не просто человек, а человек-голос.\nСлушайте себя. Говорите уверенно.",
+        'date_label': "Дата прохождения:"
+    },
+    'en': {
+        'title': "Certificate of Completion",
+        'subtitle': "This is to certify that",
+        'subsubtitle': "has successfully completed the mini-course Podcast in 7 Steps",
+        'footer': "Now you are not just a person, you are a voice.\nSpeak confidently and share your story!",
+        'date_label': "Date of completion:"
+    }
+}
+
+
+def _fast_font_path(filename: str) -> str:
+    """
+    Облегчённая копия шрифта (только FAST_RANGES) во временном каталоге.
+
+    fpdf2 сабсетит шрифт при каждом output(), и для полного DejaVu
+    (~6000 глифов) это большая часть времени рендеринга. Копия строится
+    один раз и переиспользуется всеми процессами до изменения исходника.
+    """
+    src = os.path.join(FONTS_DIR, filename)
+    st = os.stat(src)
+    path = os.path.join(
+        tempfile.gettempdir(),
+        f"cert-{st.st_size}-{int(st.st_mtime)}-{filename}"
+    )
+    if os.path.exists(path):
+        return path
+
+    from fontTools import subset, ttLib
+
+    font = ttLib.TTFont(src, recalcTimestamp=False)
+    options = subset.Options(
+        notdef_outline=True, recommended_glyphs=True, glyph_names=True,
+        name_IDs=['*'], layout_features=['*'], legacy_kern=True, drop_tables=['FFTM'],
+    )
+    subsetter = subset.Subsetter(options)
+    subsetter.populate(unicodes=[u for lo, hi in FAST_RANGES for u in range(lo, hi + 1)])
+    subsetter.subset(font)
+
+    # пишем во временный файл и переименовываем — воркеры могут строить одновременно
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.ttf')
+    with os.fdopen(fd, 'wb') as f:
+        font.save(f)
+    os.replace(tmp, path)
+    return path
+
+
+class CertificateTemplate:
+    """
+    Статическая часть сертификата для одного языка.
+
+    Шрифты, иконка, фон, рамка и все постоянные надписи рисуются один раз;
+    на каждый запрос шаблон копируется и дописываются только имя и дата.
+    При fast=True используются облегчённые шрифты (см. _fast_font_path).
+    """
+
+    def __init__(self, lang: str, fast: bool = True):
+        from fpdf import FPDF
+
+        self.lang = lang
+        texts = CERT_TEXT[lang]
+
+        pdf = FPDF('L', 'mm', 'A4')
+        pdf.set_auto_page_break(auto=False)
+        pdf.add_page()
+
+        # шрифты для кириллицы
+        for style, filename in FONT_FILES.items():
+            path = _fast_font_path(filename) if fast else os.path.join(FONTS_DIR, filename)
+            pdf.add_font('DejaVu', style, path)
+
+        # --- фон и рамка ---
+        pdf.set_fill_color(111, 78, 55)
+        pdf.rect(0, 0, pdf.w, pdf.h, 'F')
+        pdf.set_draw_color(245, 245, 220)
+        pdf.set_line_width(4)
+        pdf.rect(10, 10, pdf.w-20, pdf.h-20)
+
+        # --- PNG-иконка ---
+        image_y = pdf.h * 0.20
+        pdf.image(ICON_PATH, x=(pdf.w - ICON_W) / 2, y=image_y, w=ICON_W)
+
+        # текст ниже иконки + 5 мм отступ
+        pdf.set_y(image_y + ICON_W + 5)
+
+        # заголовок
+        pdf.set_font('DejaVu', 'B', 36)
+        pdf.set_text_color(245, 245, 220)
+        pdf.cell(0, 15, texts['title'], ln=1, align='C')
+
+        # подзаголовок
+        pdf.set_text_color(0, 0, 0)
+        pdf.set_font('DejaVu', '', 24)
+        pdf.cell(0, 12, texts['subtitle'], ln=1, align='C')
+        pdf.ln(5)
+
+        # место под имя: cell высотой 15 + отступ 8
+        self.name_y = pdf.get_y()
+        pdf.set_y(self.name_y + 15 + 8)
+
+        # подзаголовок
+        pdf.set_text_color(0, 0, 0)
+        pdf.set_font('DejaVu', '', 24)
+        pdf.cell(0, 12, texts['subsubtitle'], ln=1, align='C')
+        pdf.ln(8)
+
+        # место под дату: cell высотой 10 + отступ 8
+        self.date_y = pdf.get_y()
+        pdf.set_y(self.date_y + 10 + 8)
+
+        # футер
+        pdf.set_text_color(245, 245, 220)
+        pdf.set_font('DejaVu', '', 18)
+        pdf.multi_cell(0, 10, texts['footer'], align='C')
+
+        self._pdf = pdf
+        # Таблицы ширин и glyph id после загрузки шрифта только читаются,
+        # поэтому копии шаблона делят их с оригиналом, а не копируют заново.
+        self._shared = {}
+        self._font_data = {}
+        for key, font in pdf.fonts.items():
+            for table in (font.cw, font.glyph_ids):
+                self._shared[id(table)] = table
+            with open(font.ttffile, 'rb') as f:
+                self._font_data[key] = f.read()
+        self.charset = frozenset.intersection(
+            *(frozenset(font.cmap) for font in pdf.fonts.values())
+        )
+
+    def covers(self, text: str) -> bool:
+        """Все ли символы текста есть в шрифтах шаблона."""
+        return all(ord(ch) in self.charset for ch in text)
+
+    def render(self, name: str, date_str: str) -> 'FPDF':
+        """Копия шаблона с вписанными именем и датой."""
+        from fontTools import ttLib
+
+        pdf = copy.deepcopy(self._pdf, dict(self._shared))
+        # fpdf2 сабсетит TTFont на месте при output(), а deepcopy оставляет
+        # его общим с шаблоном — каждой копии нужен свой (лениво читаемый).
+        for key, font in pdf.fonts.items():
+            font.ttfont = ttLib.TTFont(
+                io.BytesIO(self._font_data[key]),
+                recalcTimestamp=False, lazy=True
+            )
+
+        # имя
+        pdf.set_y(self.name_y)
+        pdf.set_text_color(245, 245, 220)
+        pdf.set_font('DejaVu', 'B', 32)
+        pdf.cell(0, 15, name, ln=1, align='C')
+
+        # дата прохождения
+        pdf.set_y(self.date_y)
+        pdf.set_text_color(0, 0, 0)
+        pdf.set_font('DejaVu', '', 18)
+        pdf.cell(
+            0, 10,
+            f"{CERT_TEXT[self.lang]['date_label']} {date_str}",
+            ln=1, align='C'
+        )
+        return pdf
+
+
+_templates: dict[tuple[str, bool], CertificateTemplate] = {}
+_templates_lock = threading.Lock()
+
+
+def get_template(lang: str, fast: bool = True) -> CertificateTemplate:
+    """Шаблон для языка; строится при первом обращении."""
+    tpl = _templates.get((lang, fast))
+    if tpl is None:
+        with _templates_lock:
+            tpl = _templates.get((lang, fast))
+            if tpl is None:
+                tpl = _templates[lang, fast] = CertificateTemplate(lang, fast)
+    return tpl
+
+
+def warm_templates() -> None:
+    """Заранее строит быстрые шаблоны для всех языков (вызывается при старте)."""
+    for lang in CERT_TEXT:
+        get_template(lang)
+
+
+def _build_certificate(name: str, lang: str, date_str: str) -> 'FPDF':
+    tpl = get_template(lang)
+    if not tpl.covers(name + date_str):
+        # редкие алфавиты — полный шрифт, как раньше
+        tpl = get_template(lang, fast=False)
+    return tpl.render(name, date_str)
+
+
+def render_certificate_bytes(name: str, lang: str, date_str: str) -> bytes:
+    """Рендерит сертификат в память, без записи на диск."""
+    return bytes(_build_certificate(name, lang, date_str).output())
+
+
+def _log_warm_error(future) -> None:
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Не удалось подготовить шаблоны сертификатов", exc_info=future.exception())
+
+
+class CertificateRenderer:
+    """
+    Пул воркеров для рендеринга сертификатов вне event loop.
+
+    По умолчанию процессный (каждый воркер один раз строит свои шаблоны),
+    при mode='thread' или если процессы недоступны — потоковый.
+    Одновременно в пул передаётся не больше max_queue задач; остальные
+    ждут свободного слота в render().
+    """
+
+    def __init__(self, workers: int = 2, mode: str = 'process', max_queue: int = 8):
+        self.workers = max(1, workers)
+        self.mode = mode
+        self.max_queue = max(1, max_queue)
+        self._executor = None
+        self._slots = None
+        self._pending = 0
+
+    def _new_executor(self):
+        if self.mode == 'process':
+            try:
+                return ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=warm_templates,
+                )
+            except (OSError, ImportError, NotImplementedError):
+                logger.warning("Процессный пул недоступен, сертификаты рендерятся в потоках")
+        self.mode = 'thread'
+        return ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='cert')
+
+    def start(self) -> None:
+        self._executor = self._new_executor()
+        # прогрев в фоне: бот не ждёт импорта fpdf и сборки шаблонов
+        self._executor.submit(warm_templates).add_done_callback(_log_warm_error)
+        logger.info("Certificate renderer: %s pool, %d workers, queue %d",
+                    self.mode, self.workers, self.max_queue)
+
+    def _restart(self, broken) -> None:
+        """Воркер пула упал: пул больше не принимает задач — собираем новый."""
+        if self._executor is not broken:
+            return  # уже пересобран другой задачей
+        logger.error("Пул рендеринга сертификатов сломан, перезапускаю воркеры")
+        broken.shutdown(wait=False, cancel_futures=True)
+        self._executor = self._new_executor()
+
+    @property
+    def pending(self) -> int:
+        """Задачи, переданные в пул и ещё не завершённые."""
+        return self._pending
+
+    def is_full(self) -> bool:
+        """Все слоты заняты — новый запрос встанет в очередь."""
+        return self._pending >= self.max_queue
+
+    async def render(self, name: str, lang: str, date_str: str) -> bytes:
+        """Рендерит сертификат в пуле и возвращает байты PDF."""
+        if self._executor is None:
+            raise RuntimeError("CertificateRenderer is not started")
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_queue)
+
+        async with self._slots:
+            self._pending += 1
+            try:
+                loop = asyncio.get_running_loop()
+                for attempt in range(2):
+                    executor = self._executor
+                    try:
+                        return await loop.run_in_executor(
+                            executor, render_certificate_bytes,
+                            name, lang, date_str
+                        )
+                    except BrokenProcessPool:
+                        # один повтор в новом пуле; второй отказ — наружу
+                        if attempt or self._executor is None:
+                            raise
+                        self._restart(executor)
+            finally:
+                self._pending -= 1
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Дожидается текущих задач и останавливает воркеры."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=not wait)
+            self._executor = None
+
+
+class CertificateCache:
+    """
+    LRU-кэш готовых сертификатов по ключу (имя, язык, дата прохождения).
+
+    Для каждого ключа хранится file_id из Telegram (повторная отправка —
+    один короткий запрос без загрузки файла) и байты PDF. Не больше
+    max_entries записей; если байты в сумме превышают max_bytes, у самых
+    старых записей байты выбрасываются, а file_id остаётся.
+
+    На диске path — маленький индекс (ключ, file_id, имя файла PDF), а
+    сами PDF лежат отдельными файлами в папке рядом, имя — хэш содержимого.
+    save() дописывает только новые PDF и удаляет те, на которые индекс
+    больше не ссылается.
+    """
+
+    def __init__(self, path: str, max_entries: int = 1000, max_bytes: int = 16 * 1024 * 1024):
+        self.path = path
+        self.pdf_dir = os.path.splitext(path)[0] + '_pdf'
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[tuple, dict] = OrderedDict()
+        self._bytes = 0
+        self._dirty = False
+        self._stored: set[str] = set()  # PDF, уже лежащие в pdf_dir
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: tuple) -> dict | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: tuple, data: bytes | None = None, file_id: str | None = None) -> None:
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                entry = {'file_id': None, 'data': None, 'pdf': None}
+            else:
+                self._bytes -= len(entry['data'] or b'')
+            if data is not None:
+                entry['data'] = data
+                entry['pdf'] = None
+            if file_id is not None:
+                entry['file_id'] = file_id
+            self._entries[key] = entry
+            self._bytes += len(entry['data'] or b'')
+            self._evict()
+            self._dirty = True
+
+    def forget_file_id(self, key: tuple) -> None:
+        """file_id больше не принимается Telegram — при следующем запросе загрузим заново."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['file_id']:
+                entry['file_id'] = None
+                self._dirty = True
+
+    def _evict(self) -> None:
+        while len(self._entries) > self.max_entries:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= len(entry['data'] or b'')
+        for entry in self._entries.values():
+            if self._bytes <= self.max_bytes:
+                break
+            if entry['data']:
+                self._bytes -= len(entry['data'])
+                entry['data'] = entry['pdf'] = None
+
+    def _read_pdf(self, name: str) -> bytes | None:
+        try:
+            with open(os.path.join(self.pdf_dir, name), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def load(self) -> None:
+        """Загружает кэш с диска (порядок записей — от старых к новым)."""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                items = json.load(f)
+        except (OSError, ValueError):
+            logger.exception("Не удалось прочитать кэш сертификатов %s", self.path)
+            return
+        try:
+            stored = {name for name in os.listdir(self.pdf_dir) if name.endswith('.pdf')}
+        except FileNotFoundError:
+            stored = set()
+        with self._save_lock, self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._stored = stored
+            for item in items:
+                name = item.get('pdf')
+                data = self._read_pdf(name) if name in stored else None
+                if item.get('data'):
+                    # старый формат: PDF в base64 прямо в JSON — при сохранении разложим по файлам
+                    data, name = base64.b64decode(item['data']), None
+                    self._dirty = True
+                self._entries[tuple(item['key'])] = {
+                    'file_id': item.get('file_id'), 'data': data, 'pdf': name if data else None}
+                self._bytes += len(data or b'')
+            self._evict()
+        logger.info("Certificate cache: %d entries loaded", len(self._entries))
+
+    def save(self) -> None:
+        """Сохраняет индекс и новые PDF, если кэш менялся."""
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                items, new = [], {}
+                for key, entry in self._entries.items():
+                    if entry['data'] and entry['pdf'] is None:
+                        entry['pdf'] = hashlib.sha256(entry['data']).hexdigest()[:32] + '.pdf'
+                    if entry['pdf'] and entry['pdf'] not in self._stored:
+                        new[entry['pdf']] = entry['data']
+                    items.append({'key': list(key), 'file_id': entry['file_id'], 'pdf': entry['pdf']})
+                self._dirty = False
+            if new:
+                os.makedirs(self.pdf_dir, exist_ok=True)
+            for name, data in new.items():
+                path = os.path.join(self.pdf_dir, name)
+                with open(path + '.tmp', 'wb') as f:
+                    f.write(data)
+                os.replace(path + '.tmp', path)
+                self._stored.add(name)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(items, f, ensure_ascii=False)
+            os.replace(tmp, self.path)
+            # PDF вытесненных записей — уже после записи индекса
+            used = {item['pdf'] for item in items}
+            for name in self._stored - used:
+                try:
+                    os.remove(os.path.join(self.pdf_dir, name))
+                except FileNotFoundError:
+                    pass
+            self._stored &= used
+
+
+class CertificateArchive:
+    """
+    Необязательный архив выданных сертификатов на диске.
+
+    Файлы старше max_age секунд удаляются, а если архив больше max_bytes —
+    удаляются самые старые, пока размер не уложится в лимит.
+    Очистку выполняет sweep(), её периодически вызывает sweep_loop().
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_age: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def store(self, uid: str, data: bytes) -> str:
+        path = os.path.join(self.directory, f"certificate_{uid}_{time.time_ns()}.pdf")
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return path
+
+    def sweep(self) -> int:
+        """Удаляет устаревшие и лишние файлы; возвращает число удалённых."""
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.pdf'):
+                st = entry.stat()
+                files.append((st.st_mtime, st.st_size, entry.path))
+        files.sort()
+
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for mtime, size, path in files:
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+    def sweep_loop(self, interval: float) -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                removed = self.sweep()
+                if removed:
+                    logger.info("Certificate archive: removed %d files", removed)
+            except Exception:
+                logger.exception("Ошибка очистки архива сертификатов")
@@ -0,0 +1,365 @@
+"""
+Компиляция курса из full_course_data.json.
+
+compile_course() проверяет всю схему сразу — тексты на всех языках, мини-тесты
+шагов, правильные ответы финального теста, ссылки — и собирает неизменяемое
+представление с доступом по индексам: языки получают маленькие целые id,
+шаги и вопросы лежат в кортежах, переводы — кортежи по id языка, тексты
+интерфейса — в каталоге i18n. Недостающий перевод берётся по цепочке
+запасных языков (uk -> ru -> en) здесь же, при компиляции. Ошибки
+собираются списком, чтобы за один запуск увидеть их все, а не по одной
+KeyError у живого пользователя.
+"""
+import copyreg
+import hashlib
+import io
+import logging
+import os
+import pickle
+import sys
+from collections.abc import Iterable, Mapping
+from types import MappingProxyType
+from typing import NamedTuple
+
+from i18n import Catalog, Template, fallback_chain
+
+# Тексты, которые бот берёт через t() и напрямую из 'texts'
+REQUIRED_TEXTS = (
+    'welcome', 'overview', 'main_menu_title', 'help_brief', 'unknown',
+    'menu_show_course', 'menu_final', 'menu_certificate', 'menu_bonus',
+    'menu_support', 'menu_feedback', 'menu_ask',
+    'back_main', 'btn_back_main', 'back_steps', 'course_list', 'locked_step',
+    'progress', 'start_test', 'correct', 'incorrect', 'retry',
+    'test_progress', 'cancel_test', 'cancelled', 'final_correct',
+    'final_message', 'final_failed',
+    'cert', 'cert_ready', 'certificate_locked', 'certificate_message',
+    'enter_name_button', 'enter_name_prompt',
+    'bonus_title', 'bonus_text', 'btn_bonus', 'bonus_locked',
+    'feedback_message', 'btn_feedback',
+    'cancel_question', 'cancelled_question', 'ask_sent',
+)
+
+# Шаблоны и поля, которые им передаются
+TEMPLATE_FIELDS = {
+    'progress': ('step', 'total'),
+    'test_progress': ('current', 'total'),
+}
+
+URL_SCHEMES = ('http://', 'https://', 'tg://')
+
+# Меняется при любом изменении Course и связанных классов — старые снимки игнорируются
+SNAPSHOT_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+class CourseError(ValueError):
+    """Курс не прошёл проверку; problems — список всех найденных ошибок."""
+
+    def __init__(self, problems: list[str]):
+        self.problems = problems
+        super().__init__(f"{len(problems)} problem(s) in course: " + '; '.join(problems[:5]))
+
+
+class MiniTest(NamedTuple):
+    """Вопрос с вариантами; все поля — кортежи по id языка."""
+    question: tuple[str, ...]
+    options: tuple[tuple[str, ...], ...]
+    correct: tuple[int, ...]  # индекс правильного варианта, с нуля
+
+
+class Step(NamedTuple):
+    title: tuple[str, ...]
+    header: tuple[str, ...]
+    body: tuple[str, ...]
+    test: MiniTest | None
+
+
+class Course(NamedTuple):
+    langs: tuple[str, ...]
+    lang_ids: Mapping[str, int]
+    chains: Mapping[str, tuple[str, ...]]  # язык -> он сам и его запасные
+    catalog: Catalog
+    steps: tuple[Step, ...]
+    final_questions: tuple[MiniTest, ...]
+    bonus_links: tuple[str, ...]
+    support_link: str
+    support_text: tuple[str, ...]
+    btn_support: tuple[str, ...]
+    support_form_link: tuple[str, ...]
+    ask_prompt: tuple[str, ...]
+    fallbacks_used: tuple[str, ...]  # где перевод взят из запасного языка
+
+    def lid(self, lang: str) -> int:
+        """id языка; неизвестный язык — язык по умолчанию."""
+        return self.lang_ids.get(lang, 0)
+
+    def t(self, key: str, lang: str) -> str:
+        return self.catalog.get(key, lang)
+
+
+def _is_text(item) -> bool:
+    return isinstance(item, str) and bool(item.strip())
+
+
+class _Checker:
+    """Собирает ошибки и достаёт значения, подставляя заглушки на месте сломанных."""
+
+    def __init__(self, langs: tuple[str, ...], chains: Mapping[str, tuple[str, ...]]):
+        self.langs = langs
+        self.chains = chains
+        self.problems: list[str] = []
+        self.fallbacks_used: list[str] = []
+
+    def fail(self, where: str, what: str) -> None:
+        self.problems.append(f"{where}: {what}")
+
+    def pick(self, value: dict, lang: str, where: str, valid):
+        """Первое подходящее значение по цепочке языков lang; None, если его нет нигде."""
+        for candidate in self.chains[lang]:
+            item = value.get(candidate)
+            if valid(item):
+                if candidate != lang:
+                    self.fallbacks_used.append(f"{where}.{lang}->{candidate}")
+                return item
+        return None
+
+    def text(self, value, where: str, allow_empty: bool = False) -> tuple[str, ...]:
+        """{lang: str} -> кортеж по id языка. Одна строка годится для всех языков."""
+        if isinstance(value, str):
+            value = dict.fromkeys(self.langs, value)
+        if not isinstance(value, dict):
+            self.fail(where, "expected {lang: text}")
+            return ('',) * len(self.langs)
+        out = []
+        for lang in self.langs:
+            item = self.pick(value, lang, where, _is_text)
+            if item is None:
+                if not allow_empty:
+                    self.fail(f"{where}.{lang}", "missing or empty text")
+                item = ''
+            out.append(item)
+        return tuple(out)
+
+    def url(self, value, where: str) -> str:
+        if not isinstance(value, str) or not value.startswith(URL_SCHEMES):
+            self.fail(where, f"not a link: {value!r}")
+            return ''
+        return value
+
+    def urls(self, value, where: str) -> tuple[str, ...]:
+        if not isinstance(value, dict):
+            self.fail(where, "expected {lang: link}")
+            return ('',) * len(self.langs)
+        return tuple(
+            self.url(self.pick(value, lang, where, lambda v: isinstance(v, str) and v.startswith(URL_SCHEMES))
+                     or value.get(lang), f"{where}.{lang}")
+            for lang in self.langs
+        )
+
+    def question(self, value, where: str) -> MiniTest:
+        if not isinstance(value, dict):
+            self.fail(where, "expected a question object")
+            value = {}
+        question = self.text(value.get('question'), f"{where}.question")
+        options_raw = value.get('options')
+        correct_raw = value.get('correct')
+        if not isinstance(options_raw, dict):
+            self.fail(f"{where}.options", "expected {lang: [options]}")
+            options_raw = {}
+        if not isinstance(correct_raw, dict):
+            self.fail(f"{where}.correct", "expected {lang: index}")
+            correct_raw = {}
+
+        options, correct = [], []
+        for lang in self.langs:
+            # варианты и правильный ответ берутся из одного языка цепочки
+            source = next((c for c in self.chains[lang] if c in options_raw or c in correct_raw), lang)
+            if source != lang:
+                self.fallbacks_used.append(f"{where}.options.{lang}->{source}")
+            opts = options_raw.get(source)
+            if not isinstance(opts, list) or not opts or not all(map(_is_text, opts)):
+                self.fail(f"{where}.options.{source}", "expected a non-empty list of texts")
+                opts = []
+            idx = correct_raw.get(source)
+            if not isinstance(idx, int) or isinstance(idx, bool) or not 0 <= idx < len(opts):
+                self.fail(f"{where}.correct.{source}", f"index {idx!r} out of range for {len(opts)} option(s)")
+                idx = 0
+            options.append(tuple(opts))
+            correct.append(idx)
+        return MiniTest(question, tuple(options), tuple(correct))
+
+
+def course_languages(raw: dict, fallbacks: Mapping[str, Iterable[str]] | None = None) -> tuple[str, ...]:
+    """
+    Языки курса: явный список 'languages' или порядок переводов 'welcome',
+    плюс языки из цепочек fallbacks (их тексты могут быть переведены частично).
+    Первый язык — язык по умолчанию.
+    """
+    langs = raw.get('languages')
+    if langs is None:
+        langs = list((raw.get('texts') or {}).get('welcome') or {})
+    langs = list(langs)
+    for lang in fallbacks or ():
+        if lang not in langs:
+            langs.append(lang)
+    return tuple(langs)
+
+
+def compile_course(raw: dict, fallbacks: Mapping[str, Iterable[str]] | None = None) -> Course:
+    """
+    Проверяет курс целиком и собирает Course; при ошибках — CourseError со списком.
+
+    fallbacks — запасные языки, например {'uk': ['ru', 'en']}; в конце любой
+    цепочки стоит язык по умолчанию.
+    """
+    if not isinstance(raw, dict):
+        raise CourseError(["course: expected a JSON object"])
+    fallbacks = fallbacks or {}
+    langs = course_languages(raw, fallbacks)
+    if not langs:
+        raise CourseError(["texts.welcome: no languages found"])
+    chains = {lang: fallback_chain(lang, fallbacks, langs[0]) for lang in langs}
+    check = _Checker(langs, chains)
+
+    texts_raw = raw.get('texts')
+    if not isinstance(texts_raw, dict):
+        check.fail('texts', "expected an object")
+        texts_raw = {}
+    texts = {}
+    for key, value in texts_raw.items():
+        if key == 'support_link' or key not in REQUIRED_TEXTS and not isinstance(value, dict):
+            continue
+        texts[key] = check.text(value, f"texts.{key}", allow_empty=key not in REQUIRED_TEXTS)
+    for key in REQUIRED_TEXTS:
+        if key not in texts_raw:
+            check.fail(f"texts.{key}", "missing")
+            texts[key] = ('',) * len(langs)
+    for key, fields in TEMPLATE_FIELDS.items():
+        for lang, text in zip(langs, texts[key]):
+            try:
+                unknown = Template(text).fields - set(fields)
+            except ValueError as e:
+                unknown = e
+            if unknown:
+                check.fail(f"texts.{key}.{lang}", f"bad template ({unknown}), fields: {', '.join(fields)}")
+
+    steps_raw = raw.get('steps')
+    if not isinstance(steps_raw, list) or not steps_raw:
+        check.fail('steps', "expected a non-empty list")
+        steps_raw = []
+    steps = []
+    for idx, step in enumerate(steps_raw, start=1):
+        where = f"steps[{idx}]"
+        if not isinstance(step, dict):
+            check.fail(where, "expected an object")
+            step = {}
+        title = check.text(step.get('title'), f"{where}.title")
+        header = check.text(step.get('header', ''), f"{where}.header", allow_empty=True)
+        body = check.text(step.get('body', step.get('text', '')), f"{where}.body", allow_empty=True)
+        test = None
+        # у всех шагов, кроме последнего, есть мини-тест (на последнем — финальный)
+        if 'test' in step or idx < len(steps_raw):
+            test = check.question(step.get('test'), f"{where}.test")
+        steps.append(Step(title, header, body, test))
+
+    final_raw = (raw.get('final_test') or {}).get('questions')
+    if not isinstance(final_raw, list) or not final_raw:
+        check.fail('final_test.questions', "expected a non-empty list")
+        final_raw = []
+    final_questions = tuple(
+        check.question(q, f"final_test.questions[{i}]") for i, q in enumerate(final_raw)
+    )
+
+    course = Course(
+        langs=langs,
+        lang_ids=MappingProxyType({lang: i for i, lang in enumerate(langs)}),
+        chains=MappingProxyType(chains),
+        catalog=Catalog(langs, texts, TEMPLATE_FIELDS),
+        steps=tuple(steps),
+        final_questions=final_questions,
+        bonus_links=check.urls((raw.get('bonus') or {}).get('links'), 'bonus.links'),
+        support_link=check.url(texts_raw.get('support_link'), 'texts.support_link'),
+        support_text=check.text(raw.get('support_text'), 'support_text'),
+        btn_support=check.text(raw.get('btn_support'), 'btn_support'),
+        support_form_link=check.urls(raw.get('support_form_link'), 'support_form_link'),
+        ask_prompt=check.text(raw.get('ask_prompt'), 'ask_prompt'),
+        fallbacks_used=tuple(check.fallbacks_used),
+    )
+    if check.problems:
+        raise CourseError(check.problems)
+    return course
+
+
+# --- Бинарный снимок скомпилированного курса ---
+def _mappingproxy(data: dict) -> MappingProxyType:
+    return MappingProxyType(data)
+
+
+class _SnapshotPickler(pickle.Pickler):
+    # MappingProxyType сам не сериализуется — пишем его как dict
+    dispatch_table = copyreg.dispatch_table.copy()
+    dispatch_table[MappingProxyType] = lambda proxy: (_mappingproxy, (dict(proxy),))
+
+
+def _snapshot_key(fallbacks: Mapping | None) -> tuple:
+    """Всё, кроме исходника, от чего зависит результат компиляции."""
+    fallbacks = {lang: tuple(chain) for lang, chain in (fallbacks or {}).items()}
+    return SNAPSHOT_VERSION, sys.version_info[:2], sorted(fallbacks.items())
+
+
+def _source_hash(source_path: str) -> str:
+    with open(source_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def save_snapshot(course: Course, snapshot_path: str, source_path: str,
+                  fallbacks: Mapping | None = None) -> None:
+    """
+    Сохраняет скомпилированный курс рядом с исходником.
+
+    В заголовке — mtime, размер и sha256 исходника: load_snapshot() верит
+    снимку, пока они совпадают. Запись атомарная (tmp + os.replace).
+    """
+    st = os.stat(source_path)
+    header = {
+        'key': _snapshot_key(fallbacks),
+        'mtime_ns': st.st_mtime_ns,
+        'size': st.st_size,
+        'sha256': _source_hash(source_path),
+    }
+    buf = io.BytesIO()
+    pickler = _SnapshotPickler(buf, protocol=pickle.HIGHEST_PROTOCOL)
+    pickler.dump(header)
+    pickler.clear_memo()  # заголовок и курс читаются отдельными pickle.load
+    pickler.dump(course)
+    tmp = f'{snapshot_path}.{os.getpid()}.tmp'  # воркеры шардов могут писать снимок одновременно
+    with open(tmp, 'wb') as f:
+        f.write(buf.getvalue())
+    os.replace(tmp, snapshot_path)
+
+
+def load_snapshot(snapshot_path: str, source_path: str,
+                  fallbacks: Mapping | None = None) -> Course | None:
+    """
+    Курс из снимка или None, если снимка нет или он устарел.
+
+    Совпали mtime и размер исходника — снимок свежий без чтения исходника;
+    иначе сверяется sha256 (файл мог быть просто перезаписан тем же содержимым).
+    """
+    try:
+        with open(snapshot_path, 'rb') as f:
+            header = pickle.load(f)
+            if header.get('key') != _snapshot_key(fallbacks):
+                return None
+            st = os.stat(source_path)
+            if (st.st_mtime_ns, st.st_size) != (header['mtime_ns'], header['size']) and (
+                    st.st_size != header['size'] or _source_hash(source_path) != header['sha256']):
+                return None
+            course = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.warning("Course snapshot %s is unreadable, ignoring it", snapshot_path, exc_info=True)
+        return None
+    return course if isinstance(course, Course) else None
@@ -0,0 +1,102 @@
+"""
+Каталог переводов интерфейса.
+
+Все переводы лежат в одном плоском словаре {(ключ, язык): текст}.
+Цепочки запасных языков (например, uk -> ru -> en) разрешаются один раз
+при сборке каталога, так что пропуск перевода ничего не стоит во время
+запроса: get() — один поиск по кортежу. Шаблоны с полями разбираются
+заранее в Template и лежат в таком же словаре.
+"""
+from collections.abc import Iterable, Mapping
+from string import Formatter
+
+
+def fallback_chain(lang: str, fallbacks: Mapping[str, Iterable[str]], default: str) -> tuple[str, ...]:
+    """lang, его запасные языки по порядку и в конце язык по умолчанию, без повторов."""
+    chain = [lang]
+    for fallback in (*fallbacks.get(lang, ()), default):
+        if fallback not in chain:
+            chain.append(fallback)
+    return tuple(chain)
+
+
+class Template:
+    """
+    Заранее разобранный шаблон str.format с именованными полями.
+
+    При сборке Formatter().parse() делит шаблон на куски: литерал или
+    поле со спецификацией формата. format() только подставляет значения
+    и склеивает куски, не разбирая строку заново.
+    """
+
+    __slots__ = ('_parts', 'fields', 'text')
+
+    def __init__(self, text: str):
+        self.text = text
+        parts, fields = [], []
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if literal:
+                parts.append((literal, None, ''))
+            if field is None:
+                continue
+            if not field.isidentifier() or conversion:
+                raise ValueError(f"unsupported field {{{field}}} in {text!r}")
+            parts.append(('', field, spec))
+            if field not in fields:
+                fields.append(field)
+        self._parts = tuple(parts)
+        self.fields = frozenset(fields)
+
+    def format(self, **values) -> str:
+        return ''.join([literal if field is None else format(values[field], spec)
+                        for literal, field, spec in self._parts])
+
+    def __repr__(self) -> str:
+        return f"Template({self.text!r})"
+
+
+class Catalog:
+    """
+    Плоский словарь переводов: texts[key, lang].
+
+    texts — {ключ: кортеж строк по языкам в порядке langs}, уже с
+    подставленными запасными переводами. templates — ключи, которые надо
+    разобрать в Template. Неизвестный язык обслуживается текстами языка
+    по умолчанию (первого в langs).
+    """
+
+    def __init__(self, langs: tuple[str, ...], texts: Mapping[str, tuple[str, ...]],
+                 templates: Iterable[str] = ()):
+        self.langs = langs
+        self.default = langs[0]
+        self._texts = {(key, lang): column[lid]
+                       for key, column in texts.items() for lid, lang in enumerate(langs)}
+        self.template_keys = tuple(key for key in templates if key in texts)
+        self._templates = {(key, lang): Template(texts[key][lid])
+                           for key in self.template_keys for lid, lang in enumerate(langs)}
+
+    def __reduce__(self):
+        # в pickle кладём исходные тексты, шаблоны разбираются заново
+        texts: dict[str, list[str]] = {}
+        for (key, _), text in self._texts.items():
+            texts.setdefault(key, []).append(text)
+        return Catalog, (self.langs, {key: tuple(column) for key, column in texts.items()}, self.template_keys)
+
+    def __contains__(self, key: str) -> bool:
+        return (key, self.default) in self._texts
+
+    def get(self, key: str, lang: str) -> str:
+        try:
+            return self._texts[key, lang]
+        except KeyError:
+            # язык не из курса (например, убран при перезагрузке) — язык по умолчанию
+            return self._texts[key, self.default]
+
+    def template(self, key: str, lang: str) -> Template:
+        try:
+            return self._templates[key, lang]
+        except KeyError:
+            return self._templates[key, self.default]
+
+    def format(self, key: str, lang: str, **values) -> str:
+        return self.template(key, lang).format(**values)
@@ -0,0 +1,212 @@
+"""
+Готовые клавиатуры меню и страницы шагов.
+
+Разметка главного меню зависит только от (язык, пройден ли финальный тест),
+списки шагов — от языка и текущего шага, страница шага и вопрос мини-теста —
+от (номер шага, язык). Всё это строится один раз при загрузке курса (и заново
+при его перезагрузке), а обработчики берут готовый объект из словаря.
+Язык, которого нет в курсе (например, убранный при перезагрузке),
+обслуживается языком по умолчанию.
+"""
+from types import MappingProxyType
+from typing import NamedTuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from course import Course, Step
+from routing import pack
+
+# Подписи кнопок выбора языка; для остальных языков — текст 'lang_name' из курса
+LANGUAGE_LABELS = {'ru': '🇷🇺 Русский', 'en': '🇬🇧 English'}
+
+
+class Page(NamedTuple):
+    """Готовое сообщение: текст, parse_mode и клавиатура."""
+    text: str
+    parse_mode: str | None
+    reply_markup: InlineKeyboardMarkup
+
+
+class KeyboardCache:
+    """
+    Неизменяемый набор клавиатур для одного варианта курса.
+
+    rebuild() собирает новые словари целиком и только потом подменяет
+    старые, так что читатели никогда не видят наполовину собранный кэш.
+    """
+
+    def __init__(self, course: Course):
+        self.rebuild(course)
+
+    def rebuild(self, course: Course) -> None:
+        t = course.t
+        steps = course.steps
+
+        main, courses, progress = {}, {}, {}
+        languages = InlineKeyboardMarkup([[
+            InlineKeyboardButton(self._language_label(course, lang), callback_data=pack('lang', lang))
+            for lang in course.langs
+        ]])
+        for lang in course.langs:
+            for final_passed in (False, True):
+                main[(lang, final_passed)] = self._main_menu(t, lang, final_passed)
+            for ask in (False, True):
+                courses[(lang, ask)] = self._step_list(course, lang, ask=ask)
+            # текущий шаг от 1 до «все шаги пройдены»
+            for current in range(1, len(steps) + 2):
+                progress[(lang, current)] = self._step_list(course, lang, current=current)
+
+        self.langs = course.langs
+        self.default = course.langs[0]
+        self.steps_total = len(steps)
+        self._languages = languages
+        self._main = MappingProxyType(main)
+        self._courses = MappingProxyType(courses)
+        self._progress = MappingProxyType(progress)
+
+    # --- Доступ ---
+    def language_menu(self) -> InlineKeyboardMarkup:
+        return self._languages
+
+    def main_menu(self, lang: str, final_passed: bool) -> InlineKeyboardMarkup:
+        return self._main.get((lang, bool(final_passed))) or self._main[(self.default, bool(final_passed))]
+
+    def course_list(self, lang: str, ask: bool = False) -> InlineKeyboardMarkup:
+        return self._courses.get((lang, ask)) or self._courses[(self.default, ask)]
+
+    def course_progress(self, lang: str, current: int) -> InlineKeyboardMarkup:
+        current = min(max(current, 1), self.steps_total + 1)
+        return self._progress.get((lang, current)) or self._progress[(self.default, current)]
+
+    # --- Построение ---
+    @staticmethod
+    def _language_label(course: Course, lang: str) -> str:
+        if lang in LANGUAGE_LABELS:
+            return LANGUAGE_LABELS[lang]
+        if 'lang_name' in course.catalog:
+            return course.catalog.get('lang_name', lang)
+        return lang
+
+    @staticmethod
+    def _main_menu(t, lang: str, final_passed: bool) -> InlineKeyboardMarkup:
+        kb = [
+            # 📋 Показать шаги
+            [InlineKeyboardButton(t('menu_show_course', lang), callback_data='menu_show_course')],
+            # 🌟 Финальный тест
+            [InlineKeyboardButton(t('menu_final', lang), callback_data='menu_final')],
+        ]
+        # 🎓 Сертификат # 💖 Поддержка и 📚 Бонусы — только после финального теста
+        if final_passed:
+            kb.append([InlineKeyboardButton(t('menu_certificate', lang), callback_data='menu_certificate')])
+            kb.append([InlineKeyboardButton(t('menu_bonus', lang), callback_data='menu_bonus')])
+            kb.append([InlineKeyboardButton(t('menu_support', lang), callback_data='menu_support')])
+        # ✉ Обратная связь
+        kb.append([InlineKeyboardButton(t('menu_feedback', lang), callback_data='menu_feedback')])
+        # ❓ Задать вопрос
+        kb.append([InlineKeyboardButton(t('menu_ask', lang), callback_data='menu_ask')])
+        return InlineKeyboardMarkup(kb)
+
+    @staticmethod
+    def _step_list(course: Course, lang: str, ask: bool = False,
+                   current: int | None = None) -> InlineKeyboardMarkup:
+        """
+        Список шагов. Без current — все шаги открыты; с current — пройденные
+        отмечены ✓, текущий ▶, будущие закрыты 🔒.
+        """
+        t, lid = course.t, course.lid(lang)
+        kb = []
+        for idx, step in enumerate(course.steps, start=1):
+            title = step.title[lid]
+            if current is None:
+                label, cb = title, pack('select_step', idx)
+            elif idx < current:
+                label, cb = f"✓ {idx}. {title}", pack('select_step', idx)
+            elif idx == current:
+                label, cb = f"▶ {idx}. {title}", pack('select_step', idx)
+            else:
+                label, cb = f"🔒 {idx}. {title}", 'locked'
+            kb.append([InlineKeyboardButton(label, callback_data=cb)])
+
+        # «Назад в главное меню»
+        kb.append([InlineKeyboardButton(t('back_main', lang), callback_data='back_main')])
+        # «Задать вопрос»
+        if ask:
+            kb.append([InlineKeyboardButton(t('menu_ask', lang), callback_data='menu_ask')])
+        return InlineKeyboardMarkup(kb)
+
+
+class PageCache:
+    """
+    Скомпилированные страницы шагов и мини-тестов, ключ — (номер шага, язык).
+
+    Для шага хранится страница с заголовком, прогрессом и текстом; для
+    мини-теста — вопрос с кнопками вариантов, номер правильного варианта
+    (с единицы, как в callback_data) и клавиатура «Ещё раз».
+    """
+
+    def __init__(self, course: Course):
+        self.rebuild(course)
+
+    def rebuild(self, course: Course) -> None:
+        catalog = course.catalog
+        total = len(course.steps)
+
+        def t(key, lang, **values):
+            return catalog.format(key, lang, **values) if values else catalog.get(key, lang)
+
+        pages, tests, answers, retries = {}, {}, {}, {}
+        for lid, lang in enumerate(course.langs):
+            for sid, step in enumerate(course.steps, start=1):
+                pages[(sid, lang)] = self._step_page(t, step, sid, total, lang, lid)
+                test = step.test
+                if test is None:
+                    continue
+                kb = [[InlineKeyboardButton(opt, callback_data=pack('test_step', sid, i))]
+                      for i, opt in enumerate(test.options[lid], 1)]
+                tests[(sid, lang)] = Page(test.question[lid], None, InlineKeyboardMarkup(kb))
+                answers[(sid, lang)] = test.correct[lid] + 1
+                retries[(sid, lang)] = InlineKeyboardMarkup([
+                    [InlineKeyboardButton(t('retry', lang), callback_data=pack('test_step', sid, 'start'))]
+                ])
+
+        self.default = course.langs[0]
+        self.steps_total = total
+        self._pages = MappingProxyType(pages)
+        self._tests = MappingProxyType(tests)
+        self._answers = MappingProxyType(answers)
+        self._retries = MappingProxyType(retries)
+
+    # --- Доступ ---
+    def step(self, sid: int, lang: str) -> Page:
+        return self._pages.get((sid, lang)) or self._pages[(sid, self.default)]
+
+    def test(self, sid: int, lang: str) -> Page:
+        return self._tests.get((sid, lang)) or self._tests[(sid, self.default)]
+
+    def test_answer(self, sid: int, lang: str) -> int:
+        return self._answers.get((sid, lang)) or self._answers[(sid, self.default)]
+
+    def test_retry(self, sid: int, lang: str) -> InlineKeyboardMarkup:
+        return self._retries.get((sid, lang)) or self._retries[(sid, self.default)]
+
+    # --- Построение ---
+    @staticmethod
+    def _step_page(t, step: Step, sid: int, total: int, lang: str, lid: int) -> Page:
+        title = step.title[lid]
+        prog = t('progress', lang, step=sid, total=total)
+        header = step.header[lid]
+        body = step.body[lid]
+        text = (
+            f"<b>{title}</b>\n"
+            f"<i>{prog}</i>\n\n"
+            f"<b>{header}</b>\n\n"
+            f"{body}"
+        )
+
+        # Если последний шаг — предлагаем финальный тест
+        if sid == total:
+            kb = [[InlineKeyboardButton(t('menu_final', lang), callback_data='menu_final')]]
+        else:
+            kb = [[InlineKeyboardButton(t('start_test', lang), callback_data=pack('test_step', sid, 'start'))]]
+        kb.append([InlineKeyboardButton(t('back_steps', lang), callback_data="show_course")])
+        return Page(text, 'HTML', InlineKeyboardMarkup(kb))
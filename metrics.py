@@ -0,0 +1,239 @@
+"""
+Метрики бота в текстовом формате Prometheus, без сторонних библиотек.
+
+Registry хранит счётчики и гистограммы с метками; значения-«снимки»
+(сколько пользователей в памяти, длина очередей) считаются функциями в
+момент выдачи. render() — текст для GET /metrics (формат 0.0.4).
+InstrumentedRequest оборачивает HTTP-клиент PTB и меряет каждый вызов
+Bot API по методу, так что в метрики попадают и ответы на нажатия, и
+отправки из планировщика.
+"""
+import bisect
+import functools
+import time
+from collections.abc import Callable
+from contextlib import contextmanager
+
+from telegram.request import BaseRequest, RequestData
+
+# секунды: от быстрого обработчика до медленного рендеринга сертификата
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+def _labels_text(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    pairs = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Histogram:
+    """Счётчики по корзинам (верхним границам), сумма и число наблюдений."""
+
+    __slots__ = ('buckets', 'count', 'counts', 'sum')
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # последняя — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Оценка q-квантиля (0..1) с интерполяцией внутри корзины, как histogram_quantile."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if seen + n >= rank and n:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                low = self.buckets[i - 1] if i else 0.0
+                return low + (self.buckets[i] - low) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+class CounterFamily:
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...]):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        lines += [f'{self.name}{_labels_text(self.labels, key)} {_number(value)}'
+                  for key, value in sorted(self.values.items())]
+        return lines
+
+
+class HistogramFamily:
+    def __init__(self, name: str, help_text: str, labels: tuple[str, ...], buckets: tuple[float, ...]):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values: dict[tuple, Histogram] = {}
+
+    def get(self, *labels) -> Histogram:
+        histogram = self.values.get(labels)
+        if histogram is None:
+            histogram = self.values[labels] = Histogram(self.buckets)
+        return histogram
+
+    def observe(self, value: float, *labels) -> None:
+        self.get(*labels).observe(value)
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.get(*labels).observe(time.perf_counter() - started)
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, h in sorted(self.values.items()):
+            cumulative = 0
+            for bound, n in zip((*h.buckets, float('inf')), h.counts):
+                cumulative += n
+                le = f'le="{_number(bound)}"'
+                lines.append(f'{self.name}_bucket{_labels_text(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels_text(self.labels, key)} {_number(h.sum)}')
+            lines.append(f'{self.name}_count{_labels_text(self.labels, key)} {h.count}')
+        return lines
+
+
+class GaugeFamily:
+    """Значение считается функцией при каждой выдаче."""
+
+    def __init__(self, name: str, help_text: str, read: Callable[[], float]):
+        self.name = name
+        self.help = help_text
+        self.read = read
+
+    def render(self) -> list[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge',
+                f'{self.name} {_number(self.read())}']
+
+
+class Registry:
+    def __init__(self):
+        self._families: dict[str, CounterFamily | HistogramFamily | GaugeFamily] = {}
+
+    def _add(self, family):
+        if family.name in self._families:
+            raise ValueError(f"Metric {family.name} is already registered")
+        self._families[family.name] = family
+        return family
+
+    def counter(self, name: str, help_text: str, labels: tuple[str, ...] = ()) -> CounterFamily:
+        return self._add(CounterFamily(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> HistogramFamily:
+        return self._add(HistogramFamily(name, help_text, labels, buckets))
+
+    def gauge(self, name: str, help_text: str, read: Callable[[], float]) -> GaugeFamily:
+        return self._add(GaugeFamily(name, help_text, read))
+
+    def render(self) -> str:
+        lines = []
+        for family in self._families.values():
+            lines += family.render()
+        return '\n'.join(lines) + '\n'
+
+
+def summary_lines(seconds: HistogramFamily, errors: CounterFamily | None = None, limit: int = 10) -> list[str]:
+    """Строки для /stats: «метка: N, p50 X мс, p95 Y мс, ошибок E» — самые частые первыми."""
+    failed: dict = {}
+    if errors is not None:
+        for key, value in errors.values.items():
+            failed[key[:1]] = failed.get(key[:1], 0) + value
+    rows = sorted(seconds.values.items(), key=lambda item: -item[1].count)
+    lines = []
+    for key, h in rows[:limit]:
+        line = (f"{'/'.join(map(str, key)) + ': ' if key else ''}{h.count}, "
+                f"p50 {h.quantile(0.5) * 1000:.0f} мс, p95 {h.quantile(0.95) * 1000:.0f} мс")
+        if failed.get(key[:1]):
+            line += f", ошибок {failed[key[:1]]:.0f}"
+        lines.append(line)
+    return lines
+
+
+def timed(seconds: HistogramFamily, errors: CounterFamily, name: str, func):
+    """Обёртка async-обработчика: время в seconds{name}, исключения — в errors{name}."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            errors.inc(name)
+            raise
+        finally:
+            seconds.observe(time.perf_counter() - started, name)
+    return wrapper
+
+
+class InstrumentedRequest(BaseRequest):
+    """
+    HTTP-клиент Bot API, который меряет каждый вызов: время в
+    seconds{method}, ошибки в errors{method, status} (status — код HTTP
+    или 'network', если ответа не было).
+    """
+
+    def __init__(self, inner: BaseRequest, seconds: HistogramFamily, errors: CounterFamily):
+        self.inner = inner
+        self.seconds = seconds
+        self.errors = errors
+
+    @property
+    def read_timeout(self) -> float | None:
+        return self.inner.read_timeout
+
+    async def initialize(self) -> None:
+        await self.inner.initialize()
+
+    async def shutdown(self) -> None:
+        await self.inner.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data: RequestData | None = None,
+                         read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE,
+                         connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE) -> tuple[int, bytes]:
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await self.inner.do_request(
+                url, method, request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout)
+        except Exception:
+            self.errors.inc(api_method, 'network')
+            raise
+        finally:
+            self.seconds.observe(time.perf_counter() - started, api_method)
+        if code != 200:
+            self.errors.inc(api_method, str(code))
+        return code, payload
@@ -0,0 +1,380 @@
+"""
+Исходящие сообщения через один планировщик с ограничением скорости.
+
+Telegram ограничивает бота примерно 30 сообщениями в секунду в целом,
+1 в секунду в личный чат и 20 в минуту в группу; при превышении отвечает
+429 с retry_after. SendScheduler держит общий token bucket и по бакету на
+чат, отправляет сообщения одного чата строго по очереди, а при нехватке
+общих токенов первыми пропускает интерактивные ответы, потом уведомления
+админам, потом массовые рассылки. 429 не долетает до обработчика: чат
+ставится на паузу на retry_after и сообщение уходит повторно.
+
+Сам планировщик ничего не знает о Bot — он вызывает переданные функции,
+поэтому проверяется с любым поддельным ботом.
+"""
+import asyncio
+import heapq
+import html
+import itertools
+import logging
+import time
+from collections import Counter, deque
+from collections.abc import Awaitable, Callable
+from contextvars import ContextVar
+from typing import Any
+
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: меньше — раньше
+INTERACTIVE = 0
+ADMIN = 1
+BULK = 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', ADMIN: 'admin', BULK: 'bulk'}
+
+# Режимы ответа на нажатие кнопки (см. ReplyBatch)
+REPLY_MODES = ('send', 'merge', 'edit')
+MAX_MESSAGE_LENGTH = 4096
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """retry_after бывает числом или timedelta в зависимости от версии PTB."""
+    value = error.retry_after
+    return value.total_seconds() if hasattr(value, 'total_seconds') else float(value)
+
+
+class TokenBucket:
+    """Ведро токенов: rate в секунду, не больше burst подряд."""
+
+    __slots__ = ('burst', 'rate', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд будет доступен токен (0 — уже есть)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self, now: float) -> float:
+        """Забирает токен (в долг, если их нет) и возвращает, сколько ждать."""
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refill_time(self, now: float) -> float:
+        """Через сколько секунд ведро снова будет полным."""
+        self._refill(now)
+        return (self.burst - self.tokens) / self.rate
+
+
+class _Job:
+    __slots__ = ('attempts', 'call', 'enqueued', 'future', 'priority')
+
+    def __init__(self, call, priority, future):
+        self.call = call
+        self.priority = priority
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+
+
+class _Chat:
+    __slots__ = ('bucket', 'busy', 'jobs', 'paused_until')
+
+    def __init__(self, bucket: TokenBucket):
+        self.jobs: deque[_Job] = deque()
+        self.bucket = bucket
+        self.busy = False          # в очереди готовых, ждёт таймера или отправляется
+        self.paused_until = 0.0    # после 429
+
+
+class SendScheduler:
+    """
+    Планировщик исходящих вызовов Bot API.
+
+    send(chat_id, call, priority) ставит call() в очередь чата и возвращает
+    его результат, когда сообщение реально отправлено. В каждом чате
+    одновременно выполняется не больше одного вызова — порядок сохраняется.
+    До start() (и после stop()) вызовы выполняются сразу, без очереди.
+    """
+
+    def __init__(self, rate: float = 25.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 group_rate: float = 20 / 60, max_inflight: int = 16, max_retries: int = 5):
+        self.rate = rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_inflight = max_inflight
+        self.max_retries = max_retries
+
+        self._bucket = TokenBucket(rate, burst=max(1.0, rate / 5))
+        self._chats: dict[Any, _Chat] = {}
+        self._ready: list = []  # куча (приоритет, seq, chat_id)
+        self._seq = itertools.count()
+        self._wakeup: asyncio.Event | None = None
+        self._inflight: asyncio.Semaphore | None = None
+        self._task: asyncio.Task | None = None
+        self._running: set[asyncio.Task] = set()
+
+        # метрики
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self._wait_total = 0.0
+        self.max_wait = 0.0
+
+    # --- Жизненный цикл ---
+    def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._inflight = asyncio.Semaphore(self.max_inflight)
+        self._task = asyncio.create_task(self._dispatch_loop())
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Дожидается очереди (не дольше timeout) и останавливает диспетчер."""
+        if self._task is None:
+            return
+        deadline = time.monotonic() + timeout
+        while (self.queue_depth() or self._running) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        for chat in self._chats.values():
+            for job in chat.jobs:
+                if not job.future.done():
+                    job.future.set_exception(RuntimeError("send scheduler stopped"))
+        self._chats.clear()
+
+    # --- Отправка ---
+    async def send(self, chat_id, call: Callable[[], Awaitable], priority: int = INTERACTIVE):
+        if self._task is None:
+            return await call()
+        future = asyncio.get_running_loop().create_future()
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+            chat = self._chats[chat_id] = _Chat(TokenBucket(rate, self.chat_burst))
+        chat.jobs.append(_Job(call, priority, future))
+        if not chat.busy:
+            self._schedule(chat_id, chat)
+        return await future
+
+    def _schedule(self, chat_id, chat: _Chat) -> None:
+        """Ставит голову очереди чата в готовые — сразу или когда позволит бакет/пауза."""
+        now = time.monotonic()
+        delay = max(chat.bucket.delay(now), chat.paused_until - now)
+        chat.busy = True
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._push_ready, chat_id, chat)
+        else:
+            self._push_ready(chat_id, chat)
+
+    def _push_ready(self, chat_id, chat: _Chat) -> None:
+        if self._chats.get(chat_id) is not chat or not chat.jobs:
+            chat.busy = False
+            return
+        heapq.heappush(self._ready, (chat.jobs[0].priority, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            if not self._ready:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            # общий бакет: ждём токен, а за это время в готовые может
+            # попасть более срочное сообщение — берём голову кучи после ожидания
+            wait = self._bucket.delay(time.monotonic())
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, chat_id = heapq.heappop(self._ready)
+            chat = self._chats[chat_id]
+            now = time.monotonic()
+            self._bucket.reserve(now)
+            chat.bucket.reserve(now)
+            await self._inflight.acquire()
+            task = asyncio.create_task(self._run(chat_id, chat, chat.jobs.popleft()))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, chat_id, chat: _Chat, job: _Job) -> None:
+        try:
+            if job.attempts == 0:
+                waited = time.monotonic() - job.enqueued
+                self._wait_total += waited
+                self.max_wait = max(self.max_wait, waited)
+            job.attempts += 1
+            try:
+                result = await job.call()
+            except RetryAfter as e:
+                delay = retry_after_seconds(e)
+                if job.attempts <= self.max_retries:
+                    self.retries += 1
+                    logger.warning("Flood limit for chat %s, retrying in %.1f s", chat_id, delay)
+                    chat.paused_until = time.monotonic() + delay
+                    chat.jobs.appendleft(job)
+                else:
+                    self.failed += 1
+                    job.future.set_exception(e)
+            except Exception as e:  # noqa: BLE001 — ошибку получит тот, кто ждёт job.future
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                self.sent += 1
+                if not job.future.done():
+                    job.future.set_result(result)
+        finally:
+            self._inflight.release()
+            if chat.jobs:
+                self._schedule(chat_id, chat)
+            else:
+                chat.busy = False
+                # забываем чат, когда его бакет снова наполнится
+                now = time.monotonic()
+                idle = max(chat.bucket.refill_time(now), chat.paused_until - now)
+                asyncio.get_running_loop().call_later(idle, self._forget, chat_id, chat)
+
+    def _forget(self, chat_id, chat: _Chat) -> None:
+        if not chat.busy and not chat.jobs and self._chats.get(chat_id) is chat:
+            del self._chats[chat_id]
+
+    # --- Метрики ---
+    def queue_depth(self) -> int:
+        return sum(len(chat.jobs) for chat in self._chats.values())
+
+    def metrics(self) -> dict:
+        by_priority = dict.fromkeys(PRIORITY_NAMES.values(), 0)
+        for chat in self._chats.values():
+            for job in chat.jobs:
+                by_priority[PRIORITY_NAMES.get(job.priority, str(job.priority))] += 1
+        started = self.sent + self.failed
+        return {
+            'queued': sum(by_priority.values()),
+            'queued_by_priority': by_priority,
+            'inflight': len(self._running),
+            'chats': len(self._chats),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retries': self.retries,
+            'avg_wait_ms': round(self._wait_total / started * 1000, 1) if started else 0.0,
+            'max_wait_ms': round(self.max_wait * 1000, 1),
+        }
+
+
+# Пачка ответов текущего нажатия кнопки; reply() в bot.py смотрит сюда
+current_batch: ContextVar['ReplyBatch | None'] = ContextVar('current_batch', default=None)
+
+
+class ReplyBatch:
+    """
+    Ответы обработчика на одно нажатие кнопки.
+
+    'send'  — каждый ответ отдельным сообщением, как раньше;
+    'merge' — текст без клавиатуры не отправляется сразу, а приклеивается
+              к следующему ответу (например, «Верно!» + следующий вопрос);
+    'edit'  — как 'merge', но первое сообщение заменяет то, на котором
+              нажата кнопка (edit_message_text), вместо нового; если
+              у него нет клавиатуры, отправляется новое.
+    Используется как async with: внутри ответы на message идут через
+    reply(), на выходе досылается то, что осталось в буфере.
+    stats считает ответы обработчиков ('replies') и реальные вызовы
+    Bot API ('calls'), из них правки ('edits') и склейки ('merged').
+    """
+
+    def __init__(self, message, mode: str, sender: SendScheduler, stats: Counter,
+                 priority: int = INTERACTIVE):
+        if mode not in REPLY_MODES:
+            raise ValueError(f"unknown reply mode {mode!r}")
+        self.message = message
+        self.mode = mode
+        self.sender = sender
+        self.stats = stats
+        self.priority = priority
+        self._pending: list[str] = []
+        self._edit = mode == 'edit'
+        self._token = None
+
+    async def __aenter__(self):
+        self._token = current_batch.set(self)
+        return self
+
+    async def __aexit__(self, *exc):
+        current_batch.reset(self._token)
+        if self._pending:
+            await self._flush(self._pending)
+            self._pending = []
+
+    async def _flush(self, pending: list[str]):
+        """Отложенные тексты одним сообщением (без разметки, длинные — по отдельности)."""
+        text = '\n\n'.join(pending)
+        if len(text) <= MAX_MESSAGE_LENGTH:
+            self.stats['merged'] += len(pending) - 1
+            await self._send(text, {})
+        else:
+            for text in pending:
+                await self._send(text, {})
+
+    async def reply(self, text: str, **kwargs):
+        """Ответ обработчика; None, если текст отложен до следующего ответа."""
+        self.stats['replies'] += 1
+        if self.mode == 'send':
+            return await self._send(text, kwargs)
+        if not kwargs:
+            # голый текст — ждём, не придёт ли следом ещё ответ
+            self._pending.append(text)
+            return None
+        if self._pending:
+            pending, self._pending = self._pending, []
+            parse_mode = kwargs.get('parse_mode')
+            if parse_mode in (None, 'HTML'):
+                head = [html.escape(p, quote=False) for p in pending] if parse_mode == 'HTML' else pending
+                merged = '\n\n'.join((*head, text))
+                if len(merged) <= MAX_MESSAGE_LENGTH:
+                    self.stats['merged'] += len(pending)
+                    return await self._send(merged, kwargs)
+            await self._flush(pending)
+        return await self._send(text, kwargs)
+
+    async def _send(self, text: str, kwargs: dict):
+        message = self.message
+        self.stats['calls'] += 1
+        # правим только первым ответом; без reply_markup правка сняла бы
+        # с сообщения его кнопки — тогда отправляем новое
+        edit, self._edit = self._edit, False
+        if edit and kwargs.get('reply_markup') is not None:
+            try:
+                self.stats['edits'] += 1
+                return await self.sender.send(
+                    message.chat_id, lambda: message.edit_text(text, **kwargs), self.priority)
+            except BadRequest as e:
+                if 'not modified' in str(e):
+                    return message
+                # у сообщения нет текста (документ) или его уже нельзя менять
+                self.stats['edits'] -= 1
+                self.stats['calls'] += 1
+                logger.debug("Edit failed (%s), sending a new message", e)
+        return await self.sender.send(
+            message.chat_id, lambda: message.reply_text(text, **kwargs), self.priority)
+
+
+def reply_metrics(stats: Counter) -> dict:
+    """Сколько вызовов Bot API сэкономили склейка и правки."""
+    replies, calls = stats['replies'], stats['calls']
+    return {
+        'replies': replies,
+        'calls': calls,
+        'edits': stats['edits'],
+        'merged': stats['merged'],
+        'saved_pct': round((1 - calls / replies) * 100, 1) if replies else 0.0,
+    }
@@ -0,0 +1,232 @@
+"""
+Очередь вопросов пользователей для админов.
+
+Вопрос сначала дописывается в журнал на диске (JSON Lines), и пользователь
+сразу получает ответ «вопрос отправлен». Доставкой в админский чат
+занимается одна фоновая задача: она собирает вопросы в дайджест — не
+позже max_delay секунд после самого старого вопроса или сразу, как их
+набралось max_batch, — и при ошибке повторяет с растущей паузой.
+Доставленные вопросы отмечаются в журнале, недоставленные переживают
+перезапуск бота.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections.abc import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+
+
+def digest_text(entries: list[dict]) -> str:
+    """Текст для админов: один вопрос — как раньше, несколько — списком."""
+    if len(entries) == 1:
+        e = entries[0]
+        return f"❓ Новый вопрос от @{e['n']} ({e['u']}):\n\n{e['t']}"
+    parts = [f"❓ Новые вопросы ({len(entries)}):"]
+    parts += [f"{i}) @{e['n']} ({e['u']}):\n{e['t']}" for i, e in enumerate(entries, 1)]
+    return '\n\n'.join(parts)
+
+
+class AdminOutbox:
+    """
+    Журнал вопросов + доставка дайджестами.
+
+    Записи журнала: {"q": id, "u": uid, "n": username, "t": текст, "ts": время}
+    для нового вопроса и {"d": [id, ...]} для доставленных. Когда все
+    вопросы доставлены (или отметок набралось много), журнал переписывается
+    только с недоставленными через атомарный os.replace().
+    """
+
+    def __init__(self, path: str, max_delay: float = 30.0, max_batch: int = 10,
+                 retry_delay: float = 5.0, max_retry_delay: float = 600.0, fsync: bool = True):
+        self.path = path
+        self.max_delay = max_delay
+        self.max_batch = max_batch
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.fsync = fsync
+        self._pending: dict[int, dict] = {}
+        self._next_id = 1
+        self._acked = 0  # отметок о доставке в журнале
+        self._lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._send: Callable[[str], Awaitable] | None = None
+        self._task: asyncio.Task | None = None
+        # метрики
+        self.digests = 0
+        self.delivered = 0
+        self.failures = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    # --- Журнал ---
+    def load(self) -> int:
+        """Читает журнал; возвращает число недоставленных вопросов."""
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning("Admin outbox %s: skipped broken record", self.path)
+                    continue
+                if 'd' in entry:
+                    for qid in entry['d']:
+                        self._pending.pop(qid, None)
+                    self._acked += 1
+                else:
+                    self._pending[entry['q']] = entry
+                    self._next_id = max(self._next_id, entry['q'] + 1)
+        if self._pending:
+            logger.info("Admin outbox: %d undelivered questions", len(self._pending))
+        return len(self._pending)
+
+    def _append(self, entry: dict) -> None:
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    def _compact(self) -> None:
+        """Переписывает журнал только с недоставленными вопросами."""
+        with self._lock:
+            entries = list(self._pending.values())
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+                             for entry in entries)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self._acked = 0
+
+    def questions(self) -> list[dict]:
+        """Недоставленные вопросы в порядке поступления."""
+        return list(self._pending.values())
+
+    def import_questions(self, entries: list[dict]) -> None:
+        """Принимает недоставленные вопросы другого журнала под новыми номерами (перешардирование)."""
+        for entry in entries:
+            entry = {**entry, 'q': self._next_id}
+            self._pending[entry['q']] = entry
+            self._next_id += 1
+        self._compact()
+
+    # --- Очередь ---
+    async def add(self, uid: str, username: str, text: str) -> None:
+        """Сохраняет вопрос на диск; доставка — в фоне."""
+        entry = {'q': self._next_id, 'u': uid, 'n': username, 't': text, 'ts': time.time()}
+        self._next_id += 1
+        # сначала в словарь, потом в журнал: сжатие журнала между этими
+        # шагами запишет вопрос само, а повтор строки при чтении безопасен
+        self._pending[entry['q']] = entry
+        await asyncio.to_thread(self._append, entry)
+        self._wakeup.set()
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+
+    def _next_digest(self) -> list[dict]:
+        """Старейшие вопросы, сколько помещается в одно сообщение."""
+        batch = []
+        for entry in self._pending.values():
+            if len(batch) >= self.max_batch:
+                break
+            if batch and len(digest_text(batch + [entry])) > MAX_MESSAGE_LENGTH:
+                break
+            batch.append(entry)
+        if len(digest_text(batch)) > MAX_MESSAGE_LENGTH:
+            # один очень длинный вопрос — обрезаем текст, но не теряем вопрос
+            head = batch[0]
+            extra = len(digest_text(batch)) - MAX_MESSAGE_LENGTH
+            batch = [{**head, 't': head['t'][:len(head['t']) - extra - 1] + '…'}]
+        return batch
+
+    async def deliver(self) -> int:
+        """Отправляет один дайджест; возвращает число доставленных вопросов."""
+        if not self._pending:
+            return 0
+        batch = self._next_digest()
+        await self._send(digest_text(batch))
+        ids = [e['q'] for e in batch]
+        for qid in ids:
+            self._pending.pop(qid, None)
+        self.digests += 1
+        self.delivered += len(ids)
+        if not self._pending or self._acked >= 100:
+            await asyncio.to_thread(self._compact)
+        else:
+            self._acked += 1
+            await asyncio.to_thread(self._append, {'d': ids})
+        return len(ids)
+
+    def start(self, send: Callable[[str], Awaitable]) -> None:
+        """send(text) отправляет дайджест в админский чат."""
+        self._send = send
+        if self._pending:
+            self._wakeup.set()
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        failures = 0
+        while True:
+            await self._wakeup.wait()
+            if not self._pending:
+                self._wakeup.clear()
+                continue
+            oldest = next(iter(self._pending.values()))['ts']
+            delay = oldest + self.max_delay - time.time()
+            if delay > 0 and len(self._pending) < self.max_batch:
+                self._full.clear()
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout=delay)
+                except TimeoutError:
+                    pass
+            try:
+                await self.deliver()
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                failures += 1
+                self.failures += 1
+                pause = min(self.retry_delay * 2 ** (failures - 1), self.max_retry_delay)
+                logger.exception("Admin outbox: delivery failed, retry in %.0f s", pause)
+                await asyncio.sleep(pause)
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """Останавливает доставку, напоследок пытаясь отправить очередь."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._send is None:
+            return
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except Exception as e:  # noqa: BLE001 — сбой отправки или таймаут
+            # остальное доставим после перезапуска
+            logger.warning("Admin outbox: %d questions left for next start (%s)", len(self._pending), e)
+
+    async def _drain(self) -> None:
+        while self._pending:
+            await self.deliver()
+
+    def metrics(self) -> dict:
+        return {
+            'pending': self.pending,
+            'digests': self.digests,
+            'delivered': self.delivered,
+            'failures': self.failures,
+        }
@@ -0,0 +1,253 @@
+"""
+Профилирование работающего бота по команде админа, без перезапуска.
+
+Режимы:
+- 'cpu' — детерминированный cProfile: каждый вызов функции, точные
+  счётчики, но пока он включён, бот заметно медленнее;
+- 'sample' — выборка: фоновый поток каждые interval секунд снимает стек
+  потока event loop (sys._current_frames) и считает одинаковые стеки.
+  Нагрузка маленькая, результат — свёрнутые стеки («a;b;c 12») для
+  flamegraph.pl и speedscope.
+
+Сессия идёт seconds секунд или до updates обработанных апдейтов, но не
+дольше max_seconds. scope — имя обработчика или маршрута кнопки: профиль
+собирается, только пока выполняется хотя бы один его вызов (корутины,
+успевшие поработать в это же время, тоже попадут в профиль), и апдейты
+считаются только его. Без scope профилируется всё подряд.
+
+Обёртки обработчиков смотрят только на profiler.session: пока сессии нет,
+ни cProfile, ни поток выборки не запущены.
+"""
+import asyncio
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+MODES = ('cpu', 'sample')
+
+
+def parse_args(args: list[str], default_seconds: float = 30) -> tuple[str, float | None, int | None, str | None]:
+    """
+    Аргументы /profile в любом порядке: режим (cpu|sample), длительность
+    («30s») или число апдейтов («200»), имя обработчика или маршрута.
+    Возвращает (mode, seconds, updates, scope); ValueError — непонятный аргумент.
+    """
+    mode, seconds, updates, scope = 'sample', None, None, None
+    for arg in args:
+        if arg in MODES:
+            mode = arg
+        elif arg[:-1].isdigit() and arg[-1] in 'sс':
+            seconds = float(arg[:-1])
+        elif arg.isdigit():
+            updates = int(arg)
+        elif scope is None:
+            scope = arg
+        else:
+            raise ValueError(f"непонятный аргумент {arg!r}")
+    if seconds is None and updates is None:
+        seconds = default_seconds
+    if seconds == 0 or updates == 0:
+        raise ValueError("лимит должен быть больше нуля")
+    return mode, seconds, updates, scope
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class ProfileSession:
+    """Одна сессия профилирования; готовый профиль — finish()."""
+
+    def __init__(self, mode: str, scope: str | None, seconds: float | None, updates: int | None,
+                 interval: float):
+        self.mode = mode
+        self.scope = scope
+        self.seconds = seconds
+        self.updates = updates
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+        self.calls = 0        # апдейтов (вызовов scope) за сессию
+        self.active_time = 0.0  # сколько профиль реально собирался
+        self.samples: Counter[str] = Counter()
+        self.done = asyncio.Event()
+        self.finished = False
+        self._depth = 0
+        self._active_since: float | None = None
+        self._profile = cProfile.Profile() if mode == 'cpu' else None
+        self._thread_id = threading.get_ident()  # поток event loop
+        self._stop_sampler = threading.Event()
+        self._sampler: threading.Thread | None = None
+
+    # --- Включение и выключение ---
+    def _activate(self) -> None:
+        self._active_since = time.perf_counter()
+        if self._profile is not None:
+            self._profile.enable()
+
+    def _deactivate(self) -> None:
+        if self._active_since is None:
+            return
+        if self._profile is not None:
+            self._profile.disable()
+        self.active_time += time.perf_counter() - self._active_since
+        self._active_since = None
+
+    def begin(self) -> None:
+        if self.mode == 'sample':
+            self._sampler = threading.Thread(target=self._sample, name='profile-sampler', daemon=True)
+            self._sampler.start()
+        if self.scope is None:
+            self._activate()
+
+    def _sample(self) -> None:
+        while not self._stop_sampler.wait(self.interval):
+            if self._active_since is None:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    # --- Вызовы обработчиков ---
+    @contextmanager
+    def track(self, name: str, update: bool = True):
+        """
+        Вызов обработчика (update=True) или маршрута кнопки внутри него
+        (update=False). Выполняется в потоке event loop.
+        """
+        if self.finished or (self.scope is not None and name != self.scope):
+            yield
+            return
+        if self.scope is not None:
+            self._depth += 1
+            if self._depth == 1:
+                self._activate()
+        try:
+            yield
+        finally:
+            if not self.finished:
+                if self.scope is not None:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self._deactivate()
+                if update or self.scope is not None:
+                    self.calls += 1
+                    if self.updates is not None and self.calls >= self.updates:
+                        self.done.set()
+
+    def stop(self) -> None:
+        """Досрочное завершение: finish() вызовет тот, кто ждёт done."""
+        self.done.set()
+
+    def finish(self) -> None:
+        """Выключает профилирование (в потоке event loop — cProfile привязан к нему)."""
+        if self.finished:
+            return
+        self.finished = True
+        self._deactivate()
+        self._stop_sampler.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self.elapsed = time.perf_counter() - self.started
+
+    # --- Результат ---
+    def write(self, directory: str, prefix: str = 'profile') -> tuple[str, str]:
+        """
+        Пишет профиль в directory; возвращает (путь к файлу для отправки,
+        короткую сводку). cpu: отчёт pstats в .txt и сырой .prof рядом (для
+        snakeviz и pstats); sample: свёрнутые стеки в .txt.
+        """
+        os.makedirs(directory, exist_ok=True)
+        name = f"{prefix}-{time.strftime('%Y%m%d-%H%M%S')}-{self.mode}"
+        if self.scope:
+            name += f"-{self.scope}"
+        path = os.path.join(directory, name + '.txt')
+        if self._profile is not None:
+            self._profile.dump_stats(os.path.join(directory, name + '.prof'))
+            out = io.StringIO()
+            try:
+                stats = pstats.Stats(self._profile, stream=out)
+            except TypeError:  # профиль пуст: scope ни разу не вызывался
+                out.write("No calls recorded\n")
+                top = []
+            else:
+                stats.sort_stats('cumulative').print_stats(80)
+                stats.sort_stats('tottime').print_stats(40)
+                rows = sorted(stats.stats.items(), key=lambda item: -item[1][2])
+                top = [(f"{func[2]} ({os.path.basename(func[0])}:{func[1]})", tottime * 1000)
+                       for func, (_, _, tottime, _, _) in rows[:5]]
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(out.getvalue())
+            summary = [f"{fn}: {ms:.0f} мс" for fn, ms in top] or ["нет вызовов"]
+        else:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.writelines(f"{stack} {n}\n" for stack, n in self.samples.most_common())
+            # «собственное» время: в каких функциях стек заканчивался
+            total = sum(self.samples.values())
+            leaves: Counter[str] = Counter()
+            for stack, n in self.samples.items():
+                leaves[stack.rsplit(';', 1)[-1]] += n
+            summary = [f"{fn}: {n * 100 / total:.0f}%" for fn, n in leaves.most_common(5)] or ["нет выборок"]
+        return path, '\n'.join(summary)
+
+
+class Profiler:
+    """
+    Не больше одной сессии за раз. wrap() — обёртка обработчика: без
+    сессии она только проверяет, что session is None.
+    """
+
+    def __init__(self, interval: float = 0.005, max_seconds: float = 600.0):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.session: ProfileSession | None = None
+
+    def start(self, mode: str, scope: str | None = None, seconds: float | None = None,
+              updates: int | None = None) -> ProfileSession:
+        if self.session is not None:
+            raise RuntimeError("profiling is already running")
+        if mode not in MODES:
+            raise ValueError(f"unknown profiling mode {mode!r}")
+        self.session = ProfileSession(mode, scope, seconds, updates, self.interval)
+        self.session.begin()
+        logger.info("Profiling started: %s, scope %s, %s", mode, scope or 'all',
+                    f"{seconds:.0f} s" if seconds else f"{updates} updates")
+        return self.session
+
+    async def run(self, session: ProfileSession) -> None:
+        """Ждёт конца сессии (время, апдейты или stop()) и выключает профилирование."""
+        timeout = min(session.seconds or self.max_seconds, self.max_seconds)
+        try:
+            await asyncio.wait_for(session.done.wait(), timeout)
+        except TimeoutError:
+            pass
+        finally:
+            session.finish()
+            self.session = None
+            logger.info("Profiling finished: %.1f s, %d updates", session.elapsed, session.calls)
+
+    def wrap(self, name: str, callback):
+        """Async-обработчик, который при активной сессии попадает в её scope."""
+        @functools.wraps(callback)
+        async def wrapper(*args, **kwargs):
+            session = self.session
+            if session is None:
+                return await callback(*args, **kwargs)
+            with session.track(name):
+                return await callback(*args, **kwargs)
+        return wrapper
@@ -0,0 +1,108 @@
+"""
+Маршрутизация callback-кнопок.
+
+callback_data имеет вид «имя» или «префикс:арг1:арг2». Точные имена ищутся
+в одном словаре, префиксные — во втором по части до первого «:», так что
+поиск маршрута не зависит от их количества. Аргументы разбираются один раз
+кодеком маршрута и передаются обработчику уже типизированными.
+"""
+import logging
+from collections import Counter
+from collections.abc import Awaitable, Callable
+
+logger = logging.getLogger(__name__)
+
+SEP = ':'
+MAX_CALLBACK_BYTES = 64  # ограничение Telegram на callback_data
+
+Handler = Callable[..., Awaitable]
+
+
+def pack(prefix: str, *args) -> str:
+    """Собирает callback_data: pack('test_step', 3, 'start') -> 'test_step:3:start'."""
+    data = SEP.join((prefix, *map(str, args)))
+    if len(data.encode('utf-8')) > MAX_CALLBACK_BYTES:
+        raise ValueError(f"callback_data too long: {data!r}")
+    return data
+
+
+def unpack(data: str) -> tuple[str, list[str]]:
+    """'test_step:3:start' -> ('test_step', ['3', 'start'])."""
+    prefix, *args = data.split(SEP)
+    return prefix, args
+
+
+def step_action(value: str) -> int | str:
+    """Действие мини-теста: 'start' или номер варианта."""
+    return value if value == 'start' else int(value)
+
+
+class CallbackRouter:
+    """
+    Таблица маршрутов: точные callback_data и префиксы с типами аргументов.
+
+    Обработчик вызывается как handler(update, context, *args). hits считает
+    попадания по маршрутам (ключ — имя или префикс), misses — нераспознанные
+    callback_data.
+    """
+
+    def __init__(self):
+        self._exact: dict[str, Handler] = {}
+        self._prefix: dict[str, tuple[Handler, tuple]] = {}
+        self.hits: Counter = Counter()
+        self.misses = 0
+
+    def exact(self, *names: str, handler: Handler) -> None:
+        for name in names:
+            self._exact[name] = handler
+
+    def prefix(self, prefix: str, handler: Handler, *types: Callable) -> None:
+        """Маршрут «prefix:...»; types — конвертеры аргументов по порядку."""
+        self._prefix[prefix] = (handler, types)
+
+    def resolve(self, data: str) -> tuple[str, Handler, tuple] | None:
+        """(маршрут, обработчик, аргументы) или None, если ничего не подошло."""
+        handler = self._exact.get(data)
+        if handler is not None:
+            return data, handler, ()
+        prefix, raw = unpack(data)
+        route = self._prefix.get(prefix)
+        if route is None:
+            return None
+        handler, types = route
+        if len(raw) != len(types):
+            return None
+        try:
+            args = tuple(conv(value) for conv, value in zip(types, raw))
+        except ValueError:
+            return None
+        return prefix, handler, args
+
+    async def dispatch(self, update, context, around=None) -> bool:
+        """
+        Вызывает обработчик для update.callback_query.data; False — маршрута нет.
+
+        around(route, update) — необязательная фабрика async-контекста, внутри
+        которого выполняется обработчик (например, пачка ответов).
+        """
+        data = update.callback_query.data or ''
+        resolved = self.resolve(data)
+        if resolved is None:
+            self.misses += 1
+            logger.warning("No route for callback_data=%r", data)
+            return False
+        route, handler, args = resolved
+        self.hits[route] += 1
+        if around is None:
+            await handler(update, context, *args)
+        else:
+            async with around(route, update):
+                await handler(update, context, *args)
+        return True
+
+    def names(self) -> set[str]:
+        """Имена маршрутов — как в hits и в метриках."""
+        return set(self._exact) | set(self._prefix)
+
+    def top(self, n: int = 10) -> list[tuple[str, int]]:
+        return self.hits.most_common(n)
@@ -0,0 +1,563 @@
+"""
+Шардированный запуск бота на несколько ядер.
+
+    python shards.py              # фронт + SHARDS воркеров
+    python shards.py --reshard    # только переложить данные под SHARDS и выйти
+    python shards.py --unshard    # вернуть данные в файлы обычного bot.py
+
+Фронт получает апдейты (polling или вебхук — по BOT_MODE, как bot.py),
+по стабильному хешу id пользователя выбирает шард и пересылает апдейт
+его воркеру. Воркер — обычный bot.py в режиме вебхука на
+127.0.0.1:SHARD_PORT + номер; прогресс, вопросы админам и кэш
+сертификатов он держит в своей папке SHARD_DIR/<номер>/. Фронт не
+разбирает апдейты в объекты PTB и не трогает состояние пользователей,
+так что вся работа с ними — в воркерах.
+
+Число шардов записано в SHARD_DIR/map.json: пока оно не меняется,
+пользователь после перезапуска попадает в тот же шард. Если SHARDS в
+config.py изменили, фронт перед запуском воркеров перекладывает данные;
+при первом запуске — забирает прежние файлы bot.py (они остаются рядом
+с суффиксом .pre-shards). Упавший воркер перезапускается, его апдейты
+ждут у фронта в очереди. /shards от админа — нагрузка по шардам.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import secrets
+import shutil
+import signal
+import sys
+import time
+import warnings
+import zlib
+from collections import deque
+from itertools import islice
+
+import config
+from config import ADMIN_CHAT_ID, TOKEN
+from telegram import Bot, Update
+from telegram.error import TelegramError
+from telegram.warnings import PTBUserWarning
+
+from outbox import AdminOutbox
+from storage import open_store
+from webhook import SECRET_HEADER, HttpClient, HttpServer, Request, Response
+
+logger = logging.getLogger(__name__)
+
+ADMINS = getattr(config, 'ADMINS', [ADMIN_CHAT_ID])
+SHARDS = getattr(config, 'SHARDS', 1)
+SHARD_DIR = getattr(config, 'SHARD_DIR', 'shards')
+SHARD_PORT = getattr(config, 'SHARD_PORT', 8100)              # воркер i слушает SHARD_PORT + i
+SHARD_QUEUE_SIZE = getattr(config, 'SHARD_QUEUE_SIZE', 1000)  # апдейтов на шард ждут у фронта
+SHARD_BATCH = getattr(config, 'SHARD_BATCH', 50)              # апдейтов в одной пересылке
+BOT_API_URL = getattr(config, 'BOT_API_URL', None)
+BOT_MODE = getattr(config, 'BOT_MODE', 'polling')
+WEBHOOK_URL = getattr(config, 'WEBHOOK_URL', None)
+WEBHOOK_SECRET = getattr(config, 'WEBHOOK_SECRET', None)
+WEBHOOK_LISTEN = getattr(config, 'WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = getattr(config, 'WEBHOOK_PORT', 8080)
+WEBHOOK_PATH = getattr(config, 'WEBHOOK_PATH', '/telegram')
+WEBHOOK_MAX_CONNECTIONS = getattr(config, 'WEBHOOK_MAX_CONNECTIONS', 40)
+POLL_TIMEOUT = 30
+
+# Файлы, которые переезжают между шардами (имена — как в bot.py)
+PROGRESS_BACKEND = getattr(config, 'PROGRESS_BACKEND', 'json')
+PROGRESS_DB = getattr(config, 'PROGRESS_DB', 'progress.db')
+PROGRESS_FILES = ('progress.json', 'progress.journal', PROGRESS_DB)
+ADMIN_OUTBOX_FILE = getattr(config, 'ADMIN_OUTBOX_FILE', 'admin_outbox.jsonl')
+DATA_FILES = (*PROGRESS_FILES, ADMIN_OUTBOX_FILE)
+# Спутники хранилищ: повёрнутый журнал JournalStore и WAL SQLite. Хранилище
+# само читает их при открытии, поэтому они переезжают вместе с основными
+# файлами — иначе после --unshard bot.py доиграл бы устаревший журнал
+SIDE_FILES = ('progress.journal.old', PROGRESS_DB + '-wal', PROGRESS_DB + '-shm')
+MOVED_FILES = (*DATA_FILES, *SIDE_FILES)
+
+MAP_FILE = 'map.json'
+STATS_PATH = '/shard'  # GET у воркера — его метрики для /shards
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+
+# getUpdates читается сырым JSON через do_api_request, без разбора в Update
+warnings.filterwarnings('ignore', message="Please use 'Bot.get_updates'", category=PTBUserWarning)
+
+
+# --- Распределение пользователей ---
+def shard_of(uid: int | str, count: int) -> int:
+    """Шард пользователя: crc32 от id (hash() строк меняется от запуска к запуску)."""
+    return zlib.crc32(str(uid).encode()) % count
+
+
+def update_user_id(data: dict) -> int | None:
+    """id пользователя в сыром апдейте — как Update.effective_user, но без разбора JSON в объекты."""
+    for key, value in data.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        user = value.get('from') or value.get('user')
+        if isinstance(user, dict) and 'id' in user:
+            return user['id']
+        chat = value.get('chat')
+        if isinstance(chat, dict) and 'id' in chat:
+            return chat['id']
+    return None
+
+
+def shard_path(index: int, name: str, base: str = SHARD_DIR) -> str:
+    return os.path.join(base, str(index), os.path.basename(name))
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# --- Раскладка данных по шардам ---
+def stored_count(base: str = SHARD_DIR) -> int | None:
+    """Число шардов по map.json; None — данные лежат в файлах обычного bot.py."""
+    path = os.path.join(base, MAP_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)['count']
+
+
+def _write_map(base: str, count: int) -> None:
+    tmp = os.path.join(base, MAP_FILE + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'count': count, 'hash': 'crc32', 'created': time.time()}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, os.path.join(base, MAP_FILE))
+
+
+def _files(count: int | None) -> list[list[str]]:
+    """Пути DATA_FILES по шардам; для count=None — один «шард» из файлов bot.py."""
+    if count is None:
+        return [list(DATA_FILES)]
+    return [[shard_path(i, name) for name in DATA_FILES] for i in range(count)]
+
+
+def _layout(count: int | None) -> str:
+    return f"{count} shards" if count else 'unsharded'
+
+
+def reshard(count: int | None) -> int:
+    """
+    Перекладывает прогресс и недоставленные вопросы из текущей раскладки в
+    count шардов (None — обратно в файлы bot.py); возвращает число пользователей.
+
+    Новая раскладка собирается в SHARD_DIR.new, и запись туда map.json —
+    точка фиксации: после неё прерванное перешардирование доводится до
+    конца при следующем запуске (_finish), до неё — начинается заново.
+    """
+    staging = SHARD_DIR + '.new'
+    _recover()
+    old = stored_count()
+    if old == count:
+        return 0
+    if count is None and any(os.path.exists(name) for name in MOVED_FILES):
+        raise RuntimeError(f"{', '.join(n for n in MOVED_FILES if os.path.exists(n))} already exist, "
+                           f"move them away before --unshard")
+
+    records, questions = {}, []
+    for paths in _files(old):
+        store = open_store(PROGRESS_BACKEND, *paths[:3])
+        try:
+            records.update(store.load())
+        finally:
+            store.close()
+        outbox = AdminOutbox(paths[3])
+        outbox.load()
+        questions += outbox.questions()
+
+    shutil.rmtree(staging, ignore_errors=True)
+    for index in range(count or 1):
+        os.makedirs(os.path.join(staging, str(index)))
+        own = {uid: rec for uid, rec in records.items() if shard_of(uid, count or 1) == index}
+        store = open_store(PROGRESS_BACKEND, *(shard_path(index, name, staging) for name in PROGRESS_FILES))
+        try:
+            store.put_many([(uid, rec.to_row()) for uid, rec in own.items()])
+            store.compact()
+        finally:
+            store.close()
+        mine = sorted((q for q in questions if shard_of(q['u'], count or 1) == index), key=lambda q: q['ts'])
+        if mine:
+            AdminOutbox(shard_path(index, ADMIN_OUTBOX_FILE, staging)).import_questions(mine)
+    _write_map(staging, count or 0)
+    _finish()
+    logger.info("Resharded %d users and %d questions: %s -> %s",
+                len(records), len(questions), _layout(old), _layout(count))
+    return len(records)
+
+
+def _finish() -> None:
+    """Меняет рабочие данные на собранные в SHARD_DIR.new (повторный вызов безопасен)."""
+    staging, retired = SHARD_DIR + '.new', SHARD_DIR + '.old'
+    count = stored_count(staging)
+    if os.path.exists(SHARD_DIR):
+        os.replace(SHARD_DIR, retired)
+    if count:
+        # файлы bot.py до шардирования остаются рядом как резервная копия
+        for name in MOVED_FILES:
+            if os.path.exists(name):
+                os.replace(name, name + '.pre-shards')
+        os.replace(staging, SHARD_DIR)
+    else:
+        for name in MOVED_FILES:
+            if os.path.exists(shard_path(0, name, staging)):
+                os.replace(shard_path(0, name, staging), name)
+        shutil.rmtree(staging)
+    shutil.rmtree(retired, ignore_errors=True)
+
+
+def _recover() -> None:
+    """Последствия прерванного перешардирования: доводим или откатываем."""
+    staging, retired = SHARD_DIR + '.new', SHARD_DIR + '.old'
+    if stored_count(staging) is not None:
+        logger.warning("Finishing interrupted resharding")
+        _finish()
+        return
+    shutil.rmtree(staging, ignore_errors=True)
+    if os.path.exists(retired):
+        if os.path.exists(SHARD_DIR):
+            shutil.rmtree(retired)
+        else:
+            os.replace(retired, SHARD_DIR)
+
+
+# --- Фронт ---
+class Worker:
+    """Процесс-воркер одного шарда и очередь апдейтов для него у фронта."""
+
+    def __init__(self, index: int, secret: str):
+        self.index = index
+        self.port = SHARD_PORT + index
+        self.secret = secret
+        self.queue: deque[bytes] = deque()
+        self.client = HttpClient('127.0.0.1', self.port)
+        self.process: asyncio.subprocess.Process | None = None
+        self.started = 0.0
+        self.restarts = 0
+        self.forwarded = 0
+        self.retries = 0
+        self._wakeup = asyncio.Event()
+        self._tasks: list[asyncio.Task] = []
+        self._stopping = False
+        self._reported = (time.monotonic(), 0)  # для скорости в /shards
+
+    def push(self, body: bytes) -> None:
+        self.queue.append(body)
+        self._wakeup.set()
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._supervise()), asyncio.create_task(self._forward())]
+
+    async def _spawn(self) -> None:
+        env = dict(os.environ, BOT_SHARD=str(self.index), BOT_SHARD_SECRET=self.secret)
+        # своя сессия: Ctrl+C в терминале достаётся только фронту, воркеров гасит он сам
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, WORKER_SCRIPT, env=env, start_new_session=True)
+        self.started = time.monotonic()
+        logger.info("Shard %d: worker pid %d on port %d", self.index, self.process.pid, self.port)
+
+    async def _supervise(self) -> None:
+        pause = 1.0
+        while not self._stopping:
+            await self._spawn()
+            code = await self.process.wait()
+            if self._stopping:
+                break
+            self.restarts += 1
+            # упал сразу после старта — ждём дольше, чтобы не крутиться впустую
+            pause = 1.0 if time.monotonic() - self.started > 60 else min(pause * 2, 60.0)
+            logger.error("Shard %d: worker exited with code %s, restart in %.0f s", self.index, code, pause)
+            await asyncio.sleep(pause)
+
+    async def _forward(self) -> None:
+        """Пересылает очередь пачками по порядку; пачка уходит из очереди только после 200."""
+        headers = {SECRET_HEADER: self.secret, 'Content-Type': 'application/json'}
+        pause = 0.05
+        while True:
+            if not self.queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            batch = list(islice(self.queue, SHARD_BATCH))
+            try:
+                response = await self.client.request(
+                    'POST', WEBHOOK_PATH, b'[' + b','.join(batch) + b']', headers)
+                status = response.status
+            except (TimeoutError, OSError):
+                status = None  # воркер ещё стартует или перезапускается
+            if status == 200:
+                for _ in batch:
+                    self.queue.popleft()
+                self.forwarded += len(batch)
+                pause = 0.05
+                continue
+            if status != 503 and status is not None:
+                logger.error("Shard %d: worker answered %s, retrying", self.index, status)
+            self.retries += 1
+            await asyncio.sleep(pause)
+            pause = min(pause * 2, 2.0)
+
+    async def stats(self) -> dict | None:
+        client = HttpClient('127.0.0.1', self.port, timeout=2.0)
+        try:
+            response = await client.request('GET', STATS_PATH)
+        except (TimeoutError, OSError):
+            return None
+        finally:
+            client.close()
+        return json.loads(response.body) if response.status == 200 else None
+
+    async def drain(self, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        while self.queue and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.queue:
+            logger.warning("Shard %d: %d updates dropped on shutdown", self.index, len(self.queue))
+
+    async def stop(self, timeout: float = 60.0) -> None:
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self.client.close()
+        if self.process is None or self.process.returncode is not None:
+            return
+        # воркер дописывает прогресс и очередь вопросов сам, по SIGTERM
+        self.process.terminate()
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except TimeoutError:
+            logger.error("Shard %d: worker did not stop in %.0f s, killing", self.index, timeout)
+            self.process.kill()
+            await self.process.wait()
+
+
+class ShardFront:
+    """Маршрутизация апдейтов по воркерам и команда /shards."""
+
+    def __init__(self, bot: Bot, count: int, queue_size: int = SHARD_QUEUE_SIZE):
+        self.bot = bot
+        self.queue_size = queue_size
+        secret = secrets.token_urlsafe(32)  # общий с воркерами, только на этот запуск
+        self.workers = [Worker(i, secret) for i in range(count)]
+        self.started = time.monotonic()
+        # метрики
+        self.routed = 0
+        self.rejected = 0
+        self.forbidden = 0
+        self.invalid = 0
+        self._tasks: set[asyncio.Task] = set()  # ответы на /shards
+
+    def start(self) -> None:
+        for worker in self.workers:
+            worker.start()
+
+    def backlogged(self) -> bool:
+        return any(len(w.queue) >= self.queue_size for w in self.workers)
+
+    def route(self, data: dict, body: bytes | None = None, force: bool = False) -> bool:
+        """Ставит апдейт в очередь его шарда; False — очередь полна (кроме force)."""
+        if self._shards_command(data):
+            return True
+        uid = update_user_id(data)
+        worker = self.workers[shard_of(uid, len(self.workers)) if uid is not None else 0]
+        if not force and len(worker.queue) >= self.queue_size:
+            self.rejected += 1
+            return False
+        worker.push(body or json.dumps(data, separators=(',', ':')).encode())
+        self.routed += 1
+        return True
+
+    async def handle(self, request: Request) -> Response:
+        """POST от Telegram в режиме вебхука."""
+        if not secrets.compare_digest(request.headers.get(SECRET_HEADER, '').encode(),
+                                      (WEBHOOK_SECRET or '').encode()):
+            self.forbidden += 1
+            return Response(403)
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            self.invalid += 1
+            return Response(400)
+        if not self.route(data, request.body):
+            return Response(503, headers=(('Retry-After', '1'),))
+        return Response(200)
+
+    async def poll(self) -> None:
+        """Long polling: следующий getUpdates — только когда очереди шардов разгрузились."""
+        offset = None
+        try:
+            while True:
+                while self.backlogged():
+                    await asyncio.sleep(0.05)
+                kwargs = {'timeout': POLL_TIMEOUT, 'allowed_updates': Update.ALL_TYPES}
+                if offset is not None:
+                    kwargs['offset'] = offset
+                try:
+                    updates = await self.bot.do_api_request(
+                        'get_updates', api_kwargs=kwargs, read_timeout=POLL_TIMEOUT + 10)
+                except TelegramError as e:
+                    logger.warning("getUpdates failed: %s", e)
+                    await asyncio.sleep(1)
+                    continue
+                for data in updates:
+                    offset = data['update_id'] + 1
+                    self.route(data, force=True)
+        finally:
+            if offset is not None:
+                # подтверждаем разосланные апдейты, иначе Telegram пришлёт их снова
+                try:
+                    await self.bot.do_api_request(
+                        'get_updates', api_kwargs={'offset': offset, 'timeout': 0, 'limit': 1})
+                except TelegramError as e:
+                    logger.warning("Could not confirm last updates: %s", e)
+
+    # --- /shards ---
+    def _shards_command(self, data: dict) -> bool:
+        message = data.get('message')
+        if not isinstance(message, dict) or not message.get('text', '').startswith('/shards'):
+            return False
+        if message['text'].split()[0].split('@')[0] != '/shards':
+            return False
+        if message.get('from', {}).get('id') not in ADMINS:
+            return False
+        task = asyncio.create_task(self._report(message['chat']['id']))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return True
+
+    async def _report(self, chat_id: int) -> None:
+        try:
+            stats = await asyncio.gather(*(w.stats() for w in self.workers))
+            await self.bot.send_message(chat_id, self.report_text(stats))
+        except Exception:
+            logger.exception("/shards failed")
+
+    def report_text(self, stats: list[dict | None]) -> str:
+        now = time.monotonic()
+        lines = [(f"📊 Шардов: {len(self.workers)}, фронт работает {_duration(now - self.started)}; "
+                  f"апдейтов {self.routed}, отказов 503: {self.rejected}")]
+        for worker, s in zip(self.workers, stats):
+            since, count = worker._reported
+            worker._reported = (now, worker.forwarded)
+            rate = (worker.forwarded - count) / max(now - since, 1e-9)
+            head = f"#{worker.index}: апдейтов {worker.forwarded} ({rate:.1f}/с), в очереди {len(worker.queue)}"
+            if worker.restarts:
+                head += f", перезапусков {worker.restarts}"
+            if s is None:
+                lines.append(f"{head}\n   ❌ воркер не отвечает")
+                continue
+            ingest = s['ingest']
+            lines.append(
+                f"{head}\n   pid {s['pid']}, работает {_duration(now - worker.started)}, "
+                f"пользователей в памяти {s['users']}, пик RSS {s['peak_rss_mb']:.0f} МБ\n"
+                f"   обработка p50 {ingest['p50_ms']} мс, p99 {ingest['p99_ms']} мс, "
+                f"ждут {ingest['queued'] + ingest['inflight']}, исходящих в очереди {s['outbound_queued']}"
+            )
+        return '\n'.join(lines)
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Досылает очереди воркерам (не дольше timeout) и гасит их."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await asyncio.gather(*(w.drain(timeout) for w in self.workers))
+        await asyncio.gather(*(w.stop() for w in self.workers))
+
+    def metrics(self) -> dict:
+        return {
+            'routed': self.routed,
+            'rejected': self.rejected,
+            'forbidden': self.forbidden,
+            'invalid': self.invalid,
+            'queued': [len(w.queue) for w in self.workers],
+            'forwarded': [w.forwarded for w in self.workers],
+            'restarts': [w.restarts for w in self.workers],
+        }
+
+
+def _duration(seconds: float) -> str:
+    minutes = int(seconds // 60)
+    return f"{minutes // 60} ч {minutes % 60:02d} мин" if minutes >= 60 else f"{minutes} мин"
+
+
+async def watch_parent(stop: asyncio.Event, interval: float = 1.0) -> None:
+    """В воркере: останавливает его, если фронт умер, не успев погасить воркеров."""
+    parent = os.getppid()
+    while not stop.is_set():
+        await asyncio.sleep(interval)
+        if os.getppid() != parent:
+            logger.error("Shard front (pid %d) is gone, stopping", parent)
+            stop.set()
+
+
+def api_urls() -> dict:
+    """base_url/base_file_url для своего сервера Bot API (BOT_API_URL)."""
+    if not BOT_API_URL:
+        return {}
+    return {'base_url': f"{BOT_API_URL}/bot", 'base_file_url': f"{BOT_API_URL}/file/bot"}
+
+
+async def run_front(stop: asyncio.Event | None = None) -> None:
+    if stop is None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+
+    bot = Bot(TOKEN, **api_urls())
+    await bot.initialize()
+    front = ShardFront(bot, SHARDS)
+    front.start()
+    server = poller = None
+    try:
+        if BOT_MODE == 'webhook':
+            server = HttpServer(WEBHOOK_LISTEN, WEBHOOK_PORT)
+            server.route('POST', WEBHOOK_PATH, front.handle)
+            await server.start()
+            if WEBHOOK_URL:
+                await bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+                                      max_connections=WEBHOOK_MAX_CONNECTIONS,
+                                      allowed_updates=Update.ALL_TYPES)
+        else:
+            await bot.delete_webhook()
+            poller = asyncio.create_task(front.poll())
+        logger.info("Shard front: %s mode, %d workers", BOT_MODE, SHARDS)
+        await stop.wait()
+    finally:
+        if server is not None:
+            await server.stop()
+        if poller is not None:
+            poller.cancel()
+            await asyncio.gather(poller, return_exceptions=True)
+        await front.stop()
+        logger.info("Shard front: %s", front.metrics())
+        await bot.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bot as a front process and SHARDS workers")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--reshard', action='store_true', help="only move the data to SHARDS shards")
+    group.add_argument('--unshard', action='store_true', help="move the data back to plain bot.py files")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - front - %(name)s - %(levelname)s - %(message)s",
+                        level=logging.INFO)
+    if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+        sys.exit("❌ BOT_MODE = 'webhook' requires WEBHOOK_SECRET in config.py")
+    reshard(None if args.unshard else SHARDS)
+    if args.reshard or args.unshard:
+        return
+    asyncio.run(run_front())
+
+
+if __name__ == '__main__':
+    main()
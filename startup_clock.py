@@ -0,0 +1,10 @@
+"""
+Отметка начала старта бота.
+
+bot.py импортирует этот модуль первым, поэтому STARTED — perf_counter()
+до импорта telegram, fpdf и модулей бота: от него считаются время импорта
+в startup_times, итог старта и аптайм.
+"""
+import time
+
+STARTED = time.perf_counter()
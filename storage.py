@@ -0,0 +1,643 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class UserRecord:
+    """
+    Всё состояние одного пользователя в одном объекте со __slots__.
+
+    На диск попадают только step, final_passed, completion_date и lang —
+    компактной строкой [step, 0/1, дата, язык]. Остальное (курсор и баллы
+    финального теста, чего ждём от пользователя, deep-link параметр)
+    живёт только в памяти.
+    """
+
+    __slots__ = (
+        'awaiting', 'completion_date', 'final_passed', 'final_q', 'final_score',
+        'final_started', 'lang', 'start_param', 'step',
+    )
+
+    def __init__(self, step: int = 1, final_passed: bool = False,
+                 completion_date: str | None = None, lang: str = 'ru'):
+        self.step = step
+        self.final_passed = final_passed
+        self.completion_date = completion_date
+        self.lang = lang
+        self.final_q = None       # номер текущего вопроса финального теста или None
+        self.final_score = 0
+        self.final_started = 0.0  # time.monotonic() начала финального теста
+        self.awaiting = None      # None, 'name' или 'question'
+        self.start_param = None
+
+    def to_row(self) -> list:
+        return [self.step, int(self.final_passed), self.completion_date, self.lang]
+
+    @classmethod
+    def from_row(cls, row) -> 'UserRecord':
+        """Из компактной строки или из старого формата {'step': ..., 'final_passed': ...}."""
+        if isinstance(row, dict):
+            return cls(row.get('step', 1), bool(row.get('final_passed')),
+                       row.get('completion_date'), row.get('lang', 'ru'))
+        return cls(row[0], bool(row[1]), row[2], row[3])
+
+    def start_final(self) -> None:
+        self.final_q = 0
+        self.final_score = 0
+        self.final_started = time.monotonic()
+
+    def final_active(self, ttl: float | None = None) -> bool:
+        """Идёт ли финальный тест (брошенный дольше ttl секунд назад считается завершённым)."""
+        if self.final_q is None:
+            return False
+        if ttl is not None and time.monotonic() - self.final_started > ttl:
+            self.final_q = None
+            return False
+        return True
+
+    def in_flow(self) -> bool:
+        """Есть ли состояние только в памяти: ждём имя или вопрос, идёт финальный тест, не разобран deep link."""
+        return self.awaiting is not None or self.final_q is not None or self.start_param is not None
+
+    def __repr__(self) -> str:
+        return f"UserRecord({self.to_row()!r})"
+
+
+class LRUCache:
+    """
+    Словарь с ограничением по числу записей и времени простоя.
+
+    Чтение обновляет запись (она становится самой свежей); при переполнении
+    вытесняются самые давно использованные, а записи старше ttl секунд
+    считаются отсутствующими и удаляются при обращении или в sweep().
+    capacity=None или ttl=None отключают соответствующее ограничение.
+    Записи, для которых pinned(value) истинно, переполнение не вытесняет
+    (кэш тогда временно больше capacity); ttl действует и на них.
+    """
+
+    def __init__(self, capacity: int | None = None, ttl: float | None = None,
+                 pinned: Callable[[object], bool] | None = None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.pinned = pinned
+        self._data: OrderedDict = OrderedDict()
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value) -> None:
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        if self.capacity is not None and len(self._data) > self.capacity:
+            self._evict(len(self._data) - self.capacity)
+
+    def _evict(self, excess: int) -> None:
+        """Вытесняет excess самых давних записей, пропуская закреплённые."""
+        victims = []
+        for key, (value, _) in self._data.items():
+            if len(victims) == excess:
+                break
+            if self.pinned is None or not self.pinned(value):
+                victims.append(key)
+        for key in victims:
+            del self._data[key]
+        self.evictions += len(victims)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        now = time.monotonic()
+        if self.ttl is not None and now - item[1] > self.ttl:
+            del self._data[key]
+            self.evictions += 1
+            return default
+        self._data[key] = (item[0], now)
+        self._data.move_to_end(key)
+        return item[0]
+
+    def setdefault(self, key, default):
+        value = self.get(key)
+        if value is None:
+            self[key] = value = default
+        return value
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def sweep(self) -> int:
+        """Удаляет записи, простаивающие дольше ttl; возвращает их число."""
+        if self.ttl is None:
+            return 0
+        deadline = time.monotonic() - self.ttl
+        removed = 0
+        while self._data:
+            key, (_, touched) = next(iter(self._data.items()))
+            if touched > deadline:
+                break
+            del self._data[key]
+            removed += 1
+        self.evictions += removed
+        return removed
+
+
+class ProgressStore:
+    """
+    Интерфейс хранилища прогресса.
+
+    Хранилища принимают и отдают UserRecord, а на диске держат его
+    компактную строку to_row(). get() достаёт одного пользователя, так
+    что при старте ничего не читается целиком и в памяти бота остаются
+    только недавно активные; load() — все записи разом (миграция,
+    перешардирование, проверки).
+    """
+
+    def load(self) -> dict:
+        """Все записи {uid: UserRecord}."""
+        raise NotImplementedError
+
+    def get(self, uid: str) -> UserRecord | None:
+        """Запись одного пользователя или None."""
+        raise NotImplementedError
+
+    def put(self, uid: str, row: list | None) -> None:
+        """Сохраняет строку to_row() одного пользователя (None — удаление)."""
+        self.put_many([(uid, row)])
+
+    def put_many(self, rows: list[tuple[str, list | None]]) -> None:
+        raise NotImplementedError
+
+    def compact(self) -> None:
+        """Периодическое обслуживание; по умолчанию ничего не делает."""
+
+    def close(self) -> None:
+        pass
+
+
+class JournalStore(ProgressStore):
+    """
+    Прогресс пользователей: снимок + журнал изменений, оба в JSON Lines.
+
+    Каждое изменение одного пользователя дописывается в журнал короткой
+    строкой {"u": uid, "r": запись}, поэтому стоимость записи зависит от
+    размера изменения, а не от числа пользователей. Снимок — такие же
+    строки, отсортированные по uid: get() находит пользователя двоичным
+    поиском по файлу, не читая его целиком. Изменения, ещё не свёрнутые в
+    снимок, держатся в памяти — их столько, сколько пользователей
+    поменялось между сворачиваниями. compact() сливает старый снимок с
+    отложенным журналом строка за строкой и подменяет снимок атомарным
+    os.replace().
+
+    Записи в журнале — полное состояние пользователя, а не дельты, так что
+    повторное проигрывание одной и той же записи безопасно. Снимок старого
+    формата (один JSON-объект {uid: запись}) переписывается при открытии.
+    """
+
+    def __init__(self, snapshot_path: str, journal_path: str | None = None, fsync: bool = False):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path or snapshot_path + '.journal'
+        # журнал, который сейчас сворачивается в снимок
+        self.rotated_path = self.journal_path + '.old'
+        self.fsync = fsync
+        self._journal = None
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        # записи журналов, которых ещё нет в снимке (None — удаление)
+        self._recent: dict[str, list | None] = {}   # текущий журнал
+        self._folding: dict[str, list | None] = {}  # отложенный журнал
+        self._upgrade_snapshot()
+        self._pending = 0  # записей в журнале с момента последнего снимка
+        for path, rows in ((self.rotated_path, self._folding), (self.journal_path, self._recent)):
+            self._pending += self._replay(path, rows)
+            self._seal(path)
+        if self._pending:
+            logger.info("Progress journal: %d records not yet in the snapshot", self._pending)
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    # --- Снимок ---
+    def _upgrade_snapshot(self) -> None:
+        """Переписывает снимок старого формата ({uid: запись}) в отсортированные строки."""
+        if not os.path.exists(self.snapshot_path):
+            return
+        with open(self.snapshot_path, encoding='utf-8') as f:
+            first = f.readline()
+        try:
+            entry = json.loads(first) if first.strip() else None
+        except ValueError:
+            entry = {}
+        if entry is None or 'u' in entry:
+            return
+        with open(self.snapshot_path, encoding='utf-8') as f:
+            rows = json.load(f)
+        self._write_snapshot(sorted(rows.items()))
+        logger.info("Progress snapshot %s converted to sorted JSON Lines (%d users)",
+                    self.snapshot_path, len(rows))
+
+    def _snapshot_rows(self):
+        """(uid, запись) из снимка по порядку uid."""
+        if not os.path.exists(self.snapshot_path):
+            return
+        with open(self.snapshot_path, encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                yield entry['u'], entry['r']
+
+    @staticmethod
+    def _line_at(f, pos: int) -> dict | None:
+        """Первая строка снимка, начинающаяся не раньше pos (None — конец файла)."""
+        f.seek(pos - 1 if pos else 0)
+        if pos:
+            f.readline()
+        line = f.readline()
+        return json.loads(line) if line.strip() else None
+
+    def _lookup(self, uid: str) -> list | None:
+        """Двоичный поиск по строкам снимка."""
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                lo, hi = 0, os.fstat(f.fileno()).st_size
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    entry = self._line_at(f, mid)
+                    if entry is not None and entry['u'] < uid:
+                        lo = mid + 1
+                    else:
+                        hi = mid
+                entry = self._line_at(f, lo)
+        except FileNotFoundError:
+            return None
+        return entry['r'] if entry is not None and entry['u'] == uid else None
+
+    def _folded(self, changes: dict):
+        """Строки снимка с изменениями поверх, по порядку uid; удалённые пропускаются."""
+        pending = sorted(changes.items())
+        i = 0
+        for uid, row in self._snapshot_rows():
+            while i < len(pending) and pending[i][0] < uid:
+                if pending[i][1] is not None:
+                    yield pending[i]
+                i += 1
+            if i < len(pending) and pending[i][0] == uid:
+                row = pending[i][1]
+                i += 1
+            if row is not None:
+                yield uid, row
+        yield from ((uid, row) for uid, row in pending[i:] if row is not None)
+
+    def _write_snapshot(self, rows) -> None:
+        tmp = self.snapshot_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps({'u': uid, 'r': row}, ensure_ascii=False, separators=(',', ':')) + '\n'
+                         for uid, row in rows)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_path)
+
+    # --- Журнал ---
+    def _replay(self, path: str, data: dict) -> int:
+        if not os.path.exists(path):
+            return 0
+        count = 0
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # недописанная строка после аварийного завершения
+                    logger.warning("Progress journal %s: skipped broken record", path)
+                    continue
+                data[entry['u']] = entry['r']
+                count += 1
+        return count
+
+    @staticmethod
+    def _seal(path: str) -> None:
+        """Закрывает оборванную строку, чтобы следующая запись не склеилась с ней."""
+        if not os.path.exists(path) or not os.path.getsize(path):
+            return
+        with open(path, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+
+    def load(self) -> dict:
+        """Снимок + недосвёрнутый журнал + текущий журнал."""
+        rows = dict(self._snapshot_rows())
+        with self._lock:
+            changes = {**self._folding, **self._recent}
+        for uid, row in changes.items():
+            if row is None:
+                rows.pop(uid, None)
+            else:
+                rows[uid] = row
+        return {uid: UserRecord.from_row(row) for uid, row in rows.items()}
+
+    def get(self, uid: str) -> UserRecord | None:
+        with self._lock:
+            for changes in (self._recent, self._folding):
+                if uid in changes:
+                    row = changes[uid]
+                    return UserRecord.from_row(row) if row is not None else None
+        # в снимке запись та же, что была до сворачивания, — читаем без блокировки
+        row = self._lookup(uid)
+        return UserRecord.from_row(row) if row is not None else None
+
+    def put_many(self, rows: list[tuple[str, list | None]]) -> None:
+        """Дописывает пачку записей в журнал одной операцией записи."""
+        if not rows:
+            return
+        lines = ''.join(
+            json.dumps({'u': uid, 'r': row}, ensure_ascii=False, separators=(',', ':')) + '\n'
+            for uid, row in rows
+        )
+        with self._lock:
+            if self._journal is None:
+                self._journal = open(self.journal_path, 'a', encoding='utf-8')  # noqa: SIM115 — держим открытым до close()
+            self._journal.write(lines)
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            self._recent.update(rows)
+            self._pending += len(rows)
+
+    def compact(self) -> None:
+        """
+        Сворачивает журнал в новый снимок.
+
+        Под блокировкой только откладывается текущий журнал (новые записи
+        пойдут в свежий файл); снимок и отложенный журнал читаются с диска
+        и сливаются уже без неё, так что put_many() и get() не ждут.
+        """
+        with self._compact_lock:
+            with self._lock:
+                if not self._pending and os.path.exists(self.snapshot_path):
+                    return
+                if self._journal is not None:
+                    self._journal.close()
+                    self._journal = None
+                if os.path.exists(self.rotated_path) and os.path.exists(self.journal_path):
+                    # прошлое сворачивание не завершилось — не теряем его записи
+                    with open(self.rotated_path, 'a', encoding='utf-8') as dst, \
+                            open(self.journal_path, encoding='utf-8') as src:
+                        dst.write(src.read())
+                    os.remove(self.journal_path)
+                elif os.path.exists(self.journal_path):
+                    os.replace(self.journal_path, self.rotated_path)
+                self._folding.update(self._recent)
+                self._recent = {}
+                self._pending = 0
+
+            changes = {}
+            self._replay(self.rotated_path, changes)
+            self._write_snapshot(self._folded(changes))
+            with self._lock:
+                self._folding = {}
+            if os.path.exists(self.rotated_path):
+                os.remove(self.rotated_path)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+
+class SqliteStore(ProgressStore):
+    """
+    Прогресс в SQLite: одна строка на пользователя, запись в компактном JSON.
+
+    WAL-журнал (чтение не ждёт записи), upsert по uid, постоянные тексты
+    запросов (sqlite3 кэширует подготовленные выражения) и пачки изменений
+    в одной транзакции.
+    """
+
+    _GET = "SELECT data FROM progress WHERE uid = ?"
+    _UPSERT = (
+        "INSERT INTO progress (uid, data, updated) VALUES (?, ?, ?) "
+        "ON CONFLICT(uid) DO UPDATE SET data = excluded.data, updated = excluded.updated"
+    )
+    _DELETE = "DELETE FROM progress WHERE uid = ?"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS progress ("
+            " uid TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+
+    def load(self) -> dict:
+        with self._lock:
+            rows = self._db.execute("SELECT uid, data FROM progress").fetchall()
+        return {uid: UserRecord.from_row(json.loads(data)) for uid, data in rows}
+
+    def get(self, uid: str) -> UserRecord | None:
+        with self._lock:
+            row = self._db.execute(self._GET, (uid,)).fetchone()
+        return UserRecord.from_row(json.loads(row[0])) if row else None
+
+    def put_many(self, rows: list[tuple[str, list | None]]) -> None:
+        if not rows:
+            return
+        now = time.time()
+        upserts = [
+            (uid, json.dumps(row, ensure_ascii=False, separators=(',', ':')), now)
+            for uid, row in rows if row is not None
+        ]
+        deletes = [(uid,) for uid, row in rows if row is None]
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                if upserts:
+                    self._db.executemany(self._UPSERT, upserts)
+                if deletes:
+                    self._db.executemany(self._DELETE, deletes)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def compact(self) -> None:
+        # переносим WAL в основной файл, чтобы он не рос без предела
+        with self._lock:
+            self._db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+def open_store(backend: str, json_path: str, journal_path: str, db_path: str) -> ProgressStore:
+    """Хранилище прогресса по имени бэкенда из конфига: 'json' или 'sqlite'."""
+    if backend == 'sqlite':
+        return SqliteStore(db_path)
+    if backend == 'json':
+        return JournalStore(json_path, journal_path)
+    raise ValueError(f"Unknown progress backend: {backend!r}")
+
+
+def migrate_json_to_sqlite(json_path: str, journal_path: str, db_path: str, batch: int = 5000) -> int:
+    """Переносит progress.json (с журналом) в SQLite; возвращает число записей."""
+    data = JournalStore(json_path, journal_path).load()
+    store = SqliteStore(db_path)
+    try:
+        rows = [(uid, rec.to_row()) for uid, rec in data.items()]
+        for i in range(0, len(rows), batch):
+            store.put_many(rows[i:i + batch])
+    finally:
+        store.close()
+    return len(data)
+
+
+class ProgressWriter:
+    """
+    Отложенная запись прогресса из event loop.
+
+    Хендлеры вызывают mark_dirty(uid, record) и сразу продолжают работу; одна
+    asyncio-задача собирает всплеск изменений и сбрасывает его в хранилище
+    одной пачкой — не позже max_latency секунд после первого изменения
+    или сразу, как только набралось max_batch пользователей.
+    Сама запись идёт в потоке, чтобы не блокировать loop.
+
+    Писатель держит ссылки на изменённые записи до сброса, поэтому
+    вытеснение пользователя из кэша в памяти не теряет его изменений.
+    on_flush(секунды, записей) вызывается после каждого удачного сброса.
+    """
+
+    def __init__(self, store, max_latency: float = 1.0, max_batch: int = 500,
+                 on_flush: Callable[[float, int], None] | None = None):
+        self.store = store
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self.on_flush = on_flush
+        self._dirty: dict[str, UserRecord | None] = {}
+        self._flushing: dict[str, UserRecord | None] = {}
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._flush_lock = asyncio.Lock()
+        # метрики
+        self.flushes = 0
+        self.flushed_records = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    @property
+    def pending(self) -> int:
+        """Сколько пользователей ждут записи."""
+        return len(self._dirty)
+
+    def get_pending(self, uid: str):
+        """
+        Несохранённая запись пользователя (или None).
+
+        Нужна, чтобы пользователь, вытесненный из кэша до сброса, не был
+        перечитан из хранилища в устаревшем виде.
+        """
+        if uid in self._dirty:
+            return self._dirty[uid]
+        return self._flushing.get(uid)
+
+    def mark_dirty(self, uid: str, record: UserRecord | None) -> None:
+        self._dirty[uid] = record
+        self._wakeup.set()
+        if len(self._dirty) >= self.max_batch:
+            self._full.set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.max_latency)
+            except TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Ошибка записи прогресса")
+                await asyncio.sleep(1)
+
+    async def flush(self) -> None:
+        """Сбрасывает всех грязных пользователей одной пачкой."""
+        async with self._flush_lock:
+            self._wakeup.clear()
+            self._full.clear()
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+            self._flushing = dirty
+            # копируем записи здесь, в потоке loop, пока их никто не меняет
+            records = [
+                (uid, rec.to_row() if rec is not None else None)
+                for uid, rec in dirty.items()
+            ]
+
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(self.store.put_many, records)
+            except Exception:
+                # вернём пользователей в очередь, чтобы не потерять изменения
+                for uid, rec in dirty.items():
+                    self._dirty.setdefault(uid, rec)
+                self._wakeup.set()
+                raise
+            finally:
+                self._flushing = {}
+            elapsed = (time.perf_counter() - started) * 1000
+            if self.on_flush is not None:
+                self.on_flush(elapsed / 1000, len(records))
+            self.flushes += 1
+            self.flushed_records += len(records)
+            self.last_flush_ms = elapsed
+            self.max_flush_ms = max(self.max_flush_ms, elapsed)
+            logger.debug("Progress flush: %d records in %.1f ms", len(records), elapsed)
+
+    async def stop(self) -> None:
+        """Останавливает задачу и сбрасывает всё, что осталось."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def metrics(self) -> dict:
+        return {
+            'pending_dirty': self.pending,
+            'flushes': self.flushes,
+            'flushed_records': self.flushed_records,
+            'last_flush_ms': round(self.last_flush_ms, 2),
+            'max_flush_ms': round(self.max_flush_ms, 2),
+        }
@@ -0,0 +1,65 @@
+"""
+Сравнение памяти на пользователя: старая раскладка состояния против UserRecord.
+
+    python tools/bench_memory.py [--users 100000]
+
+Старая раскладка — отдельные словари на пользователя: прогресс
+{'step', 'final_passed', 'completion_date'}, user_data PTB с языком и флагами
+ожидания, user_final во время финального теста. Новая — один UserRecord.
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import UserRecord
+
+
+def old_layout(n: int):
+    progress, ptb_user_data, user_final = {}, {}, {}
+    for i in range(n):
+        uid = str(i)
+        progress[uid] = {'step': i % 8 + 1, 'final_passed': i % 3 == 0,
+                         'completion_date': '01.01.2025' if i % 3 == 0 else None}
+        ptb_user_data[i] = {'lang': 'ru', 'awaiting_name': False, 'awaiting_question': False}
+        if i % 10 == 0:
+            user_final[uid] = {'q': 2, 'score': 2}
+    return progress, ptb_user_data, user_final
+
+
+def new_layout(n: int):
+    users = {}
+    for i in range(n):
+        user = UserRecord(i % 8 + 1, i % 3 == 0, '01.01.2025' if i % 3 == 0 else None, 'ru')
+        if i % 10 == 0:
+            user.start_final()
+        users[str(i)] = user
+    return users
+
+
+def measure(build, n: int) -> int:
+    tracemalloc.start()
+    data = build(n)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-user memory: dicts vs UserRecord")
+    parser.add_argument('--users', type=int, default=100000)
+    args = parser.parse_args()
+
+    old = measure(old_layout, args.users)
+    new = measure(new_layout, args.users)
+    print(f"users:       {args.users}")
+    print(f"old layout:  {old / 2**20:8.1f} MiB  ({old / args.users:.0f} B/user)")
+    print(f"UserRecord:  {new / 2**20:8.1f} MiB  ({new / args.users:.0f} B/user)")
+    print(f"saved:       {(1 - new / old) * 100:.0f}%")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+"""
+Сквозная проверка шардированного запуска (shards.py) на настоящих процессах.
+
+    python tools/bench_shards.py [--shards 2] [--users 300] [--connections 40]
+                                 [--backend json|sqlite] [--course full_course_data.json]
+
+Во временной папке пишется config.py, поднимается поддельный сервер Bot
+API (tools/fake_telegram.py, BOT_API_URL) и запускается python shards.py
+в режиме вебхука: фронт и --shards воркеров. Пользователи проходят курс,
+посылая апдейты во фронт по HTTP, админ запрашивает /shards. Печатает
+апдейты в секунду, распределение по шардам и пик памяти воркеров.
+
+После остановки фронта проверяется, что прогресс каждого пользователя
+записан и лежит в файлах своего шарда; затем данные перекладываются
+на --shards + 1 шардов (--reshard) и обратно в файлы bot.py (--unshard),
+и проверка повторяется. Скорость здесь упирается в HTTP-вызовы Bot API
+(httpx в воркерах и поддельный сервер в этом же процессе), а на одном
+ядре шарды и вовсе не ускоряют — это проверка правильности, а не замер
+масштабирования.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import types
+
+# harness первым: он добавляет корень репозитория в sys.path
+from harness import (
+    COURSE_FILE,
+    OFFLINE_CONFIG,
+    ROOT,
+    Connections,
+    bot_workdir,
+    deliver,
+    final_step,
+    free_port,
+    wait_listening,
+)
+
+# isort: split
+
+from fake_telegram import (
+    FakeRequest,
+    course_flow,
+    fake_api_server,
+    flow_update,
+    message_update,
+)
+
+from webhook import HttpClient
+
+SECRET = 'bench-secret'
+ADMIN = 1
+
+
+def free_ports(count: int) -> int:
+    """Начало count свободных портов подряд."""
+    while True:
+        base = random.randint(20000, 60000 - count)
+        try:
+            for port in range(base, base + count):
+                with socket.socket() as sock:
+                    sock.bind(('127.0.0.1', port))
+            return base
+        except OSError:
+            continue
+
+
+def write_config(args, front_port: int, shard_port: int, api_port: int, shards: int) -> None:
+    settings = dict(
+        OFFLINE_CONFIG, ADMIN_CHAT_ID=ADMIN, BOT_MODE='webhook', WEBHOOK_SECRET=SECRET,
+        WEBHOOK_PORT=front_port, SHARDS=shards, SHARD_PORT=shard_port,
+        BOT_API_URL=f'http://127.0.0.1:{api_port}', PROGRESS_BACKEND=args.backend,
+        PROGRESS_FLUSH_LATENCY=0.05,
+    )
+    with open('config.py', 'w', encoding='utf-8') as f:
+        f.writelines(f'{key} = {value!r}\n' for key, value in settings.items())
+
+
+async def worker_stats(shard_port: int, shards: int) -> list[dict | None]:
+    async def one(port):
+        client = HttpClient('127.0.0.1', port, timeout=2.0)
+        try:
+            return json.loads((await client.request('GET', '/shard')).body)
+        except (TimeoutError, OSError, ValueError):
+            return None
+        finally:
+            client.close()
+    return await asyncio.gather(*(one(shard_port + i) for i in range(shards)))
+
+
+async def run(bot, args, uids: list[int], ports: tuple[int, int], log) -> int:
+    front_port, shard_port = ports
+    api = FakeRequest()
+    api_server = fake_api_server(api)
+    await api_server.start()
+    write_config(args, front_port, shard_port, api_server.port, args.shards)
+
+    env = dict(os.environ, PYTHONPATH=os.getcwd())
+    front = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(ROOT, 'shards.py'), env=env, stdout=log, stderr=log)
+    try:
+        await wait_listening(front_port)
+        for i in range(args.shards):
+            await wait_listening(shard_port + i, timeout=60)
+
+        langs = bot.COURSE.langs
+        flows = [[flow_update(uid, kind, value) for kind, value in course_flow(bot, langs[uid % len(langs)])]
+                 for uid in uids]
+        total = sum(map(len, flows))
+        headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET, 'Content-Type': 'application/json'}
+        client = Connections(front_port, args.connections)
+        await client.open()
+
+        started = time.perf_counter()
+        retries = sum(await asyncio.gather(*(deliver(client, '/telegram', updates, headers)
+                                             for updates in flows)))
+        while True:
+            stats = await worker_stats(shard_port, args.shards)
+            if sum(s['ingest']['processed'] for s in stats if s) >= total:
+                break
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+
+        # /shards отвечает сам фронт
+        await client.post('/telegram', json.dumps(message_update(ADMIN, '/shards')).encode(), headers)
+        for _ in range(100):
+            if api.texts.get(ADMIN, '').startswith('📊'):
+                break
+            await asyncio.sleep(0.05)
+        await client.close()
+    finally:
+        if front.returncode is None:
+            front.terminate()
+        code = await asyncio.wait_for(front.wait(), 60)
+        await api_server.stop()
+
+    print(f"shards={args.shards} users={len(uids)} updates={total} backend={args.backend}")
+    print(f"processed in {elapsed:.2f} s: {total / elapsed:.0f} updates/s, 503 retries {retries}")
+    for s in stats:
+        print(f"  shard {s['shard']}: {s['ingest']['processed']} updates, p99 {s['ingest']['p99_ms']} ms, "
+              f"peak RSS {s['peak_rss_mb']:.0f} MB")
+    print(f"Bot API calls: {api.total()} {dict(api.calls.most_common())}")
+    report = api.texts.get(ADMIN, '')
+    print(report or "FAIL: no /shards report")
+    if code != 0:
+        print(f"FAIL: front exited with {code}")
+    return 0 if report and code == 0 else 1
+
+
+def check(shards_module, storage, args, uids, want_step: int, count: int | None) -> bool:
+    """Все ли пользователи на месте: в своём шарде и с пройденным курсом."""
+    files = shards_module._files(count)
+    found = {}
+    for index, paths in enumerate(files):
+        store = storage.open_store(args.backend, *paths[:3])
+        try:
+            for uid, rec in store.load().items():
+                if count and shards_module.shard_of(uid, count) != index:
+                    print(f"FAIL: user {uid} is in shard {index} of {count}")
+                    return False
+                found[uid] = rec
+        finally:
+            store.close()
+    bad = [uid for uid in uids if str(uid) not in found
+           or found[str(uid)].step != want_step or not found[str(uid)].final_passed]
+    where = f"{count} shards" if count else "plain bot.py files"
+    if bad:
+        print(f"FAIL: {len(bad)} users missing or unfinished in {where}")
+        return False
+    print(f"OK: all {len(uids)} users finished, each in its own shard ({where})")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sharded deployment end-to-end check")
+    parser.add_argument('--shards', type=int, default=2)
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--connections', type=int, default=40)
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--course', default=COURSE_FILE)
+    args = parser.parse_args()
+    random.seed(1)
+    if os.path.exists(os.path.join(ROOT, 'config.py')):
+        # воркеры импортируют config рядом с bot.py раньше, чем из PYTHONPATH
+        sys.exit("config.py next to bot.py would override the bench config; move it away first")
+
+    logging.basicConfig(level=logging.WARNING)
+    with bot_workdir(args.course, 'bench_shards_') as workdir:
+        # shards.py читает config.py, который пишется в рабочую папку
+        sys.path.insert(0, workdir)
+        import storage
+        from course import compile_course
+        from menus import PageCache
+        with open('full_course_data.json', encoding='utf-8') as f:
+            course = compile_course(json.load(f))
+        # course_flow() нужны только курс и страницы мини-тестов, сам bot.py здесь не импортируется
+        bot = types.SimpleNamespace(COURSE=course, pages=PageCache(course))
+        want_step = final_step(course)
+        uids = list(range(1001, 1001 + args.users))
+        ports = (free_port(), free_ports(args.shards + 1))
+        with open('front.log', 'wb') as log:
+            code = asyncio.run(run(bot, args, uids, ports, log))
+
+        import shards
+        ok = check(shards, storage, args, uids, want_step, args.shards)
+        # другое число шардов и обратно в файлы bot.py
+        write_config(args, 0, 0, 0, args.shards + 1)
+        for flag, count in (('--reshard', args.shards + 1), ('--unshard', None)):
+            subprocess.run([sys.executable, os.path.join(ROOT, 'shards.py'), flag],
+                           env=dict(os.environ, PYTHONPATH=workdir), check=True)
+            ok = check(shards, storage, args, uids, want_step, count) and ok
+        if not ok or code:
+            with open('front.log', encoding='utf-8', errors='replace') as f:
+                print(''.join(f.readlines()[-30:]))
+            code = 1
+    sys.exit(code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Сквозной тест режима вебхука: синтетические апдейты по HTTP в локальный сервер бота.
+
+    python tools/bench_webhook.py [--users 300] [--connections 40] [--api-latency 0.01]
+                                  [--course full_course_data.json]
+
+Поднимает то же Application, что main() в режиме BOT_MODE = 'webhook'
+(run_webhook), но Bot API подменён tools/fake_telegram.py. Каждый
+пользователь проходит курс (шаги, мини-тесты, финальный тест), посылая
+апдейты по одному, как Telegram; одновременно открыто не больше
+--connections соединений. Проверяются также отказ на неверный секрет и
+мусор в теле запроса. Печатает апдейты в секунду, p50/p99 от приёма
+запроса до конца обработки и число вызовов Bot API.
+
+Запускается во временной папке со своим config. Клиент работает в том же
+процессе и тоже расходует CPU, так что цифры — нижняя граница.
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+# harness первым: он добавляет корень репозитория в sys.path
+from harness import (
+    COURSE_FILE,
+    Connections,
+    bot_workdir,
+    deliver,
+    free_port,
+    import_bot,
+    unfinished,
+    wait_listening,
+)
+
+# isort: split
+
+from fake_telegram import FAKE_TOKEN, FakeRequest, course_flow, flow_update
+from telegram.ext import ApplicationBuilder
+
+SECRET = 'bench-secret'
+
+
+async def run(bot, args, port: int) -> int:
+    bot.progress = bot.load_progress()
+    api = FakeRequest(args.api_latency)
+    app = bot.build_application(
+        ApplicationBuilder().token(FAKE_TOKEN).request(bot.instrument_request(api))
+        .get_updates_request(FakeRequest()))
+    stop = asyncio.Event()
+    server = asyncio.create_task(bot.run_webhook(app, stop))
+    path = bot.WEBHOOK_PATH
+    await wait_listening(port)
+
+    langs = bot.COURSE.langs
+    flows = [[flow_update(uid, kind, value) for kind, value in course_flow(bot, langs[uid % len(langs)])]
+             for uid in range(1, args.users + 1)]
+    total = sum(map(len, flows))
+    headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET, 'Content-Type': 'application/json'}
+
+    client = Connections(port, args.connections)
+    await client.open()
+    # чужой запрос и мусор не должны доходить до бота
+    forbidden = await client.post(path, b'{}', {'X-Telegram-Bot-Api-Secret-Token': 'x'})
+    invalid = await client.post(path, b'not json', headers)
+    assert forbidden == 403 and invalid == 400, (forbidden, invalid)
+
+    started = time.perf_counter()
+    retries = sum(await asyncio.gather(*(deliver(client, path, updates, headers) for updates in flows)))
+    accepted = time.perf_counter() - started
+    while bot.webhook_ingest.processed < total:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+    await client.close()
+
+    metrics = bot.webhook_ingest.metrics()
+    stop.set()
+    await server
+
+    wrong = unfinished(bot, range(1, args.users + 1))
+
+    print(f"users={args.users} updates={total} connections={args.connections} "
+          f"concurrency={bot.CONCURRENT_UPDATES} api_latency={args.api_latency * 1000:.0f} ms")
+    print(f"accepted in {accepted:.2f} s, processed in {elapsed:.2f} s: {total / elapsed:.0f} updates/s")
+    print(f"latency receive -> handled: p50 {metrics['p50_ms']} ms, p99 {metrics['p99_ms']} ms")
+    print(f"batches {metrics['batches']} (avg {total / max(metrics['batches'], 1):.1f} updates), "
+          f"503 retries {retries}, forbidden {metrics['forbidden']}, invalid {metrics['invalid']}")
+    print(f"Bot API calls: {api.total()} {dict(api.calls.most_common())}")
+    if wrong:
+        print(f"FAIL: {len(wrong)} users did not finish the course")
+        return 1
+    print(f"OK: all {args.users} users finished the course")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Webhook mode end-to-end benchmark")
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--connections', type=int, default=40)
+    parser.add_argument('--api-latency', type=float, default=0.01, help="max fake Bot API latency, s")
+    parser.add_argument('--concurrency', type=int, default=32, help="CONCURRENT_UPDATES")
+    parser.add_argument('--queue', type=int, default=1000, help="WEBHOOK_QUEUE_SIZE")
+    parser.add_argument('--course', default=COURSE_FILE)
+    args = parser.parse_args()
+    random.seed(1)
+
+    with bot_workdir(args.course, 'bench_webhook_'):
+        port = free_port()
+        bot = import_bot(
+            BOT_MODE='webhook', WEBHOOK_SECRET=SECRET, WEBHOOK_PORT=port,
+            WEBHOOK_QUEUE_SIZE=args.queue, CONCURRENT_UPDATES=args.concurrency,
+        )
+        code = asyncio.run(run(bot, args, port))
+    sys.exit(code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+"""
+Локальная подмена Bot API для бенчмарков и нагрузочных тестов.
+
+FakeRequest подключается вместо HTTP-клиента PTB:
+
+    ApplicationBuilder().token(FAKE_TOKEN).request(FakeRequest()).get_updates_request(FakeRequest())
+
+и отвечает на методы Bot API правдоподобными объектами без выхода в сеть,
+считая вызовы по методам. latency — случайная задержка ответа «сервера»
+(секунды, от 0 до latency). fake_api_server() отдаёт те же ответы по HTTP —
+для ботов в других процессах (BOT_API_URL = "http://127.0.0.1:<порт>").
+Функции message_update/callback_update строят JSON входящих апдейтов,
+как их присылает Telegram.
+"""
+import asyncio
+import itertools
+import json
+import random
+import re
+import time
+from collections import Counter
+from urllib.parse import parse_qsl
+
+from telegram.request import BaseRequest, RequestData
+
+from webhook import HttpServer, Request, Response
+
+FAKE_TOKEN = '123456:offline-fake-token'
+API_METHODS = ('getMe', 'getUpdates', 'setWebhook', 'deleteWebhook', 'sendMessage',
+               'editMessageText', 'sendDocument', 'answerCallbackQuery')
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'CourseBot', 'username': 'course_bot',
+            'can_join_groups': False, 'can_read_all_group_messages': False,
+            'supports_inline_queries': False}
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def _chat(chat_id: int) -> dict:
+    return {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'}
+
+
+def _user(uid: int) -> dict:
+    return {'id': uid, 'is_bot': False, 'first_name': f'User{uid}', 'username': f'user{uid}'}
+
+
+def message_update(uid: int, text: str) -> dict:
+    message = {'message_id': next(_message_ids), 'date': int(time.time()),
+               'chat': _chat(uid), 'from': _user(uid), 'text': text}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': next(_update_ids), 'message': message}
+
+
+def callback_update(uid: int, data: str) -> dict:
+    message = {'message_id': next(_message_ids), 'date': int(time.time()),
+               'chat': _chat(uid), 'from': BOT_USER, 'text': 'menu'}
+    return {'update_id': next(_update_ids), 'callback_query': {
+        'id': str(next(_update_ids)), 'from': _user(uid), 'chat_instance': str(uid),
+        'data': data, 'message': message}}
+
+
+def course_flow(bot, lang: str, name: str | None = None) -> list[tuple[str, str]]:
+    """
+    Прохождение курса без ошибок: [('text', '/start'), ('data', 'lang:ru'), ...].
+
+    Каждый шаг открывается, каждый мини-тест начинается и решается верно,
+    затем финальный тест; с name — ещё ввод имени и сертификат.
+    """
+    course = bot.COURSE
+    flow = [('text', '/start'), ('data', f'lang:{lang}'), ('data', 'menu_show_course')]
+    for sid, step in enumerate(course.steps, 1):
+        flow.append(('data', f'select_step:{sid}'))
+        if step.test is not None:
+            flow.append(('data', f'test_step:{sid}:start'))
+            flow.append(('data', f'test_step:{sid}:{bot.pages.test_answer(sid, lang)}'))
+    flow.append(('data', 'menu_final'))
+    lid = course.lid(lang)
+    for q, question in enumerate(course.final_questions):
+        flow.append(('data', f'test_final:{q}:{question.correct[lid]}'))
+    if name is not None:
+        flow += [('data', 'menu_certificate'), ('data', 'enter_name'), ('text', name)]
+    return flow
+
+
+def flow_update(uid: int, kind: str, value: str) -> dict:
+    return message_update(uid, value) if kind == 'text' else callback_update(uid, value)
+
+
+class FakeRequest(BaseRequest):
+    """Ответы Bot API из памяти; calls — счётчик вызовов по методам, texts — последний текст в чат."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.texts: dict[int, str] = {}
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data: RequestData | None = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> tuple[int, bytes]:
+        params = request_data.parameters if request_data else {}
+        return 200, await self.answer(url.rsplit('/', 1)[-1], params)
+
+    async def answer(self, api_method: str, params: dict) -> bytes:
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(random.uniform(0, self.latency))
+        if api_method == 'sendMessage':
+            self.texts[int(params['chat_id'])] = params.get('text', '')
+        return json.dumps({'ok': True, 'result': self._result(api_method, params)}).encode()
+
+    @staticmethod
+    def _result(api_method: str, params: dict):
+        if api_method == 'getMe':
+            return BOT_USER
+        if api_method == 'getUpdates':
+            return []
+        if api_method in ('sendMessage', 'editMessageText', 'sendDocument'):
+            chat_id = int(params.get('chat_id', 0))
+            message = {'message_id': int(params.get('message_id') or next(_message_ids)),
+                       'date': int(time.time()), 'chat': _chat(chat_id), 'from': BOT_USER}
+            if api_method == 'sendDocument':
+                file_id = f'FILE{message["message_id"]}'
+                message['document'] = {'file_id': file_id, 'file_unique_id': file_id}
+                if 'caption' in params:
+                    message['caption'] = params['caption']
+            else:
+                message['text'] = params.get('text', '')
+            return message
+        return True
+
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+
+def _form(request: Request) -> dict:
+    """Параметры запроса PTB: x-www-form-urlencoded или multipart (с файлом)."""
+    content_type = request.headers.get('content-type', '')
+    if content_type.startswith('multipart/'):
+        fields = re.findall(rb'name="([^"]+)"\r\n\r\n([^\r]*)\r\n', request.body)
+        return {name.decode(): value.decode('utf-8', 'replace') for name, value in fields}
+    return dict(parse_qsl(request.body.decode()))
+
+
+def fake_api_server(api: FakeRequest, host: str = '127.0.0.1', port: int = 0) -> HttpServer:
+    """HttpServer с методами API_METHODS на /bot<FAKE_TOKEN>/...; запустить — await server.start()."""
+    server = HttpServer(host, port, max_body=50 << 20)
+
+    async def handle(request: Request) -> Response:
+        body = await api.answer(request.path.rsplit('/', 1)[-1], _form(request))
+        return Response(200, body, 'application/json')
+
+    for method in API_METHODS:
+        server.route('POST', f'/bot{FAKE_TOKEN}/{method}', handle)
+    return server
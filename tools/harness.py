@@ -0,0 +1,147 @@
+"""
+Общая обвязка офлайн-прогонов бота: stress_updates, loadtest, bench_webhook, bench_shards.
+
+    with bot_workdir(args.course, 'loadtest_'):
+        bot = import_bot(PROGRESS_BACKEND='sqlite')
+
+Инструменту достаточно импортировать harness первым: он добавляет корень
+репозитория в sys.path. Курс по умолчанию — full_course_data.json бота,
+а без него (чистый checkout, CI) — маленький tools/sample_course.json. bot_workdir() — временная рабочая папка с копией
+курса (файлы бота в репозитории не трогаются), import_bot() — импорт
+bot.py со своим config: OFFLINE_CONFIG плюс настройки прогона.
+Connections, deliver(), free_port() и wait_listening() — для прогонов,
+которые шлют апдейты боту по HTTP.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import types
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_telegram import FAKE_TOKEN
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_COURSE_FILE = os.path.join(ROOT, 'tools', 'sample_course.json')
+COURSE_FILE = os.path.join(ROOT, 'full_course_data.json')
+if not os.path.exists(COURSE_FILE):
+    COURSE_FILE = SAMPLE_COURSE_FILE
+
+# config прогона: токен поддельный, за курсом не следим, лимиты Telegram
+# на отправку сняты — меряется сам бот
+OFFLINE_CONFIG = {
+    'TOKEN': FAKE_TOKEN, 'ADMIN_CHAT_ID': 1, 'COURSE_WATCH_INTERVAL': 0, 'CERT_POOL': 'thread',
+    'OUTBOUND_RATE': 1e6, 'OUTBOUND_CHAT_RATE': 1e6, 'OUTBOUND_CHAT_BURST': 1e6,
+}
+
+
+@contextmanager
+def bot_workdir(course: str, prefix: str):
+    """Временная рабочая папка с full_course_data.json; после — удаляется."""
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix=prefix)
+    shutil.copy(course, os.path.join(workdir, 'full_course_data.json'))
+    os.chdir(workdir)
+    try:
+        yield workdir
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def import_bot(**settings):
+    """bot.py с config = OFFLINE_CONFIG + settings и загруженным курсом; вызывать внутри bot_workdir()."""
+    sys.modules['config'] = types.SimpleNamespace(**{**OFFLINE_CONFIG, **settings})
+    logging.disable(logging.WARNING)
+    import bot
+    bot.load_course()
+    return bot
+
+
+def final_step(course) -> int:
+    """Шаг пользователя, прошедшего все мини-тесты."""
+    return max((sid for sid, step in enumerate(course.steps, 1) if step.test is not None), default=0) + 1
+
+
+def unfinished(bot, uids) -> list[int]:
+    """Пользователи, у которых в памяти бота курс не пройден до конца."""
+    want = final_step(bot.COURSE)
+    return [uid for uid in uids
+            if (user := bot.get_user(str(uid))).step != want or not user.final_passed]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_listening(port: int, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+
+
+class Connections:
+    """
+    Пул keep-alive соединений к локальному серверу. Свой мини-клиент вместо
+    httpx: тот на сотнях запросов в секунду сам становится узким местом.
+    """
+
+    def __init__(self, port: int, size: int):
+        self.port = port
+        self.size = size
+        self._pool: asyncio.Queue = asyncio.Queue()
+
+    async def open(self) -> None:
+        for _ in range(self.size):
+            self._pool.put_nowait(await asyncio.open_connection('127.0.0.1', self.port))
+
+    async def post(self, path: str, body: bytes, headers: dict[str, str]) -> int:
+        reader, writer = await self._pool.get()
+        try:
+            head = ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+            writer.write(f'POST {path} HTTP/1.1\r\nHost: localhost\r\n{head}'
+                         f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+            status_line, *lines = (await reader.readuntil(b'\r\n\r\n')).decode().split('\r\n')
+            length = next((int(line.split(':')[1]) for line in lines
+                           if line.lower().startswith('content-length:')), 0)
+            if length:
+                await reader.readexactly(length)
+            return int(status_line.split()[1])
+        finally:
+            self._pool.put_nowait((reader, writer))
+
+    async def close(self) -> None:
+        while not self._pool.empty():
+            _, writer = self._pool.get_nowait()
+            writer.close()
+
+
+async def deliver(client: Connections, path: str, updates: list[dict], headers: dict[str, str]) -> int:
+    """Апдейты одного пользователя по одному, как шлёт Telegram; возвращает число повторов после 503."""
+    retries = 0
+    for update in updates:
+        body = json.dumps(update).encode()
+        # очередь полна (503) — повторяем, как Telegram
+        while (status := await client.post(path, body, headers)) == 503:
+            retries += 1
+            await asyncio.sleep(random.uniform(0.05, 0.2))
+        assert status == 200, status
+    return retries
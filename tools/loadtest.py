@@ -0,0 +1,261 @@
+"""
+Нагрузочный тест без Telegram: тысячи синтетических пользователей проходят курс.
+
+    python tools/loadtest.py [--users 2000] [--concurrency 32] [--api-latency 0.01]
+                             [--names 100] [--backend json|sqlite] [--cert-pool process|thread]
+                             [--processor per-user|simple] [--no-reference] [--tolerance 0.25]
+                             [--baseline PATH] [--save-baseline PATH] [--course full_course_data.json]
+
+Собирается то же Application, что в main() (build_application, post_init,
+пул сертификатов, загрузка прогресса), только Bot API подменён
+tools/fake_telegram.py, а апдейты подаются прямо в update processor, как
+их подаёт Updater. Каждый пользователь проходит курс целиком: /start,
+язык, каждый шаг и мини-тест, финальный тест, ввод имени и сертификат;
+следующее нажатие — после ответа на предыдущее, все пользователи
+одновременно. Имена берутся из --names вариантов, так что работают и
+рендеринг, и кэш сертификатов.
+
+Печатает апдейты в секунду, p50/p95/p99 от подачи апдейта до конца
+обработки, время обработчиков и рендеринга (метрики бота), вызовы Bot
+API по методам и пик памяти процесса.
+
+Абсолютные цифры зависят от машины, поэтому baseline у каждой машины
+свой: --save-baseline PATH записывает прогон в файл, --baseline PATH
+сверяет с ним (если параметры прогона и курс те же). Меньше апдейтов в
+секунду, больше p50/p95/p99 или памяти, чем на --tolerance (по умолчанию
+25%), или больше вызовов API сверх 5% шума («сертификат в очереди», когда
+пул занят) — регрессия, код выхода 1.
+
+Кроме того, тот же прогон повторяется в отдельном процессе с обычным
+SimpleUpdateProcessor PTB (опорный прогон, --no-reference — без него), и
+сверяются отношения на одной машине: апдейты в секунду, p50, память и
+вызовы API с тем же допуском. Хвосты p95/p99 здесь упираются в очередь к
+пулу сертификатов, и у двух разных процессоров апдейтов сравнивать их
+нечестно, поэтому с опорным прогоном они только печатаются.
+
+Лимиты Telegram на отправку здесь сняты — меряется сам бот.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+# harness первым: он добавляет корень репозитория в sys.path
+from harness import COURSE_FILE, bot_workdir, import_bot, unfinished
+
+# isort: split
+
+from fake_telegram import FAKE_TOKEN, FakeRequest, course_flow, flow_update
+from telegram import Update
+from telegram.ext import ApplicationBuilder, SimpleUpdateProcessor
+
+from metrics import summary_lines
+from webhook import percentile
+
+# что сверяется: (название, ключ, 1 — хуже, когда больше; -1 — когда меньше)
+BASELINE_RATIOS = (('updates/s', 'updates_per_s', -1), ('p50 ms', 'p50_ms', 1), ('p95 ms', 'p95_ms', 1),
+                   ('p99 ms', 'p99_ms', 1), ('peak RSS MB', 'peak_rss_mb', 1))
+REFERENCE_RATIOS = (('updates/s', 'updates_per_s', -1), ('p50 ms', 'p50_ms', 1), ('peak RSS MB', 'peak_rss_mb', 1))
+# параметры, при которых прогон можно сравнивать с baseline
+PARAMS = ('users', 'concurrency', 'api_latency', 'names', 'backend', 'cert_pool', 'processor')
+
+
+async def run(bot, args) -> dict:
+    # как main(): прогресс, очередь админам, кэш и пул сертификатов, Application
+    bot.progress = bot.load_progress()
+    bot.admin_outbox.load()
+    bot.cert_cache.load()
+    bot.cert_renderer.start()
+    api = FakeRequest(args.api_latency)
+    builder = ApplicationBuilder().token(FAKE_TOKEN).request(bot.instrument_request(api)) \
+        .get_updates_request(FakeRequest())
+    if args.processor == 'simple':
+        bot.update_processor = None
+        builder.concurrent_updates(SimpleUpdateProcessor(args.concurrency))
+    app = bot.build_application(builder)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    idle_rss = bot.peak_rss_mb()
+
+    langs = bot.COURSE.langs
+    names = [f'Student {i}' for i in range(args.names)]
+    flows = [[flow_update(uid, kind, value)
+              for kind, value in course_flow(bot, langs[uid % len(langs)], random.choice(names))]
+             for uid in range(1, args.users + 1)]
+    total = sum(map(len, flows))
+    latencies: list[float] = []
+
+    async def handled(update: Update, done: asyncio.Future) -> None:
+        try:
+            await app.process_update(update)
+        finally:
+            done.set_result(None)
+
+    async def user(updates):
+        for data in updates:
+            update = Update.de_json(data, app.bot)
+            done = asyncio.get_running_loop().create_future()
+            started = time.perf_counter()
+            await app.update_processor.process_update(update, handled(update, done))
+            await done
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(updates) for updates in flows))
+    elapsed = time.perf_counter() - started
+
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+    bot.cert_renderer.shutdown()
+
+    return {
+        'updates': total,
+        'seconds': round(elapsed, 2),
+        'updates_per_s': round(total / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        'max_ms': round(max(latencies) * 1000, 1),
+        'api_calls': dict(api.calls.most_common()),
+        'api_calls_per_update': round(api.total() / total, 3),
+        'idle_rss_mb': round(idle_rss, 1),
+        'peak_rss_mb': round(bot.peak_rss_mb(), 1),
+        'unfinished': len(unfinished(bot, range(1, args.users + 1))),
+        'certificates': api.calls['sendDocument'],
+    }
+
+
+def report(bot, args, result: dict) -> None:
+    print(f"users={args.users} updates={result['updates']} concurrency={args.concurrency} "
+          f"api_latency={args.api_latency * 1000:.0f} ms backend={args.backend} cert_pool={args.cert_pool} "
+          f"processor={args.processor}")
+    print(f"processed in {result['seconds']} s: {result['updates_per_s']:.0f} updates/s")
+    print(f"latency update -> handled: p50 {result['p50_ms']} ms, p95 {result['p95_ms']} ms, "
+          f"p99 {result['p99_ms']} ms, max {result['max_ms']} ms")
+    for title, family in (("handlers", bot.handler_seconds), ("buttons", bot.route_seconds),
+                          ("certificate render", bot.cert_seconds), ("progress flush", bot.flush_seconds)):
+        lines = summary_lines(family)
+        if lines:
+            print(f"{title}:")
+            print('\n'.join(f"  {line}" for line in lines))
+    print(f"Bot API calls: {sum(result['api_calls'].values())} ({result['api_calls_per_update']} per update) "
+          f"{result['api_calls']}")
+    print(f"peak RSS {result['peak_rss_mb']:.0f} MB (after startup {result['idle_rss_mb']:.0f} MB)")
+
+
+def reference_run() -> dict:
+    """Тот же прогон с SimpleUpdateProcessor в отдельном процессе (у bot.py глобальное состояние)."""
+    fd, path = tempfile.mkstemp(prefix='loadtest_reference_', suffix='.json')
+    os.close(fd)
+    try:
+        subprocess.run([sys.executable, os.path.abspath(__file__), *sys.argv[1:],
+                        '--processor', 'simple', '--result', path],
+                       check=True, stdout=subprocess.DEVNULL)
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    finally:
+        os.remove(path)
+
+
+def compare(title: str, reference: dict, result: dict, ratios, tolerance: float) -> list[str]:
+    """Регрессии относительно baseline или опорного прогона: медленнее, больше памяти или вызовов API."""
+    problems = []
+    print(f"vs {title} (tolerance {tolerance:.0%}):")
+    for name, key, worse in ratios:
+        ref, now = reference[key], result[key]
+        change = (now - ref) / ref if ref else 0.0
+        flag = ''
+        if change * worse > tolerance:
+            flag = '  <-- regression'
+            problems.append(f"{name}: {ref} -> {now}")
+        print(f"  {name}: {ref} -> {now} ({change:+.0%}){flag}")
+    # число вызовов не зависит ни от машины, ни от процессора апдейтов;
+    # допускаем только шум (например, «сертификат в очереди», когда пул занят)
+    for method in sorted(set(reference['api_calls']) | set(result['api_calls'])):
+        was, now = reference['api_calls'].get(method, 0), result['api_calls'].get(method, 0)
+        if now > was * 1.05:
+            problems.append(f"{method} calls: {was} -> {now}")
+            print(f"  {method} calls: {was} -> {now}  <-- regression")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test of the bot Application")
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32, help="CONCURRENT_UPDATES")
+    parser.add_argument('--api-latency', type=float, default=0.01, help="max fake Bot API latency, s")
+    parser.add_argument('--names', type=int, default=100, help="distinct names on certificates")
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--cert-pool', choices=('process', 'thread'), default='process')
+    parser.add_argument('--processor', choices=('per-user', 'simple'), default='per-user')
+    parser.add_argument('--course', default=COURSE_FILE)
+    parser.add_argument('--no-reference', action='store_true', help="skip the SimpleUpdateProcessor run")
+    parser.add_argument('--baseline', metavar='PATH', help="compare with a result saved on this machine")
+    parser.add_argument('--save-baseline', metavar='PATH', help="save this run as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown / growth, 0.25 = 25%%")
+    parser.add_argument('--result', help=argparse.SUPPRESS)  # опорный прогон: куда записать результат
+    args = parser.parse_args()
+    random.seed(1)
+
+    with bot_workdir(args.course, 'loadtest_'):
+        bot = import_bot(PROGRESS_BACKEND=args.backend, CONCURRENT_UPDATES=args.concurrency,
+                         CERT_POOL=args.cert_pool)
+        result = asyncio.run(run(bot, args))
+        if args.result:
+            with open(args.result, 'w', encoding='utf-8') as f:
+                json.dump(result, f)
+            sys.exit(0)
+        report(bot, args, result)
+
+    if result['unfinished'] or result['certificates'] != args.users:
+        print(f"FAIL: {result['unfinished']} users did not finish the course, "
+              f"{result['certificates']} of {args.users} certificates sent")
+        sys.exit(1)
+    params = {key: getattr(args, key) for key in PARAMS}
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump({'saved': time.strftime('%Y-%m-%d %H:%M'), 'params': params, 'result': result},
+                      f, indent=2, ensure_ascii=False)
+            f.write('\n')
+        print(f"baseline saved to {args.save_baseline}")
+
+    problems, compared = [], []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline['params'] != params:
+            print(f"baseline was run with {baseline['params']}, not comparing")
+        elif baseline['result']['updates'] != result['updates']:
+            print("baseline was run on a different course, not comparing")
+        else:
+            problems += compare(f"baseline ({baseline['saved']})", baseline['result'], result,
+                                BASELINE_RATIOS, args.tolerance)
+            compared.append('the baseline')
+    if not args.no_reference and args.processor != 'simple':
+        reference = reference_run()
+        print(f"reference: {reference['updates_per_s']:.0f} updates/s, p50 {reference['p50_ms']} ms, "
+              f"p95 {reference['p95_ms']} ms, p99 {reference['p99_ms']} ms, "
+              f"peak RSS {reference['peak_rss_mb']:.0f} MB")
+        if reference['unfinished'] or reference['certificates'] != args.users:
+            print("FAIL: the reference run did not finish the course")
+            sys.exit(1)
+        problems += compare("SimpleUpdateProcessor in the same conditions", reference, result,
+                            REFERENCE_RATIOS, args.tolerance)
+        compared.append('the reference run')
+    if problems:
+        print("FAIL: " + "; ".join(problems))
+    elif compared:
+        print(f"OK: within tolerance of {' and '.join(compared)}")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+"""
+Одноразовый перенос прогресса из progress.json (+ журнал) в SQLite.
+
+    python tools/migrate_progress.py [--json progress.json] [--journal progress.journal] [--db progress.db]
+
+После переноса в config.py ставится PROGRESS_BACKEND = "sqlite".
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import migrate_json_to_sqlite
+
+logger = logging.getLogger('migrate_progress')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate progress.json to SQLite")
+    parser.add_argument('--json', default='progress.json')
+    parser.add_argument('--journal', default='progress.journal')
+    parser.add_argument('--db', default='progress.db')
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(message)s", level=logging.INFO)
+    if not os.path.exists(args.json) and not os.path.exists(args.journal):
+        logger.error("Nothing to migrate: %s not found", args.json)
+        sys.exit(1)
+
+    started = time.perf_counter()
+    count = migrate_json_to_sqlite(args.json, args.journal, args.db)
+    logger.info("Migrated %d users to %s in %.2f s", count, args.db, time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+Нагрузочная проверка параллельной обработки апдейтов: не теряется ли прогресс.
+
+    python tools/stress_updates.py [--users 200] [--concurrency 32] [--latency 0.02]
+                                   [--processor per-user|simple] [--backend json|sqlite]
+                                   [--course full_course_data.json]
+
+Каждый пользователь проходит курс целиком: /start, выбор языка, все
+шаги и мини-тесты, финальный тест и вопрос админам. Апдейты всех
+пользователей приходят разом вперемешку и идут через update processor
+в Application из build_application(); Bot API подменён
+tools/fake_telegram.py и отвечает со случайной задержкой, чтобы
+обработчики разных апдейтов перемежались. В конце прогресс
+сбрасывается на диск, перечитывается и сверяется с ожидаемым.
+
+Запускается в отдельной временной папке со своим config, рабочие файлы
+бота не трогает. --processor simple — обычная параллельность PTB без
+очереди на пользователя, для сравнения.
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+# harness первым: он добавляет корень репозитория в sys.path
+from harness import COURSE_FILE, bot_workdir, final_step, import_bot
+
+# isort: split
+
+from fake_telegram import FAKE_TOKEN, FakeRequest, course_flow, flow_update
+from telegram import Update
+from telegram.ext import ApplicationBuilder, SimpleUpdateProcessor
+
+
+class CountingRequest(FakeRequest):
+    """FakeRequest, который ещё считает ответы «неизвестная команда»."""
+
+    def __init__(self, latency: float, unknown_texts: tuple[str, ...]):
+        super().__init__(latency)
+        self.unknown_texts = unknown_texts
+        self.unknown = 0
+
+    async def answer(self, api_method: str, params: dict) -> bytes:
+        text = params.get('text', '') if api_method in ('sendMessage', 'editMessageText') else ''
+        if text.startswith(self.unknown_texts):
+            self.unknown += 1
+        return await super().answer(api_method, params)
+
+
+def user_script(bot, uid: int, lang: str) -> list[dict]:
+    """Апдейты одного пользователя: курс без ошибок и вопрос админам."""
+    flow = course_flow(bot, lang) + [('data', 'menu_ask'), ('text', f'question from {uid}')]
+    return [flow_update(uid, kind, value) for kind, value in flow]
+
+
+async def run(bot, args) -> int:
+    api = CountingRequest(args.latency, tuple(bot.t('unknown', lang) for lang in bot.COURSE.langs))
+    if args.processor == 'simple':
+        bot.update_processor = None
+    bot.progress = bot.load_progress()
+    builder = ApplicationBuilder().token(FAKE_TOKEN).request(api).get_updates_request(FakeRequest())
+    if args.processor == 'simple':
+        builder.concurrent_updates(SimpleUpdateProcessor(args.concurrency))
+    app = bot.build_application(builder)
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    processor = app.update_processor
+
+    langs = bot.COURSE.langs
+    scripts = [user_script(bot, 1000 + i, langs[i % len(langs)]) for i in range(args.users)]
+    total = sum(map(len, scripts))
+    # всё приходит разом: апдейты разных пользователей вперемешку,
+    # апдейты одного пользователя — в своём порядке
+    arrivals = []
+    cursors = [0] * len(scripts)
+    live = list(range(len(scripts)))
+    while live:
+        i = random.choice(live)
+        arrivals.append(scripts[i][cursors[i]])
+        cursors[i] += 1
+        if cursors[i] == len(scripts[i]):
+            live.remove(i)
+
+    started = time.perf_counter()
+    tasks = []
+    for data in arrivals:
+        update = Update.de_json(data, app.bot)
+        tasks.append(asyncio.create_task(processor.process_update(update, app.process_update(update))))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    # on_stop досылает вопросы админам, on_shutdown — прогресс на диск
+    await app.stop()
+    await app.post_stop(app)
+    await app.shutdown()
+    await app.post_shutdown(app)
+    bot.progress_store.close()
+
+    # перечитываем с диска
+    store = bot.open_store(bot.PROGRESS_BACKEND, bot.PROGRESS_FILE, bot.PROGRESS_JOURNAL, bot.PROGRESS_DB)
+    want_step = final_step(bot.COURSE)
+    lost = []
+    for i in range(args.users):
+        uid = str(1000 + i)
+        mem = bot.get_user(uid)
+        disk = store.get(uid)
+        ok = (mem.step == want_step and mem.final_passed and mem.awaiting is None
+              and disk is not None and disk.step == want_step and disk.final_passed)
+        if not ok:
+            lost.append((uid, mem, disk))
+    store.close()
+
+    questions = bot.admin_outbox.pending + bot.admin_outbox.delivered
+    print(f"processor={args.processor} users={args.users} updates={total} "
+          f"concurrency={args.concurrency} api_calls={api.total()}")
+    print(f"time {elapsed:.2f} s, {total / elapsed:.0f} updates/s")
+    print(f"'unknown' replies: {api.unknown}, questions for admins: {questions}/{args.users}")
+    if isinstance(processor, bot.PerUserUpdateProcessor):
+        print(f"per-user queues: {processor.metrics()}")
+    if lost or api.unknown or questions != args.users:
+        print(f"FAIL: {len(lost)} users with wrong state")
+        for uid, mem, disk in lost[:5]:
+            print(f"  {uid}: memory {mem!r} awaiting={mem.awaiting!r}, disk {disk!r}")
+        return 1
+    print(f"OK: all {args.users} users at step {want_step} with the final test passed, in memory and on disk")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent update processing stress test")
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--latency', type=float, default=0.02, help="max fake Bot API latency, s")
+    parser.add_argument('--processor', choices=('per-user', 'simple'), default='per-user')
+    parser.add_argument('--backend', choices=('json', 'sqlite'), default='json')
+    parser.add_argument('--course', default=COURSE_FILE)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    with bot_workdir(args.course, 'stress_updates_'):
+        bot = import_bot(PROGRESS_BACKEND=args.backend, CONCURRENT_UPDATES=args.concurrency,
+                         PROGRESS_FLUSH_LATENCY=0.05)
+        code = asyncio.run(run(bot, args))
+    sys.exit(code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Параллельная обработка апдейтов с очередью на пользователя.
+
+Разные пользователи обслуживаются одновременно (не больше
+max_concurrent_updates апдейтов сразу), а апдейты одного пользователя —
+строго по порядку прихода: от этого зависят курсор финального теста и
+флаги ожидания имени или вопроса в UserRecord.
+"""
+import logging
+from collections import deque
+from collections.abc import Awaitable
+from typing import Any
+
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+def update_user_id(update: object) -> int | None:
+    user = getattr(update, 'effective_user', None)
+    return user.id if user is not None else None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Пока апдейт пользователя обрабатывается, следующие его апдейты встают
+    в очередь этого пользователя, и их по порядку выполняет та же задача.
+    Ожидающий своей очереди апдейт сразу освобождает слот, так что один
+    пользователь, нажавший кнопку много раз подряд, не занимает больше
+    одного слота и не тормозит остальных.
+    """
+
+    __slots__ = ('_queues', 'max_queue', 'queued')
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._queues: dict[int, deque] = {}
+        # метрики: сколько апдейтов ждали своей очереди и самая длинная очередь
+        self.queued = 0
+        self.max_queue = 0
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        uid = update_user_id(update)
+        if uid is None:
+            await coroutine
+            return
+        queue = self._queues.get(uid)
+        if queue is not None:
+            queue.append(coroutine)
+            self.queued += 1
+            self.max_queue = max(self.max_queue, len(queue))
+            return
+        queue = self._queues[uid] = deque((coroutine,))
+        try:
+            while queue:
+                try:
+                    await queue[0]
+                except Exception:
+                    # ошибка одного апдейта не должна терять следующие
+                    logger.exception("Error while processing update of user %s", uid)
+                queue.popleft()
+        finally:
+            # между последней проверкой и удалением нет await — новый апдейт
+            # либо попал в эту очередь, либо создаст свою
+            del self._queues[uid]
+            for left in queue:
+                left.close()
+
+    @property
+    def users_busy(self) -> int:
+        return len(self._queues)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def metrics(self) -> dict:
+        return {
+            'users_busy': self.users_busy,
+            'running': self.current_concurrent_updates,
+            'queued_total': self.queued,
+            'max_queue': self.max_queue,
+        }
@@ -0,0 +1,332 @@
+"""
+Приём апдейтов через вебхук.
+
+HttpServer — минимальный HTTP/1.1 сервер на asyncio.start_server (POST/GET
+с Content-Length и keep-alive), без сторонних зависимостей: балансировщик
+снимает TLS и проксирует запросы на него. WebhookIngest проверяет
+секретный заголовок Telegram, кладёт апдейт в ограниченную очередь и
+сразу отвечает 200; если очередь полна — 503, и Telegram повторит
+доставку позже. Отдельная задача забирает апдейты из очереди пачками
+и передаёт их в Application через его update processor, так что
+очередь на пользователя и лимит параллельности те же, что при polling.
+"""
+import asyncio
+import hmac
+import json
+import logging
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from typing import NamedTuple
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+STATUS_TEXT = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+               405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error',
+               503: 'Service Unavailable'}
+
+
+class Request(NamedTuple):
+    method: str
+    path: str
+    headers: dict[str, str]  # имена в нижнем регистре
+    body: bytes
+
+
+class Response(NamedTuple):
+    status: int
+    body: bytes = b''
+    content_type: str = 'text/plain; charset=utf-8'
+    headers: tuple[tuple[str, str], ...] = ()
+
+
+RouteHandler = Callable[[Request], Awaitable[Response]]
+
+
+def percentile(values, q: float) -> float:
+    """q-й перцентиль (0..100) списка чисел, 0 для пустого."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+
+class HttpServer:
+    """
+    Маленький HTTP-сервер: маршруты (метод, путь) -> async handler(Request).
+
+    Тело читается только по Content-Length (не больше max_body байт),
+    соединения держатся открытыми keepalive секунд между запросами.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0,
+                 max_body: int = 1 << 20, keepalive: float = 75.0):
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self.keepalive = keepalive
+        self._routes: dict[tuple[str, str], RouteHandler] = {}
+        self._server: asyncio.AbstractServer | None = None
+        self._clients: dict[asyncio.Task, asyncio.StreamWriter] = {}
+
+    def route(self, method: str, path: str, handler: RouteHandler) -> None:
+        self._routes[(method, path)] = handler
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._client, self.host, self.port)
+        # port=0 — свободный порт, узнаём какой
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("HTTP server listening on %s:%d", self.host, self.port)
+
+    async def stop(self) -> None:
+        if self._server is None:
+            return
+        self._server.close()
+        # открытые keep-alive соединения закрываем сами и ждём их обработчики
+        for writer in self._clients.values():
+            writer.close()
+        await asyncio.gather(*self._clients, return_exceptions=True)
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        task = asyncio.current_task()
+        self._clients[task] = writer
+        try:
+            while True:
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.keepalive)
+                except (TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                try:
+                    request_line, *header_lines = head.decode('latin-1').split('\r\n')
+                    method, target, version = request_line.split(' ', 2)
+                    headers = {}
+                    for line in header_lines:
+                        if line:
+                            name, _, value = line.partition(':')
+                            headers[name.strip().lower()] = value.strip()
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    await self._respond(writer, Response(400), close=True)
+                    break
+                if length > self.max_body:
+                    await self._respond(writer, Response(413), close=True)
+                    break
+                try:
+                    body = await reader.readexactly(length) if length else b''
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+
+                path = target.split('?', 1)[0]
+                handler = self._routes.get((method, path))
+                if handler is None:
+                    known = any(p == path for _, p in self._routes)
+                    response = Response(405 if known else 404)
+                else:
+                    try:
+                        response = await handler(Request(method, path, headers, body))
+                    except Exception:
+                        logger.exception("HTTP handler %s %s failed", method, path)
+                        response = Response(500)
+                close = version == 'HTTP/1.0' or headers.get('connection', '').lower() == 'close'
+                await self._respond(writer, response, close)
+                if close:
+                    break
+        finally:
+            self._clients.pop(task, None)
+            writer.close()
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, response: Response, close: bool) -> None:
+        lines = [
+            f"HTTP/1.1 {response.status} {STATUS_TEXT.get(response.status, '')}",
+            f"Content-Type: {response.content_type}",
+            f"Content-Length: {len(response.body)}",
+            f"Connection: {'close' if close else 'keep-alive'}",
+            *(f"{name}: {value}" for name, value in response.headers),
+        ]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + response.body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+class HttpClient:
+    """
+    Одно keep-alive соединение к локальному HTTP-серверу (такому же HttpServer).
+
+    Запросы идут по одному. Если сервер успел закрыть простаивавшее
+    соединение, запрос один раз повторяется через новое; остальные ошибки
+    соединения (OSError, asyncio.TimeoutError) достаются вызывающему.
+    """
+
+    def __init__(self, host: str, port: int, timeout: float = 30.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._lock = asyncio.Lock()
+
+    async def request(self, method: str, path: str, body: bytes = b'',
+                      headers: dict[str, str] | None = None) -> Response:
+        async with self._lock:
+            for attempt in (1, 2):
+                fresh = self._writer is None
+                if fresh:
+                    self._reader, self._writer = await asyncio.wait_for(
+                        asyncio.open_connection(self.host, self.port), self.timeout)
+                try:
+                    return await asyncio.wait_for(self._exchange(method, path, body, headers or {}),
+                                                  self.timeout)
+                except asyncio.IncompleteReadError as e:
+                    self.close()
+                    # старое соединение закрыто сервером до ответа — пробуем новое
+                    if fresh or e.partial or attempt == 2:
+                        raise ConnectionResetError("connection closed by server") from e
+                except BaseException:
+                    self.close()
+                    raise
+        raise AssertionError("unreachable")
+
+    async def _exchange(self, method: str, path: str, body: bytes, headers: dict[str, str]) -> Response:
+        head = ''.join(f'{name}: {value}\r\n' for name, value in headers.items())
+        self._writer.write(f'{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n{head}'
+                           f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body)
+        await self._writer.drain()
+        status_line, *lines = (await self._reader.readuntil(b'\r\n\r\n')).decode('latin-1').split('\r\n')
+        response_headers = {}
+        for line in lines:
+            if line:
+                name, _, value = line.partition(':')
+                response_headers[name.strip().lower()] = value.strip()
+        length = int(response_headers.get('content-length', 0))
+        data = await self._reader.readexactly(length) if length else b''
+        if response_headers.get('connection', '').lower() == 'close':
+            self.close()
+        return Response(int(status_line.split()[1]), data, response_headers.get('content-type', ''),
+                        tuple(response_headers.items()))
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+
+class WebhookIngest:
+    """
+    Очередь входящих апдейтов между HTTP и Application.
+
+    handle() — обработчик POST на путь вебхука; тело — апдейт или список
+    апдейтов (так их пачками пересылает фронт шардов). Фоновая задача берёт из
+    очереди до batch_size апдейтов за раз и запускает их обработку, держа
+    в работе не больше max_inflight апдейтов. latencies — время от приёма
+    запроса до конца обработки апдейта (последние 10 000).
+    """
+
+    def __init__(self, app, secret: str | None, queue_size: int = 1000,
+                 batch_size: int = 50, max_inflight: int | None = None):
+        self.app = app
+        self.secret = secret
+        self.batch_size = batch_size
+        self._queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self._slots = asyncio.Semaphore(max_inflight or queue_size)
+        self._task: asyncio.Task | None = None
+        self._running: set[asyncio.Task] = set()
+        self.latencies: deque[float] = deque(maxlen=10000)
+        # метрики
+        self.received = 0
+        self.rejected = 0   # очередь полна
+        self.forbidden = 0  # неверный секрет
+        self.invalid = 0    # не JSON-объект
+        self.batches = 0
+        self.processed = 0
+
+    async def handle(self, request: Request) -> Response:
+        if self.secret is not None and not hmac.compare_digest(
+                request.headers.get(SECRET_HEADER, '').encode(), self.secret.encode()):
+            self.forbidden += 1
+            return Response(403)
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            data = None
+        updates = [data] if isinstance(data, dict) else data
+        if not (isinstance(updates, list) and all(isinstance(u, dict) for u in updates)):
+            self.invalid += 1
+            return Response(400)
+        # пачка принимается целиком или не принимается вовсе
+        if self._queue.maxsize - self._queue.qsize() < len(updates):
+            self.rejected += 1
+            return Response(503, headers=(('Retry-After', '1'),))
+        received = time.perf_counter()
+        for update in updates:
+            self._queue.put_nowait((received, update))
+        self.received += len(updates)
+        return Response(200)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._feed())
+
+    async def _feed(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self.batches += 1
+            for received, data in batch:
+                try:
+                    update = Update.de_json(data, self.app.bot)
+                except Exception:
+                    self.invalid += 1
+                    logger.exception("Broken update from webhook: %.200r", data)
+                    continue
+                await self._slots.acquire()
+                task = asyncio.create_task(self.app.update_processor.process_update(
+                    update, self._process(update, received)))
+                self._running.add(task)
+                task.add_done_callback(self._finished)
+
+    def _finished(self, task: asyncio.Task) -> None:
+        # слот освобождается здесь, даже если задачу отменили до _process
+        self._running.discard(task)
+        self._slots.release()
+
+    async def _process(self, update: Update, received: float) -> None:
+        try:
+            await self.app.process_update(update)
+        finally:
+            self.latencies.append(time.perf_counter() - received)
+            self.processed += 1
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Дорабатывает принятые апдейты (не дольше timeout) и останавливает задачу."""
+        deadline = time.monotonic() + timeout
+        while (not self._queue.empty() or self._running) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if not self._queue.empty():
+            logger.warning("Webhook: %d updates dropped on shutdown", self._queue.qsize())
+
+    def metrics(self) -> dict:
+        latencies = list(self.latencies)
+        return {
+            'received': self.received,
+            'processed': self.processed,
+            'queued': self._queue.qsize(),
+            'inflight': len(self._running),
+            'rejected': self.rejected,
+            'forbidden': self.forbidden,
+            'invalid': self.invalid,
+            'batches': self.batches,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        }